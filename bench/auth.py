@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+In-process benchmark of device token checks (validate_device_token in
+server.py): signed tokens from the verify cache and verified from scratch,
+opaque tokens looked up by hash, with and without the Bloom filter in front
+of the revocation list.
+
+Nothing is started; server.py is imported with a throwaway DATA_DIR.
+
+Usage:
+    python bench/auth.py
+    python bench/auth.py --devices 10000 --revoked 100000 --calls 200000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="cos-auth-"))
+
+import server
+
+
+def ns_per_call(fn, arg, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn(arg)
+    return round((time.perf_counter() - start) / calls * 1e9)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=1000, help="devices registered per format")
+    parser.add_argument("--revoked", type=int, default=10000, help="entries in the revocation list")
+    parser.add_argument("--calls", type=int, default=100000)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    expires = time.time() + 86400
+    with open(server.REVOKED_FILE, "w") as f:
+        json.dump({f"revoked-{i}": expires for i in range(args.revoked)}, f)
+    server.load_devices()
+
+    server.TOKEN_FORMAT = "opaque"
+    opaque = [server.create_device(f"user{i}@example.com") for i in range(args.devices)]
+    server.TOKEN_FORMAT = "signed"
+    signed = [server.create_device(f"user{i}@example.com") for i in range(args.devices)]
+    assert server.validate_device_token(signed[-1])["email"] == f"user{args.devices - 1}@example.com"
+    assert server.validate_device_token(opaque[-1])["email"] == f"user{args.devices - 1}@example.com"
+
+    signer = server.token_signer
+    results = {
+        "devices": args.devices,
+        "revoked": args.revoked,
+        "ns_per_call": {
+            "signed_cached": ns_per_call(server.validate_device_token, signed[-1], args.calls),
+            "signed_uncached": ns_per_call(signer._decode, signed[-1], args.calls),
+            "opaque": ns_per_call(server.validate_device_token, opaque[-1], args.calls),
+        },
+    }
+    signer.revocations = server.RevocationList(server.REVOKED_FILE, bloom_bits=max(args.revoked, 1) * 10)
+    signer.revocations.is_revoked("", time.time())  # load the list and build the filter
+    results["ns_per_call"]["signed_cached_bloom"] = ns_per_call(server.validate_device_token, signed[-1], args.calls)
+
+    for name, ns in results["ns_per_call"].items():
+        print(f"{name:22} {ns:>6} ns")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Synthetic datasets for the benchmarks: Amplenote-style tasks and notes and a
+memory-scaffold context bundle. Generation is deterministic for a given seed.
+"""
+import json
+import random
+import time
+
+WORDS = ("review draft call email plan fix write send prepare update check book "
+         "invoice budget proposal client team meeting notes report deploy release "
+         "tax doctor garden car insurance offsite hiring roadmap").split()
+
+TAGS = ["work", "home", "finance", "health", "project/alpha", "project/beta", "waiting", "someday"]
+
+CONTEXT_FILES = ["CLAUDE.md", "PROJECTS.md", "WAITING_FOR.md", "INBOX.md", "DECISIONS.md"]
+
+
+def _sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def make_task(rng, i, now):
+    """One task in the shape the Amplenote plugin posts to /tasks."""
+    task = {
+        "uuid": f"task-{i:08d}",
+        "content": _sentence(rng, rng.randint(4, 14)),
+        "noteUUID": f"note-{rng.randint(0, 999):04d}",
+        "score": round(rng.uniform(0, 20), 2),
+        "important": rng.random() < 0.2,
+        "urgent": rng.random() < 0.1,
+        "startAt": None,
+        "hideUntil": None,
+        "completedAt": None,
+        "dismissedAt": None,
+    }
+    roll = rng.random()
+    if roll < 0.15:
+        task["completedAt"] = now - rng.randint(0, 90 * 86400)
+    elif roll < 0.20:
+        task["dismissedAt"] = now - rng.randint(0, 90 * 86400)
+    if rng.random() < 0.3:
+        task["startAt"] = now + rng.randint(-30 * 86400, 30 * 86400)
+    if rng.random() < 0.1:
+        task["hideUntil"] = now + rng.randint(-5 * 86400, 20 * 86400)
+    if rng.random() < 0.25:
+        task["deadline"] = now + rng.randint(-5 * 86400, 60 * 86400)
+    if rng.random() < 0.3:
+        task["tags"] = rng.sample(TAGS, rng.randint(1, 2))
+    return task
+
+
+def iter_tasks(count, seed=1, now=None):
+    rng = random.Random(seed)
+    now = int(now or time.time())
+    for i in range(count):
+        yield make_task(rng, i, now)
+
+
+def make_tasks(count, seed=1, now=None):
+    return list(iter_tasks(count, seed, now))
+
+
+def write_tasks_payload(path, count, seed=1):
+    """Stream a POST /tasks body to `path` without holding every task in memory."""
+    with open(path, "w") as f:
+        f.write('{"tasks": [')
+        for i, task in enumerate(iter_tasks(count, seed)):
+            if i:
+                f.write(",")
+            f.write(json.dumps(task))
+        f.write('], "syncedAt": %d}' % int(time.time() * 1000))
+
+
+def make_notes(count, note_kb=8, seed=1):
+    """Notes with a mix of types, tags and large markdown bodies."""
+    rng = random.Random(seed)
+    now = int(time.time() * 1000)
+    notes = []
+    for i in range(count):
+        paragraphs = []
+        size = 0
+        while size < note_kb * 1024:
+            paragraph = _sentence(rng, rng.randint(20, 60)) + "."
+            paragraphs.append(paragraph)
+            size += len(paragraph) + 2
+        notes.append({
+            "uuid": f"note-{i:06d}",
+            "name": _sentence(rng, 3),
+            "type": rng.choice(["werkbank", "project", "project", "reference", "journal"]),
+            "tags": rng.sample(TAGS, rng.randint(0, 3)),
+            "updated": now - rng.randint(0, 365 * 86400 * 1000),
+            "content": "\n\n".join(paragraphs),
+        })
+    return notes
+
+
+def make_markdown(title, sections, section_kb, rng):
+    lines = [f"# {title}", ""]
+    for s in range(sections):
+        lines.append(f"## Section {s + 1}: {_sentence(rng, 2)}")
+        lines.append("")
+        size = 0
+        while size < section_kb * 1024:
+            line = f"- {_sentence(rng, rng.randint(6, 16))}"
+            lines.append(line)
+            size += len(line) + 1
+        lines.append("")
+    return "\n".join(lines)
+
+
+def make_context(context_kb=64, seed=1):
+    """The five memory scaffold files, each roughly `context_kb` KB in ~8 sections."""
+    rng = random.Random(seed)
+    sections = 8
+    return {name: make_markdown(name[:-3].replace("_", " ").title(), sections,
+                                max(1, context_kb // sections), rng)
+            for name in CONTEXT_FILES}
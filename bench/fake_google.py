@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""
+Fake Google API
+Local stand-in for the Gmail and Calendar REST APIs used by server.py,
+with configurable latency and error injection. Point the server at it with
+GOOGLE_API_ENDPOINT=http://127.0.0.1:<port>.
+
+Accounts are identified by their access token ("fake-<email>"), which is
+what bench/run.py writes into the server's token files.
+
+Usage: python bench/fake_google.py --port 9100 --latency-ms 40 --error-rate 0.02
+"""
+import argparse
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+
+SENDERS = [
+    "Sarah Miller <sarah@example.com>",
+    "AWS Billing <billing@aws.example.com>",
+    "GitHub <noreply@github.example.com>",
+    "Max Mustermann <max@example.de>",
+    "Newsletter <news@example.org>",
+]
+SUBJECTS = [
+    "Re: Project timeline", "Your bill is ready", "[repo] PR #42 review requested",
+    "Termin nächste Woche", "Weekly digest", "Quick question", "Invoice 2026-10",
+]
+DATE_FORMATS = [
+    "%a, %d %b %Y %H:%M:%S %z",
+    "%d %b %Y %H:%M:%S %z",
+    "%a, %d %b %Y %H:%M:%S +0000 (UTC)",
+]
+
+
+class FakeGoogleConfig:
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, rate_limit_rate=0.0,
+                 messages_per_account=30, calendars_per_account=2, events_per_day=3, body_kb=4,
+                 seed=1):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.messages_per_account = messages_per_account
+        self.calendars_per_account = calendars_per_account
+        self.events_per_day = events_per_day
+        self.body_kb = body_kb
+        self.seed = seed
+
+
+class FakeGoogleState:
+    """Deterministic per-account mailbox and calendar data plus call counters."""
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.errors = {}
+        self._messages = {}
+
+    def count(self, account, method, error=False):
+        key = f"{account} {method}"
+        with self.lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+            if error:
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": dict(self.calls),
+                "errors": dict(self.errors),
+                "total_calls": sum(self.calls.values()),
+                "total_errors": sum(self.errors.values()),
+            }
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.errors.clear()
+
+    def messages(self, account):
+        with self.lock:
+            if account not in self._messages:
+                self._messages[account] = self._generate_messages(account)
+            return self._messages[account]
+
+    def _generate_messages(self, account):
+        rng = random.Random(f"{self.config.seed}:{account}")
+        now = datetime.now(timezone.utc)
+        messages = []
+        for i in range(self.config.messages_per_account):
+            sent = now - timedelta(minutes=rng.randint(1, 60 * 20))
+            offset = timezone(timedelta(hours=rng.choice([-5, 0, 1, 2, 9])))
+            date_header = sent.astimezone(offset).strftime(rng.choice(DATE_FORMATS))
+            sender = rng.choice(SENDERS)
+            subject = rng.choice(SUBJECTS)
+            # Every 5th message is a copy that also reached the other accounts
+            shared = i % 5 == 0
+            message_id = f"<shared-{i}@example.com>" if shared else f"<{account}-{i}@example.com>"
+            msg_id = hashlib.sha1(f"{account}:{i}".encode()).hexdigest()[:16]
+            body = (f"Hello,\n\nThis is message {i} for {account}.\n" +
+                    "Lorem ipsum dolor sit amet. " * (self.config.body_kb * 1024 // 28))
+            messages.append({
+                "id": msg_id,
+                "threadId": hashlib.sha1(f"{account}:{subject}".encode()).hexdigest()[:16],
+                "labelIds": ["INBOX", "UNREAD"] if i % 3 else ["INBOX"],
+                "snippet": body[:100].replace("\n", " "),
+                "internalDate": str(int(sent.timestamp() * 1000)),
+                "headers": [
+                    {"name": "Subject", "value": subject},
+                    {"name": "From", "value": sender},
+                    {"name": "To", "value": account},
+                    {"name": "Date", "value": date_header},
+                    {"name": "Message-ID", "value": message_id},
+                ],
+                "body": body,
+                "has_attachment": i % 4 == 0,
+            })
+        messages.sort(key=lambda m: m["internalDate"], reverse=True)
+        return messages
+
+    def calendars(self, account):
+        return [{"id": account if i == 0 else f"cal{i}-{account}", "summary": "Main" if i == 0 else f"Calendar {i}"}
+                for i in range(self.config.calendars_per_account)]
+
+    def events(self, account, calendar_id, time_min, time_max):
+        rng = random.Random(f"{self.config.seed}:{calendar_id}")
+        slots = [(9, 0, 60), (11, 30, 30), (13, 0, 90), (15, 30, 45), (17, 0, 30)]
+        start_day = time_min.date()
+        events = []
+        day = start_day
+        while datetime.combine(day, datetime.min.time(), timezone.utc) < time_max:
+            for n in range(self.config.events_per_day):
+                hour, minute, duration = slots[(n + rng.randint(0, len(slots) - 1)) % len(slots)]
+                start = datetime(day.year, day.month, day.day, hour, minute, tzinfo=timezone.utc)
+                end = start + timedelta(minutes=duration)
+                if end > time_min and start < time_max:
+                    events.append({
+                        "id": f"{calendar_id}-{day.isoformat()}-{n}",
+                        "summary": f"Meeting {n + 1}",
+                        "start": {"dateTime": start.isoformat()},
+                        "end": {"dateTime": end.isoformat()},
+                        "status": "confirmed",
+                        "htmlLink": "https://calendar.example.com/event",
+                    })
+            if day.toordinal() % 5 == 0:
+                events.append({
+                    "id": f"{calendar_id}-{day.isoformat()}-allday",
+                    "summary": "Offsite",
+                    "start": {"date": day.isoformat()},
+                    "end": {"date": (day + timedelta(days=1)).isoformat()},
+                    "transparency": "transparent",
+                    "status": "confirmed",
+                })
+            day += timedelta(days=1)
+        events.sort(key=lambda e: e["start"].get("dateTime", e["start"].get("date")))
+        return events
+
+
+def _parse_time(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def make_handler(state):
+    config = state.config
+
+    class FakeGoogleHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body go out in separate writes; without TCP_NODELAY the body
+        # waits for the client's delayed ACK (~40 ms) on a kept-alive connection
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def _account(self):
+            auth = self.headers.get("Authorization", "")
+            token = auth[7:] if auth.startswith("Bearer ") else ""
+            return token[5:] if token.startswith("fake-") else "unknown"
+
+        def _send(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _inject(self, account, method):
+            """Apply latency and error injection. Returns True if an error was sent."""
+            if config.latency_ms or config.jitter_ms:
+                delay = config.latency_ms + random.uniform(-config.jitter_ms, config.jitter_ms)
+                time.sleep(max(0.0, delay) / 1000)
+            roll = random.random()
+            if roll < config.rate_limit_rate:
+                state.count(account, method, error=True)
+                self._send(429, {"error": {"code": 429, "message": "Rate Limit Exceeded",
+                                           "errors": [{"reason": "rateLimitExceeded"}]}})
+                return True
+            if roll < config.rate_limit_rate + config.error_rate:
+                state.count(account, method, error=True)
+                self._send(503, {"error": {"code": 503, "message": "Backend Error",
+                                           "errors": [{"reason": "backendError"}]}})
+                return True
+            state.count(account, method)
+            return False
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            path = parsed.path
+            params = parse_qs(parsed.query)
+            account = self._account()
+
+            if path == "/_stats":
+                self._send(200, state.stats())
+                return
+
+            # Calendar paths come with or without the /calendar/v3 prefix
+            if path.startswith("/calendar/v3/"):
+                path = path[len("/calendar/v3"):]
+
+            if path == "/gmail/v1/users/me/messages":
+                if self._inject(account, "gmail.messages.list"):
+                    return
+                messages = state.messages(account)
+                query = params.get("q", [""])[0]
+                if "is:unread" in query:
+                    messages = [m for m in messages if "UNREAD" in m["labelIds"]]
+                limit = int(params.get("maxResults", [100])[0])
+                self._send(200, {
+                    "messages": [{"id": m["id"], "threadId": m["threadId"]} for m in messages[:limit]],
+                    "resultSizeEstimate": len(messages),
+                })
+                return
+
+            if path.startswith("/gmail/v1/users/me/messages/"):
+                msg_id = path.rsplit("/", 1)[1]
+                message = next((m for m in state.messages(account) if m["id"] == msg_id), None)
+                if self._inject(account, "gmail.messages.get"):
+                    return
+                if not message:
+                    self._send(404, {"error": {"code": 404, "message": "Requested entity was not found."}})
+                    return
+                self._send(200, self._render_message(message, params.get("format", ["full"])[0],
+                                                     params.get("metadataHeaders", [])))
+                return
+
+            if path == "/users/me/calendarList":
+                if self._inject(account, "calendar.calendarList.list"):
+                    return
+                self._send(200, {"items": state.calendars(account)})
+                return
+
+            if path.startswith("/calendars/") and path.endswith("/events"):
+                calendar_id = unquote(path[len("/calendars/"):-len("/events")])
+                if self._inject(account, "calendar.events.list"):
+                    return
+                time_min = _parse_time(params.get("timeMin", [datetime.now(timezone.utc).isoformat()])[0])
+                time_max = _parse_time(params.get("timeMax", [(time_min + timedelta(days=7)).isoformat()])[0])
+                events = state.events(account, calendar_id, time_min, time_max)
+                limit = int(params.get("maxResults", [250])[0])
+                self._send(200, {"items": events[:limit]})
+                return
+
+            self._send(404, {"error": {"code": 404, "message": f"Unknown path {path}"}})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            path = urlparse(self.path).path
+            account = self._account()
+            if path.startswith("/calendar/v3/"):
+                path = path[len("/calendar/v3"):]
+
+            if path == "/token":
+                self._send(200, {"access_token": "fake-refreshed", "expires_in": 3600, "token_type": "Bearer"})
+                return
+
+            if path == "/_reset":
+                state.reset()
+                self._send(200, {"success": True})
+                return
+
+            if path == "/freeBusy":
+                if self._inject(account, "calendar.freebusy.query"):
+                    return
+                time_min = _parse_time(body["timeMin"])
+                time_max = _parse_time(body["timeMax"])
+                calendars = {}
+                for item in body.get("items", []):
+                    busy = []
+                    for event in state.events(account, item["id"], time_min, time_max):
+                        if "dateTime" not in event["start"] or event.get("transparency") == "transparent":
+                            continue
+                        busy.append({"start": event["start"]["dateTime"], "end": event["end"]["dateTime"]})
+                    calendars[item["id"]] = {"busy": busy}
+                self._send(200, {"kind": "calendar#freeBusy", "calendars": calendars})
+                return
+
+            self._send(404, {"error": {"code": 404, "message": f"Unknown path {path}"}})
+
+        def _render_message(self, message, fmt, metadata_headers):
+            result = {
+                "id": message["id"],
+                "threadId": message["threadId"],
+                "labelIds": message["labelIds"],
+                "snippet": message["snippet"],
+                "internalDate": message["internalDate"],
+            }
+            if fmt == "minimal":
+                return result
+            headers = message["headers"]
+            if fmt == "metadata":
+                if metadata_headers:
+                    headers = [h for h in headers if h["name"] in metadata_headers]
+                result["payload"] = {"headers": headers}
+                return result
+            text = base64.urlsafe_b64encode(message["body"].encode()).decode()
+            parts = [{"partId": "0", "mimeType": "text/plain", "filename": "",
+                      "body": {"size": len(message["body"]), "data": text}}]
+            if message["has_attachment"]:
+                parts.append({"partId": "1", "mimeType": "application/pdf", "filename": "invoice.pdf",
+                              "body": {"size": 48213, "attachmentId": f"att-{message['id']}"}})
+            result["payload"] = {"mimeType": "multipart/mixed", "headers": headers, "parts": parts}
+            result["sizeEstimate"] = len(message["body"]) + 512
+            return result
+
+    return FakeGoogleHandler
+
+
+def start_fake_google(port=0, config=None):
+    """Start the fake API in a background thread. Returns (server, state)."""
+    state = FakeGoogleState(config or FakeGoogleConfig())
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of calls answered with 429")
+    parser.add_argument("--messages", type=int, default=30, help="messages per account")
+    args = parser.parse_args()
+
+    config = FakeGoogleConfig(args.latency_ms, args.jitter_ms, args.error_rate, args.rate_limit_rate,
+                              messages_per_account=args.messages)
+    server, _ = start_fake_google(args.port, config)
+    print(f"Fake Google API on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+In-process benchmark of the note indexes behind /notes?type=&tag=&updated_since=
+and /notes/werkbank: lookup time of NoteColumns in server.py at several
+collection sizes, with a fixed number of matches (20 werkbank notes, 20 tagged
+"focus", 20 updated in the last hour), against the linear scan the routes
+used before (filter every note, then json.dumps the matches).
+
+Times are per lookup and include building the response body (uncached).
+
+Usage:
+    python bench/notes_index.py                  # 1k, 10k, 100k notes
+    python bench/notes_index.py --sizes 1000,200000 --note-kb 2
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="cos-notes-"))
+
+from datasets import make_notes
+import server
+
+MATCHES = 20
+
+
+def make_collection(size, note_kb):
+    notes = make_notes(size, note_kb)
+    now = int(time.time() * 1000)
+    for note in notes:
+        if note["type"] == "werkbank":
+            note["type"] = "reference"
+        note["tags"] = [tag for tag in note["tags"] if tag != "focus"]
+        note["updated"] = min(note["updated"], now - 86400 * 1000)
+    step = size // MATCHES
+    for i in range(MATCHES):
+        notes[i * step]["type"] = "werkbank"
+        notes[i * step + 1]["tags"].append("focus")
+        notes[i * step + 2]["updated"] = now - i * 1000
+    return notes, now - 3600 * 1000
+
+
+def us_per_call(fn, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return round((time.perf_counter() - start) / calls * 1e6, 1)
+
+
+def run(size, note_kb, calls):
+    notes, hour_ago = make_collection(size, note_kb)
+    store = server.NoteStore()
+    start = time.perf_counter()
+    store.replace(notes, None)
+    sync_ms = (time.perf_counter() - start) * 1000
+    columns = store.columns
+
+    assert len(columns.query("werkbank")) == MATCHES
+    assert len(columns.query(tags=["focus"])) == MATCHES
+    assert len(columns.query(updated_since=hour_ago)) == MATCHES
+
+    def scan():
+        werkbank = [n for n in notes if n.get("type") == "werkbank"]
+        return json.dumps({"notes": werkbank, "syncedAt": None})
+
+    return {
+        "notes": size,
+        "sync_ms": round(sync_ms, 1),
+        "us_per_lookup": {
+            "werkbank": us_per_call(lambda: columns.json_rows(columns.by_type.get("werkbank", [])), calls),
+            "tag": us_per_call(lambda: columns.json_rows(columns.query(tags=["focus"])), calls),
+            "updated_since": us_per_call(lambda: columns.json_rows(columns.query(updated_since=hour_ago)), calls),
+            "type_tag_fields": us_per_call(lambda: columns.json_rows(columns.query("project", ["focus"]),
+                                                                     fields=["uuid", "name"]), calls),
+            "scan_werkbank": us_per_call(scan, max(1, calls // 100)),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma-separated note counts")
+    parser.add_argument("--note-kb", type=int, default=1)
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    for size in [int(s) for s in args.sizes.split(",")]:
+        result = run(size, args.note_kb, args.calls)
+        results.append(result)
+        us = result["us_per_lookup"]
+        print(f"{size:>8} notes  werkbank {us['werkbank']:>7} us  tag {us['tag']:>7} us"
+              f"  updated_since {us['updated_since']:>7} us  type+tag+fields {us['type_tag_fields']:>7} us"
+              f"   linear scan {us['scan_werkbank']:>9} us   sync {result['sync_ms']} ms")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
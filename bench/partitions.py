@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Isolation benchmark of the per-user partitions in server.py: latency of one
+user's reads (bob: /tasks/today?limit=10 and /context/CLAUDE.md) while
+another user (alice) repeatedly syncs a large task list, against the same
+reads while alice is idle.
+
+Runs twice: "shared" maps bob onto alice's data with PARTITION_ALIASES (what
+every user saw before partitioning), "partitioned" keeps bob's data apart.
+Partitions remove waiting on alice's locks; what remains are pauses of the
+whole process (garbage collection, long C calls such as decoding the sync
+body), which only a separate process per user would avoid.
+
+Usage:
+    python bench/partitions.py
+    python bench/partitions.py --tasks 200000 --seconds 20
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from datasets import make_context, write_tasks_payload
+import run
+
+BOB_TOKEN = "bench-device-token-bob"
+READS = ["/tasks/today?limit=10", "/context/CLAUDE.md"]
+
+
+def add_device(data_dir, token, email):
+    path = os.path.join(data_dir, "devices.json")
+    with open(path) as f:
+        devices = json.load(f)
+    devices["devices"].append({
+        "token_hash": hashlib.sha256(token.encode()).hexdigest(),
+        "email": email,
+        "device_name": "bench",
+        "created_at": datetime.now().isoformat(),
+        "expires_at": (datetime.now() + timedelta(days=1)).isoformat(),
+        "last_used": datetime.now().isoformat(),
+    })
+    with open(path, "w") as f:
+        json.dump(devices, f)
+
+
+def read_latencies(port, seconds):
+    """bob's reads back to back on one connection for `seconds`; latencies in ms."""
+    conn = run.http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+    headers = {"Authorization": f"Bearer {BOB_TOKEN}"}
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    i = 0
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        status, _ = run.request(port, "GET", READS[i % len(READS)], headers=headers, conn=conn)
+        latencies.append((time.perf_counter() - start) * 1000)
+        assert status == 200, status
+        i += 1
+    conn.close()
+    return sorted(latencies)
+
+
+def summary(latencies):
+    return {"requests": len(latencies), "p50_ms": round(statistics.median(latencies), 2),
+            "p99_ms": round(run.percentile(latencies, 99), 2), "max_ms": round(latencies[-1], 2),
+            "over_50ms": sum(1 for v in latencies if v > 50)}
+
+
+def scenario(mode, payloads, port, seconds):
+    data_dir = tempfile.mkdtemp(prefix=f"cos-partitions-{mode}-")
+    run.prepare_data_dir(data_dir, "http://127.0.0.1:1")
+    add_device(data_dir, BOB_TOKEN, run.ACCOUNTS[1])
+    env = {"PARTITION_ALIASES": f"{run.ACCOUNTS[1]}={run.ACCOUNTS[0]}"} if mode == "shared" else {}
+    server = run.ServerProcess(data_dir, port, "http://127.0.0.1:1", env=env)
+    try:
+        server.wait_ready()
+        bob = {"Authorization": f"Bearer {BOB_TOKEN}"}
+        if mode == "partitioned":
+            run.request(port, "POST", "/tasks", {"tasks": [{"uuid": f"b{i}", "content": "bob", "score": i}
+                                                           for i in range(100)]}, bob)
+        run.request(port, "POST", "/context", {"files": make_context(16)}, bob)
+
+        def sync(path):
+            size = os.path.getsize(path)
+            with open(path, "rb") as f:
+                start = time.perf_counter()
+                status, _ = run.request(port, "POST", f"/tasks?key={run.API_KEY}", f,
+                                        {"Content-Type": "application/json", "Content-Length": str(size)})
+            assert status == 200, status
+            return (time.perf_counter() - start) * 1000
+
+        sync(payloads[0])
+        idle = read_latencies(port, seconds)
+
+        stop = threading.Event()
+        sync_ms = []
+
+        def syncer():
+            i = 1
+            while not stop.is_set():
+                sync_ms.append(sync(payloads[i % len(payloads)]))
+                i += 1
+
+        thread = threading.Thread(target=syncer)
+        thread.start()
+        busy = read_latencies(port, seconds)
+        stop.set()
+        thread.join()
+        return {"idle": summary(idle), "during_sync": summary(busy),
+                "syncs": len(sync_ms), "sync_ms_p50": round(statistics.median(sync_ms), 1)}
+    finally:
+        server.stop()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, default=100000, help="tasks in alice's syncs")
+    parser.add_argument("--seconds", type=float, default=10, help="duration of each read phase")
+    parser.add_argument("--port", type=int, default=18210)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="cos-partitions-")
+    payloads = []
+    for seed in (1, 2):  # alternate two different task lists so every sync re-ranks
+        path = os.path.join(work_dir, f"tasks-{seed}.json")
+        write_tasks_payload(path, args.tasks, seed=seed)
+        payloads.append(path)
+
+    results = {"tasks": args.tasks}
+    try:
+        for mode in ("shared", "partitioned"):
+            result = results[mode] = scenario(mode, payloads, args.port, args.seconds)
+            for phase in ("idle", "during_sync"):
+                r = result[phase]
+                print(f"{mode:12} bob reads, alice {phase:12} p50 {r['p50_ms']:>8} ms  p99 {r['p99_ms']:>8} ms"
+                      f"  max {r['max_ms']:>8} ms  {r['over_50ms']:>4} of {r['requests']} over 50 ms")
+            print(f"{mode:12} alice: {result['syncs']} syncs of {args.tasks} tasks, p50 {result['sync_ms_p50']} ms")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
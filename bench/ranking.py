@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+In-process benchmark of the task ranking behind /tasks/today?limit=10 and
+/briefing: per-request cost of the incremental TaskRanker in server.py at
+several task counts, against ranking all of today's tasks per request.
+
+Requests are spread over a simulated day (one every few minutes). Rank
+changes come due in between (tasks becoming visible, deadline steps, start
+bonuses expiring); the server's clock thread applies them every 30 seconds,
+which is simulated here, untimed, before each request. "cold" is the same
+request when it has to apply all changes due since the previous request
+itself. Every 20th request follows a sync that changed 0.1% of the tasks;
+the sync itself is timed separately.
+
+Usage:
+    python bench/ranking.py                        # 10k, 100k, 1M tasks
+    python bench/ranking.py --sizes 100000 --requests 500
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="cos-ranking-"))
+
+from datasets import make_tasks
+import server
+
+WEIGHTS = "score=1,deadline=10,start=3,age=0.1"
+
+
+def full_sort_top(ranker, tasks, now, limit):
+    """Rank every open, visible task from scratch and sort: the per-request
+    cost without the incremental structure."""
+    ranked = []
+    first_seen = ranker._first_seen
+    for task in tasks:
+        if server._task_time(task.get("completedAt")) or server._task_time(task.get("dismissedAt")):
+            continue
+        rank, _ = ranker._evaluate(ranker._entry(task, b"", first_seen.get(task["uuid"], now)), now)
+        if rank is not None:
+            ranked.append((rank, task["uuid"]))
+    ranked.sort(reverse=True)
+    return ranked[:limit]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(size, requests, limit, baseline_requests):
+    rng = random.Random(size)
+    now = time.time()
+    tasks = make_tasks(size, seed=1, now=now)
+    store = server.TaskStore(server.TaskRanker(WEIGHTS))
+    start = time.perf_counter()
+    store.replace(tasks, None, now)
+    load_ms = (time.perf_counter() - start) * 1000
+
+    step = 86400 / requests
+    request_us, cold_us, sync_ms = [], [], []
+    for i in range(requests):
+        now += step
+        if i and i % 20 == 0:
+            tasks = [dict(t) for t in tasks]
+            for task in rng.sample(tasks, max(1, size // 1000)):
+                task["score"] = round(rng.uniform(0, 20), 2)
+            start = time.perf_counter()
+            store.replace(tasks, None, now)
+            sync_ms.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        store.today(now, limit)
+        cold_us.append((time.perf_counter() - start) * 1e6)
+
+        now += 30
+        store.ranker.advance(now - 30 * rng.random())
+        start = time.perf_counter()
+        store.today(now, limit)
+        request_us.append((time.perf_counter() - start) * 1e6)
+
+    baseline_ms = []
+    for _ in range(baseline_requests):
+        start = time.perf_counter()
+        full_sort_top(store.ranker, tasks, now, limit)
+        baseline_ms.append((time.perf_counter() - start) * 1000)
+
+    return {
+        "tasks": size,
+        "initial_load_ms": round(load_ms, 1),
+        "request_us": {"p50": round(statistics.median(request_us), 1),
+                       "p99": round(percentile(request_us, 0.99), 1)},
+        "cold_request_us": {"p50": round(statistics.median(cold_us), 1),
+                            "p99": round(percentile(cold_us, 0.99), 1)},
+        "sync_ms_p50": round(statistics.median(sync_ms), 1) if sync_ms else None,
+        "full_sort_ms_p50": round(statistics.median(baseline_ms), 1),
+        "epochs": store.ranker.epoch,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="comma-separated task counts")
+    parser.add_argument("--requests", type=int, default=300, help="requests spread over one simulated day")
+    parser.add_argument("--limit", type=int, default=10, help="top-k per request")
+    parser.add_argument("--baseline-requests", type=int, default=3, help="full-sort requests for comparison")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    for size in [int(s) for s in args.sizes.split(",")]:
+        result = run(size, args.requests, args.limit, args.baseline_requests)
+        results.append(result)
+        print(f"{size:>9} tasks  top-{args.limit} request p50 {result['request_us']['p50']:>7} us"
+              f"  p99 {result['request_us']['p99']:>7} us   cold p50 {result['cold_request_us']['p50']:>7} us"
+              f"   full sort {result['full_sort_ms_p50']:>7} ms   sync {result['sync_ms_p50']} ms"
+              f"   initial load {result['initial_load_ms']} ms")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+"""
+Chief of Staff Benchmark
+Starts server.py against the fake Google API (bench/fake_google.py), seeds it
+with synthetic datasets and drives load against every endpoint.
+
+Reports p50/p95/p99 latency, throughput, server RSS, disk writes and upstream
+Google calls per endpoint, and saves everything to a JSON file so runs can be
+compared between versions.
+
+Usage:
+    python bench/run.py                                  # 10, 1k, 100k tasks
+    python bench/run.py --sizes 10,1000000 --output new.json
+    python bench/run.py --latency-ms 80 --error-rate 0.05 --endpoints /emails
+    python bench/run.py --compare old.json new.json      # exits 1 on regressions
+"""
+import argparse
+import hashlib
+import http.client
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from datasets import make_notes, make_context, write_tasks_payload
+from fake_google import FakeGoogleConfig, start_fake_google
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER = os.path.join(ROOT, "server.py")
+
+TOKEN = "bench-device-token"
+API_KEY = "bench-api-key"
+ACCOUNTS = ["alice@example.com", "bob@example.org"]
+
+# (method, path, body) -- body is a callable taking the seeded context bundle.
+# Keep in sync with the routes in ChiefOfStaffHandler.
+ENDPOINTS = [
+    ("GET", "/health", None),
+    ("GET", "/auth/status", None),
+    ("GET", "/tasks", None),
+    ("GET", "/tasks/open", None),
+    ("GET", "/tasks/today", None),
+    ("GET", "/notes", None),
+    ("GET", "/notes/werkbank", None),
+    ("GET", "/notes/projects", None),
+    ("GET", "/context", None),
+    ("GET", "/context/CLAUDE.md", None),
+    ("GET", "/context/CLAUDE.md?raw=1", None),
+    ("GET", "/context/PROJECTS.md?index=1", None),
+    ("GET", "/context/PROJECTS.md?lines=1-40", None),
+    ("GET", "/emails/unread", None),
+    ("GET", "/emails/recent", None),
+    ("GET", "/emails/digest", None),
+    # First message of the first account in bench/fake_google.py
+    ("GET", f"/emails/{ACCOUNTS[0]}/{hashlib.sha1(f'{ACCOUNTS[0]}:0'.encode()).hexdigest()[:16]}", None),
+    ("GET", "/gmail/status", None),
+    ("GET", "/calendar/today", None),
+    ("GET", "/calendar/upcoming?days=14", None),
+    ("GET", "/calendar/week", None),
+    ("GET", "/calendar/free", None),
+    ("GET", "/briefing", None),
+    ("GET", "/metrics", None),
+    ("POST", "/context/INBOX.md", lambda context: {"content": context["INBOX.md"] + "\n- quick capture"}),
+]
+
+
+def token_file_name(email):
+    # Mirrors get_token_file() in server.py
+    return "gmail_token_" + email.replace("@", "_at_").replace(".", "_") + ".json"
+
+
+def prepare_data_dir(data_dir, fake_url):
+    os.makedirs(data_dir, exist_ok=True)
+    device = {
+        "token_hash": hashlib.sha256(TOKEN.encode()).hexdigest(),
+        "email": ACCOUNTS[0],
+        "device_name": "bench",
+        "created_at": datetime.now().isoformat(),
+        "expires_at": (datetime.now() + timedelta(days=1)).isoformat(),
+        "last_used": datetime.now().isoformat(),
+    }
+    with open(os.path.join(data_dir, "devices.json"), "w") as f:
+        json.dump({"devices": [device]}, f)
+    for email in ACCOUNTS:
+        with open(os.path.join(data_dir, token_file_name(email)), "w") as f:
+            json.dump({
+                "token": f"fake-{email}",
+                "refresh_token": "fake-refresh",
+                "token_uri": f"{fake_url}/token",
+                "expiry": "2099-01-01T00:00:00Z",
+                "client_id": "bench",
+                "client_secret": "bench",
+                "account": email,
+            }, f)
+
+
+def proc_stats(pid):
+    """RSS / peak RSS (KB) and bytes written to storage by a process (Linux only)."""
+    stats = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    stats[line.split(":")[0]] = int(line.split()[1])
+    except OSError:
+        pass
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            for line in f:
+                key, value = line.split(":")
+                if key in ("write_bytes", "wchar"):
+                    stats[key] = int(value)
+    except OSError:
+        pass
+    return stats
+
+
+class ServerProcess:
+    def __init__(self, data_dir, port, fake_url, env=None):
+        self.data_dir = data_dir
+        self.port = port
+        server_env = dict(os.environ)
+        server_env.update({
+            "PORT": str(port),
+            "DATA_DIR": data_dir,
+            "API_KEY": API_KEY,
+            "GMAIL_ACCOUNTS": ",".join(ACCOUNTS),
+            "GMAIL_CLIENT_ID": "bench",
+            "GMAIL_CLIENT_SECRET": "bench",
+            "GOOGLE_API_ENDPOINT": fake_url,
+            "SERVER_URL": f"http://127.0.0.1:{port}",
+        })
+        server_env.update(env or {})
+        self.log = open(os.path.join(data_dir, "server.log"), "w")
+        self.started = time.perf_counter()
+        self.proc = subprocess.Popen([sys.executable, SERVER], cwd=ROOT, env=server_env,
+                                     stdout=self.log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, timeout=120):
+        """Poll /health until it answers. Returns seconds since process start."""
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"server exited early, see {self.log.name}")
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=1)
+                conn.request("GET", "/health")
+                if conn.getresponse().status == 200:
+                    conn.close()
+                    return time.perf_counter() - self.started
+            except OSError:
+                pass
+            time.sleep(0.005)
+        raise RuntimeError("server did not become ready")
+
+    def stats(self):
+        return proc_stats(self.proc.pid)
+
+    def stop(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        self.log.close()
+
+
+def request(port, method, path, body=None, headers=None, timeout=300, conn=None):
+    """Send one request. Returns (status, response bytes)."""
+    own = conn is None
+    if own:
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    headers = dict(headers or {})
+    if body is not None and not isinstance(body, (bytes, str)) and not hasattr(body, "read"):
+        body = json.dumps(body).encode()
+        headers["Content-Type"] = "application/json"
+    conn.request(method, path, body=body, headers=headers)
+    response = conn.getresponse()
+    data = response.read()
+    if own:
+        conn.close()
+    return response.status, data
+
+
+def with_token(path):
+    return path + ("&" if "?" in path else "?") + f"token={TOKEN}"
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    # Nearest-rank percentile
+    index = max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def drive(port, method, path, body, concurrency, requests, max_seconds, keepalive=False):
+    """Run `requests` requests with `concurrency` workers (or stop after max_seconds)."""
+    latencies = []
+    statuses = {}
+    errors = [0]
+    lock = threading.Lock()
+    issued = [0]
+    deadline = time.perf_counter() + max_seconds
+    payload = json.dumps(body).encode() if body is not None else None
+    headers = {"Content-Type": "application/json"} if payload is not None else {}
+
+    def worker():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=300) if keepalive else None
+        while True:
+            with lock:
+                if issued[0] >= requests or time.perf_counter() > deadline:
+                    break
+                issued[0] += 1
+            start = time.perf_counter()
+            try:
+                status, _ = request(port, method, with_token(path), payload, headers, conn=conn)
+            except (OSError, http.client.HTTPException):
+                status = None
+                if conn is not None:
+                    conn.close()
+                    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+                if status is None or status >= 500:
+                    errors[0] += 1
+        if conn is not None:
+            conn.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "statuses": statuses,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "mean_ms": ms(sum(latencies) / len(latencies)) if latencies else None,
+        "max_ms": ms(latencies[-1]) if latencies else None,
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else None,
+    }
+
+
+def seed(server, work_dir, tasks, notes, note_kb, context_kb):
+    """POST the synthetic datasets. Returns (context bundle, timings)."""
+    timings = {}
+    payload_path = os.path.join(work_dir, "tasks_payload.json")
+    write_tasks_payload(payload_path, tasks)
+    size = os.path.getsize(payload_path)
+    with open(payload_path, "rb") as f:
+        start = time.perf_counter()
+        status, _ = request(server.port, "POST", f"/tasks?key={API_KEY}", f,
+                            {"Content-Type": "application/json", "Content-Length": str(size)})
+        timings["post_tasks_s"] = round(time.perf_counter() - start, 4)
+    os.remove(payload_path)
+    if status != 200:
+        raise RuntimeError(f"seeding tasks failed: HTTP {status}")
+    timings["tasks_payload_bytes"] = size
+
+    start = time.perf_counter()
+    request(server.port, "POST", f"/notes?key={API_KEY}", {"notes": make_notes(notes, note_kb)})
+    timings["post_notes_s"] = round(time.perf_counter() - start, 4)
+
+    context = make_context(context_kb)
+    start = time.perf_counter()
+    request(server.port, "POST", f"/context?key={API_KEY}", {"files": context})
+    timings["post_context_s"] = round(time.perf_counter() - start, 4)
+    return context, timings
+
+
+def run_dataset(args, tasks, fake_url, fake_state, port):
+    work_dir = tempfile.mkdtemp(prefix=f"cos-bench-{tasks}-")
+    data_dir = os.path.join(work_dir, "data")
+    prepare_data_dir(data_dir, fake_url)
+    server = ServerProcess(data_dir, port, fake_url)
+    result = {"dataset": {"tasks": tasks, "notes": args.notes, "note_kb": args.note_kb,
+                          "context_kb": args.context_kb}}
+    try:
+        result["startup_s"] = round(server.wait_ready(), 4)
+        result["rss_kb_idle"] = server.stats().get("VmRSS")
+        context, result["seed"] = seed(server, work_dir, tasks, args.notes, args.note_kb, args.context_kb)
+        result["rss_kb_seeded"] = server.stats().get("VmRSS")
+
+        # Restart on the seeded data to measure load time with a full dataset
+        server.stop()
+        server = ServerProcess(data_dir, port, fake_url)
+        result["restart_s"] = round(server.wait_ready(), 4)
+
+        endpoints = []
+        for method, path, body_factory in ENDPOINTS:
+            if args.endpoints and not any(path.startswith(p) for p in args.endpoints):
+                continue
+            body = body_factory(context) if body_factory else None
+            before = server.stats()
+            upstream_before = fake_state.stats()["total_calls"]
+            stats = drive(port, method, path, body, args.concurrency, args.requests,
+                          args.max_seconds, keepalive=args.keepalive)
+            after = server.stats()
+            stats.update({
+                "method": method,
+                "path": path,
+                "rss_kb": after.get("VmRSS"),
+                "disk_write_bytes": (after.get("write_bytes", 0) - before.get("write_bytes", 0))
+                if "write_bytes" in after else None,
+                "upstream_calls": fake_state.stats()["total_calls"] - upstream_before,
+            })
+            endpoints.append(stats)
+            print(f"  {method:4} {path:32} p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms "
+                  f"p99={stats['p99_ms']}ms {stats['throughput_rps']} req/s "
+                  f"errors={stats['errors']} upstream={stats['upstream_calls']}", flush=True)
+        result["endpoints"] = endpoints
+        result["rss_kb_peak"] = server.stats().get("VmHWM")
+    finally:
+        server.stop()
+        if not args.keep_data:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return result
+
+
+def git_version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path, threshold):
+    """Print per-endpoint latency deltas. Returns the number of regressions."""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old['meta'].get('version')} -> {new['meta'].get('version')}")
+    old_index = {(r["dataset"]["tasks"], e["method"], e["path"]): e
+                 for r in old["runs"] for e in r.get("endpoints", [])}
+    regressions = 0
+    for run in new["runs"]:
+        tasks = run["dataset"]["tasks"]
+        print(f"\n{tasks} tasks")
+        for e in run.get("endpoints", []):
+            before = old_index.get((tasks, e["method"], e["path"]))
+            if not before:
+                print(f"  {e['method']:4} {e['path']:32} (new)")
+                continue
+            line = f"  {e['method']:4} {e['path']:32}"
+            for key in ("p50_ms", "p95_ms", "p99_ms"):
+                if before.get(key) and e.get(key) is not None:
+                    change = (e[key] - before[key]) / before[key]
+                    flag = ""
+                    if key != "p99_ms" and change > threshold:
+                        flag = " !"
+                        regressions += 1
+                    line += f" {key[:3]} {before[key]:.2f}->{e[key]:.2f} ({change:+.0%}){flag}"
+            print(line)
+    print(f"\n{regressions} regression(s) above {threshold:.0%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,1000,100000", help="comma-separated task counts")
+    parser.add_argument("--notes", type=int, default=200)
+    parser.add_argument("--note-kb", type=int, default=8)
+    parser.add_argument("--context-kb", type=int, default=64, help="size of each context file")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--max-seconds", type=float, default=15.0, help="time cap per endpoint")
+    parser.add_argument("--keepalive", action="store_true", help="reuse connections per worker")
+    parser.add_argument("--endpoints", nargs="*", help="only paths starting with these prefixes")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="fake Google API latency")
+    parser.add_argument("--jitter-ms", type=float, default=5.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--port", type=int, default=18181)
+    parser.add_argument("--output", default="bench-results.json")
+    parser.add_argument("--keep-data", action="store_true", help="keep the temporary data directories")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    parser.add_argument("--threshold", type=float, default=0.15, help="regression threshold for --compare")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) else 0)
+
+    fake_config = FakeGoogleConfig(args.latency_ms, args.jitter_ms, args.error_rate, args.rate_limit_rate)
+    fake_server, fake_state = start_fake_google(0, fake_config)
+    fake_url = f"http://127.0.0.1:{fake_server.server_address[1]}"
+
+    results = {
+        "meta": {
+            "version": git_version(),
+            "timestamp": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {k: v for k, v in vars(args).items() if k not in ("compare", "output")},
+        },
+        "runs": [],
+    }
+    for size in [int(s) for s in args.sizes.split(",") if s]:
+        print(f"\n=== {size} tasks ===", flush=True)
+        results["runs"].append(run_dataset(args, size, fake_url, fake_state, args.port))
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    fake_server.shutdown()
+    print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
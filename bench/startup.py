@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark of the data files: load time and peak RSS of the snapshot
+files (tasks.snap / notes.snap, loaded by server.py's Partition) against the JSON
+files they replaced (tasks.json / notes.json read with json.load, as before).
+
+Each load runs in a fresh interpreter that has already imported server.py;
+"load" is the time Partition.load() (or the JSON equivalent) takes, "first /notes"
+the time to build the first GET /notes body after it. Peak RSS is the
+process high-water mark after the load and after that first /notes (whose
+body alone is as big as the notes); "added" is the growth during the load.
+
+Usage:
+    python bench/startup.py
+    python bench/startup.py --tasks 200000 --notes 5000 --note-kb 8 --runs 5
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+
+def child(mode):
+    import server
+    partition = server.Partition("", server.DATA_DIR)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if mode == "json":
+        with open(os.path.join(server.DATA_DIR, "tasks.json")) as f:
+            data = json.load(f)
+        partition.tasks.replace(data.get("tasks", []), data.get("syncedAt"))
+        with open(os.path.join(server.DATA_DIR, "notes.json")) as f:
+            notes_data = json.load(f)
+        loaded = time.perf_counter()
+        loaded_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        body = json.dumps(notes_data).encode()
+    else:
+        partition.load()
+        loaded = time.perf_counter()
+        loaded_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        body = partition.notes.columns.json_rows(key="all")
+    done = time.perf_counter()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"load_ms": (loaded - start) * 1000, "first_notes_ms": (done - loaded) * 1000,
+                      "load_rss_mb": loaded_peak / 1024, "added_rss_mb": (loaded_peak - before) / 1024,
+                      "peak_rss_mb": peak / 1024,
+                      "tasks": len(partition.tasks), "notes_bytes": len(body)}))
+
+
+def run_child(mode, data_dir):
+    env = dict(os.environ, DATA_DIR=data_dir)
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", mode],
+                         env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, default=100000)
+    parser.add_argument("--notes", type=int, default=2000)
+    parser.add_argument("--note-kb", type=int, default=8)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--child", choices=["json", "snapshot"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.child)
+
+    from datasets import make_notes, make_tasks
+    now = time.time()
+    json_dir = tempfile.mkdtemp(prefix="cos-startup-json-")
+    with open(os.path.join(json_dir, "tasks.json"), "w") as f:
+        json.dump({"tasks": make_tasks(args.tasks, seed=1, now=now), "syncedAt": int(now * 1000)}, f)
+    with open(os.path.join(json_dir, "notes.json"), "w") as f:
+        json.dump({"notes": make_notes(args.notes, args.note_kb), "syncedAt": int(now * 1000)}, f, indent=2)
+    snap_dir = tempfile.mkdtemp(prefix="cos-startup-snap-")
+    for name in ("tasks.json", "notes.json"):
+        with open(os.path.join(json_dir, name), "rb") as src, open(os.path.join(snap_dir, name), "wb") as dst:
+            dst.write(src.read())
+    run_child("snapshot", snap_dir)  # migrates the JSON files into snapshots
+
+    sizes = {
+        "json": sum(os.path.getsize(os.path.join(json_dir, n)) for n in ("tasks.json", "notes.json")),
+        "snapshot": sum(os.path.getsize(os.path.join(snap_dir, n)) for n in ("tasks.snap", "notes.snap")),
+    }
+    results = {"tasks": args.tasks, "notes": args.notes, "note_kb": args.note_kb}
+    for mode, data_dir in (("json", json_dir), ("snapshot", snap_dir)):
+        runs = [run_child(mode, data_dir) for _ in range(args.runs)]
+        results[mode] = {
+            "file_mb": round(sizes[mode] / 2 ** 20, 1),
+            "load_ms": round(statistics.median(r["load_ms"] for r in runs), 1),
+            "first_notes_ms": round(statistics.median(r["first_notes_ms"] for r in runs), 1),
+            "load_rss_mb": round(max(r["load_rss_mb"] for r in runs), 1),
+            "peak_rss_mb": round(max(r["peak_rss_mb"] for r in runs), 1),
+            "added_rss_mb": round(max(r["added_rss_mb"] for r in runs), 1),
+        }
+        r = results[mode]
+        print(f"{mode:9} files {r['file_mb']:>7} MB   load {r['load_ms']:>8} ms   first /notes {r['first_notes_ms']:>7} ms"
+              f"   peak RSS after load {r['load_rss_mb']:>7} MB (+{r['added_rss_mb']})"
+              f"   after /notes {r['peak_rss_mb']:>7} MB")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+In-process benchmark of the task views: the TaskStore in server.py
+(ranking by score only) against the list-of-dicts approach it replaced.
+
+Reports memory per task (tracemalloc) and the time of the open, today and
+top-10 views at each size. The store's memory counts its JSON records,
+open rows and the ranker's entries; together they take about as much as
+the decoded dicts, so the gain is the speed of the views, not memory.
+Nothing is started or written; server.py is imported with a throwaway
+DATA_DIR.
+
+Usage:
+    python bench/taskstore.py                      # 10k, 100k, 1M tasks
+    python bench/taskstore.py --sizes 1000000 --repeat 5
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="cos-taskstore-"))
+
+from datasets import make_tasks
+import server
+
+
+def dict_open(tasks):
+    return [t for t in tasks if not t.get("completedAt") and not t.get("dismissedAt")]
+
+
+def dict_today(tasks, now):
+    """The previous get_today_tasks(): filter, then sort by score."""
+    today = [t for t in tasks
+             if not t.get("completedAt")
+             and not t.get("dismissedAt")
+             and (not t.get("startAt") or t.get("startAt") <= now)
+             and (not t.get("hideUntil") or t.get("hideUntil") <= now)]
+    today.sort(key=lambda t: t.get("score", 0), reverse=True)
+    return today
+
+
+def measure_memory(build):
+    """Bytes still allocated by build() once it returns, and its result."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+
+def best_of(repeat, fn):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best * 1000, 2)
+
+
+def run(size, repeat):
+    now = time.time()
+    payload = json.dumps({"tasks": make_tasks(size, seed=1, now=now)})
+
+    dict_bytes, tasks = measure_memory(lambda: json.loads(payload)["tasks"])
+    def build_store():
+        store = server.TaskStore(server.TaskRanker("score=1"))
+        store.replace(json.loads(payload)["tasks"], None, now)
+        return store
+
+    column_bytes, store = measure_memory(build_store)
+    columns = store.columns
+
+    assert [t["uuid"] for t in store.today(now)] == [t["uuid"] for t in dict_today(tasks, now)]
+    result = {
+        "tasks": size,
+        "bytes_per_task": {"dicts": round(dict_bytes / size), "store": round(column_bytes / size)},
+        "ms": {
+            "open": {"dicts": best_of(repeat, lambda: dict_open(tasks)),
+                     "store": best_of(repeat, lambda: list(columns.open_rows))},
+            "today": {"dicts": best_of(repeat, lambda: dict_today(tasks, now)),
+                      "store": best_of(repeat, lambda: store.ranker.top(now))},
+            "today_top10": {"dicts": best_of(repeat, lambda: dict_today(tasks, now)[:10]),
+                            "store": best_of(repeat, lambda: store.today(now, 10))},
+            "today_json": {"dicts": best_of(repeat, lambda: json.dumps({"tasks": dict_today(tasks, now)})),
+                           "store": best_of(repeat, lambda: store.today_json(now))},
+        },
+    }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="comma-separated task counts")
+    parser.add_argument("--repeat", type=int, default=3, help="timing runs per view (best is reported)")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    for size in [int(s) for s in args.sizes.split(",")]:
+        result = run(size, args.repeat)
+        results.append(result)
+        memory = result["bytes_per_task"]
+        print(f"{size:>9} tasks  memory/task: dicts {memory['dicts']} B, store {memory['store']} B")
+        for view, times in result["ms"].items():
+            print(f"           {view:12} dicts {times['dicts']:>9} ms   store {times['store']:>9} ms")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,21 +4,38 @@ Chief of Staff Server
 Combined Amplenote + Gmail server with Google Sign-In authentication.
 """
 import json
+import math
 import os
+import re
 import secrets
 import hashlib
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from datetime import datetime, timedelta
-from urllib.parse import urlparse, parse_qs, urlencode
+import hmac
+import fcntl
+import threading
+import time
+import random
+import mmap
+import struct
+import sys
+import zlib
+import cProfile
+import pstats
+from array import array
+from bisect import bisect_left, insort
+import heapq
+from itertools import chain, islice
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from datetime import datetime, timedelta, time as dtime
+from zoneinfo import ZoneInfo
+from urllib.parse import parse_qs, urlencode, quote
 import base64
+from collections import OrderedDict
+from html import unescape
+from email.utils import parsedate_to_datetime, parseaddr
 
-# Google API imports
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import Flow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from google.oauth2 import id_token
-from google.auth.transport import requests as google_requests
+from types import SimpleNamespace
+
+# Google client libraries are imported lazily, see google_libs()
 
 # =============================================================================
 # Configuration from Environment Variables
@@ -38,31 +55,435 @@ API_KEY = os.environ.get("API_KEY", "")
 # Server URL for OAuth callback
 SERVER_URL = os.environ.get("SERVER_URL", "http://localhost:8080")
 
+# Override the Google API base URL (e.g. the fake API used by bench/run.py)
+GOOGLE_API_ENDPOINT = os.environ.get("GOOGLE_API_ENDPOINT", "")
+
+# Google API scheduling: per-account quota (Gmail in quota units, Calendar in
+# requests per second), retries for 429/5xx and the circuit breaker
+GMAIL_QUOTA_UNITS_PER_SEC = float(os.environ.get("GMAIL_QUOTA_UNITS_PER_SEC", "250"))
+CALENDAR_REQUESTS_PER_SEC = float(os.environ.get("CALENDAR_REQUESTS_PER_SEC", "10"))
+# Seconds of quota that may be spent at once after an idle period (Google
+# enforces the per-user limits as moving averages, not per second)
+GOOGLE_QUOTA_BURST_SECONDS = float(os.environ.get("GOOGLE_QUOTA_BURST_SECONDS", "5"))
+GOOGLE_MAX_RETRIES = int(os.environ.get("GOOGLE_MAX_RETRIES", "3"))
+GOOGLE_BREAKER_THRESHOLD = int(os.environ.get("GOOGLE_BREAKER_THRESHOLD", "5"))
+GOOGLE_BREAKER_COOLDOWN = float(os.environ.get("GOOGLE_BREAKER_COOLDOWN", "30"))
+
+# Import the Google client libraries in the background right after startup
+# (otherwise on first use)
+GOOGLE_WARMUP = os.environ.get("GOOGLE_WARMUP", "1") not in ("0", "false", "off")
+
+# Working hours for /calendar/free ("09:00-18:00", ISO weekdays "1-5") and
+# the IANA timezone they are in
+WORK_HOURS = os.environ.get("WORK_HOURS", "09:00-18:00")
+WORK_DAYS = os.environ.get("WORK_DAYS", "1-5")
+CALENDAR_TIMEZONE = os.environ.get("CALENDAR_TIMEZONE", os.environ.get("TZ", "UTC"))
+
+# Task ranking for /tasks/today and /briefing: weights of the pushed score,
+# deadline proximity (full weight once overdue), a freshly started/unhidden
+# task, age (per day since first sync) and per-tag bonuses (important/urgent
+# count as tags), e.g. TASK_RANK_WEIGHTS="score=1,deadline=10,start=3,age=0.1"
+# and TASK_TAG_WEIGHTS="waiting=-5,urgent=3". The default ranks by score alone.
+TASK_RANK_WEIGHTS = os.environ.get("TASK_RANK_WEIGHTS", "score=1")
+TASK_TAG_WEIGHTS = os.environ.get("TASK_TAG_WEIGHTS", "")
+
+# Device tokens issued at login: "signed" (HMAC tokens verified without any
+# storage lookup) or "opaque" (random, looked up by hash). Both are accepted.
+TOKEN_FORMAT = os.environ.get("TOKEN_FORMAT", "signed")
+
+# Signing keys as "kid:secret,kid:secret" (the first signs, all verify, so a
+# new key goes first and an old one is dropped once its tokens expired);
+# empty = one key generated into DATA_DIR/token_keys.json
+TOKEN_SIGNING_KEYS = os.environ.get("TOKEN_SIGNING_KEYS", "")
+
+# Size of the optional Bloom filter in front of the token revocation list (0 = off)
+TOKEN_REVOCATION_BLOOM_BITS = int(os.environ.get("TOKEN_REVOCATION_BLOOM_BITS", "0"))
+
+# HTTP/1.1 keep-alive: idle seconds before a connection is closed (keep it
+# above the reverse proxy's upstream idle timeout, 2 minutes in Caddy) and
+# requests served per connection
+KEEPALIVE_TIMEOUT = float(os.environ.get("KEEPALIVE_TIMEOUT", "130"))
+KEEPALIVE_MAX_REQUESTS = int(os.environ.get("KEEPALIVE_MAX_REQUESTS", "1000"))
+
+# Attach a Server-Timing header with per-phase timings to every response
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "1") not in ("0", "false", "off")
+
+# CLAUDE.md section shown on /briefing (heading path, e.g. "Current Focus");
+# empty = the first section with text
+BRIEFING_CONTEXT_SECTION = os.environ.get("BRIEFING_CONTEXT_SECTION", "")
+
+# Device accounts allowed to use /admin endpoints (default: every Gmail account)
+ADMIN_EMAILS = [e for e in os.environ.get("ADMIN_EMAILS", "").split(",") if e]
+
+# Tasks, notes and context are kept per user (the device's account). Accounts
+# listed as "alias=account,..." share the other account's data. A user's data
+# is dropped from memory after PARTITION_IDLE_SECONDS without requests.
+PARTITION_ALIASES = dict(pair.strip().split("=", 1) for pair in os.environ.get("PARTITION_ALIASES", "").split(",")
+                         if "=" in pair)
+PARTITION_IDLE_SECONDS = int(os.environ.get("PARTITION_IDLE_SECONDS", "900"))
+
 # Create data directory
 os.makedirs(DATA_DIR, exist_ok=True)
 
-TASKS_FILE = os.path.join(DATA_DIR, "tasks.json")
-NOTES_FILE = os.path.join(DATA_DIR, "notes.json")
 DEVICES_FILE = os.path.join(DATA_DIR, "devices.json")
-CONTEXT_FILE = os.path.join(DATA_DIR, "context.json")
+REVOKED_FILE = os.path.join(DATA_DIR, "revoked.json")
+TOKEN_KEYS_FILE = os.path.join(DATA_DIR, "token_keys.json")
+# Data of users other than the owner (the first Gmail account, whose data stays in DATA_DIR)
+USERS_DIR = os.path.join(DATA_DIR, "users")
+
+# Full-message cache for /emails/{account}/{id}: disk budget and label freshness
+MAIL_CACHE_DIR = os.path.join(DATA_DIR, "mail_cache")
+MAIL_CACHE_MB = int(os.environ.get("MAIL_CACHE_MB", "64"))
+MAIL_LABEL_TTL = int(os.environ.get("MAIL_LABEL_TTL", "60"))
+
+# Unread-mail digest for /emails/digest and /briefing: unread messages of the
+# last MAIL_DIGEST_HOURS (at most MAIL_DIGEST_MAX per account), checked for new
+# mail at most every MAIL_DIGEST_TTL seconds
+MAIL_DIGEST_MAX = int(os.environ.get("MAIL_DIGEST_MAX", "50"))
+MAIL_DIGEST_HOURS = int(os.environ.get("MAIL_DIGEST_HOURS", "24"))
+MAIL_DIGEST_TTL = int(os.environ.get("MAIL_DIGEST_TTL", "60"))
+
+# Context file versions kept readable via ?version= / ?since= after compaction
+CONTEXT_KEEP_VERSIONS = int(os.environ.get("CONTEXT_KEEP_VERSIONS", "50"))
+
+# =============================================================================
+# Metrics (Prometheus text exposition)
+# =============================================================================
+
+# Latency buckets in seconds, shared by all histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names, values, extra=""):
+    parts = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    """Monotonic counter, one value per combination of label values."""
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, k)} {v}" for k, v in items]
+
+class Gauge(Counter):
+    """Value that can go up and down (e.g. in-flight requests)."""
+    kind = "gauge"
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values, value):
+        with self._lock:
+            self._values[label_values] = value
+
+class Histogram:
+    """Fixed-bucket histogram. Buckets are stored non-cumulative and summed on render."""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, *label_values):
+        """Context manager that observes the duration of its block."""
+        return _HistogramTimer(self, label_values)
+
+    def render(self):
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+class _HistogramTimer:
+    __slots__ = ("histogram", "label_values", "start")
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+        return False
+
+HTTP_REQUESTS = Counter("cos_http_requests_total", "HTTP requests by method, route and status", ("method", "route", "status"))
+HTTP_REQUEST_SECONDS = Histogram("cos_http_request_duration_seconds", "HTTP request latency", ("method", "route"))
+HTTP_IN_FLIGHT = Gauge("cos_http_requests_in_flight", "HTTP requests currently being handled", ("method",))
+GOOGLE_API_CALLS = Counter("cos_google_api_calls_total", "Upstream Google API calls", ("account", "method"))
+GOOGLE_API_ERRORS = Counter("cos_google_api_errors_total", "Failed upstream Google API calls", ("account", "method"))
+GOOGLE_API_SECONDS = Histogram("cos_google_api_duration_seconds", "Upstream Google API call latency", ("account", "method"))
+GOOGLE_API_RETRIES = Counter("cos_google_api_retries_total", "Upstream Google API calls retried after 429/5xx/network errors", ("account", "method"))
+GOOGLE_API_COALESCED = Counter("cos_google_api_coalesced_total", "Google API calls answered by an identical in-flight call", ("account", "method"))
+GOOGLE_CIRCUIT_OPEN = Gauge("cos_google_circuit_open", "1 while an account's Google API circuit breaker is open", ("account",))
+AUTH_SECONDS = Histogram("cos_auth_lookup_duration_seconds", "Device token / API key lookup time", ("result",))
+PERSIST_SECONDS = Histogram("cos_persist_flush_duration_seconds", "Time to write a data file to disk", ("store",))
+JSON_SERIALIZE_SECONDS = Histogram("cos_json_serialize_duration_seconds", "Time spent in json.dumps for responses", ("route",))
+MAIL_CACHE_LOOKUPS = Counter("cos_mail_cache_lookups_total", "Full-message cache lookups by tier that answered", ("tier",))
+STARTUP_SECONDS = Gauge("cos_startup_phase_seconds", "Duration of each startup phase", ("phase",))
+PARTITIONS_LOADED = Gauge("cos_partitions_loaded", "User data partitions currently in memory")
+PARTITION_LOAD_SECONDS = Histogram("cos_partition_load_duration_seconds", "Time to load a user's data partition")
+MAIL_DIGEST_MESSAGES = Gauge("cos_mail_digest_messages", "Unique unread messages in the email digest")
+MAIL_DIGEST_FETCHED = Counter("cos_mail_digest_fetched_total", "Message metadata fetched into the email digest", ("account",))
+
+METRICS = [HTTP_REQUESTS, HTTP_REQUEST_SECONDS, HTTP_IN_FLIGHT,
+           GOOGLE_API_CALLS, GOOGLE_API_ERRORS, GOOGLE_API_SECONDS,
+           GOOGLE_API_RETRIES, GOOGLE_API_COALESCED, GOOGLE_CIRCUIT_OPEN,
+           AUTH_SECONDS, PERSIST_SECONDS, JSON_SERIALIZE_SECONDS, MAIL_CACHE_LOOKUPS,
+           STARTUP_SECONDS, PARTITIONS_LOADED, PARTITION_LOAD_SECONDS,
+           MAIL_DIGEST_MESSAGES, MAIL_DIGEST_FETCHED]
+
+def render_metrics():
+    """Render all registered metrics in Prometheus text format."""
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# =============================================================================
+# Startup Timing
+# =============================================================================
+
+def process_age():
+    """Seconds since this process was started (from /proc), or None where unavailable."""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return None
+
+class StartupTimer:
+    """Durations of the startup phases, printed once ready and exported as
+    cos_startup_phase_seconds. The first phase ("imports") covers interpreter
+    start and module imports up to this point, measured from the process start time."""
+
+    def __init__(self):
+        self.phases = {}
+        self._last = time.perf_counter()
+        age = process_age()
+        if age is not None:
+            self.record("imports", age)
+
+    def record(self, phase, seconds):
+        self.phases[phase] = seconds
+        STARTUP_SECONDS.set(phase, value=round(seconds, 6))
+
+    def mark(self, phase):
+        """Record the time since the previous mark as `phase`."""
+        now = time.perf_counter()
+        self.record(phase, now - self._last)
+        self._last = now
+
+    def summary(self):
+        parts = [f"{phase} {seconds * 1000:.0f}ms" for phase, seconds in self.phases.items()]
+        age = process_age()
+        if age is not None:
+            parts.append(f"ready {age * 1000:.0f}ms after process start")
+        return " | ".join(parts)
+
+startup = StartupTimer()
+
+# =============================================================================
+# Request Tracing (Server-Timing spans and sampled profiling)
+# =============================================================================
+
+_trace = threading.local()
+
+class span:
+    """Time a named phase of the current request for the Server-Timing header.
+
+    Usage: ``with span("google"): ...``. Spans with the same name are summed.
+    Outside of a request, or with SERVER_TIMING off, nothing is recorded.
+    """
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        spans = getattr(_trace, "spans", None)
+        if spans is not None:
+            spans.append((self.name, time.perf_counter() - self.start))
+        return False
+
+def begin_trace(start):
+    _trace.spans = [] if SERVER_TIMING else None
+    _trace.start = start
+
+def end_trace():
+    _trace.spans = None
+
+def server_timing_header():
+    """Format the spans recorded so far as a Server-Timing header value, or None."""
+    spans = getattr(_trace, "spans", None)
+    if spans is None:
+        return None
+    totals = {}
+    counts = {}
+    for name, duration in spans:
+        totals[name] = totals.get(name, 0.0) + duration
+        counts[name] = counts.get(name, 0) + 1
+    parts = []
+    for name, duration in totals.items():
+        if counts[name] > 1:
+            parts.append(f'{name};dur={duration * 1000:.2f};desc="{counts[name]}x"')
+        else:
+            parts.append(f"{name};dur={duration * 1000:.2f}")
+    parts.append(f"total;dur={(time.perf_counter() - _trace.start) * 1000:.2f}")
+    return ", ".join(parts)
+
+class RequestProfiler:
+    """Runs cProfile on a sample of the next N requests and aggregates the stats."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.remaining = 0
+        self.sample_rate = 1.0
+        self.profiled = 0
+        self.armed_at = None
+        self._stats = None
+
+    def arm(self, requests, sample_rate=1.0):
+        with self._lock:
+            self.remaining = max(0, requests)
+            self.sample_rate = min(1.0, max(0.0, sample_rate))
+            self.profiled = 0
+            self.armed_at = datetime.now().isoformat()
+            self._stats = None
+
+    def start(self):
+        """Return an enabled profiler if this request is sampled, else None."""
+        if self.remaining <= 0:
+            return None
+        with self._lock:
+            if self.remaining <= 0 or random.random() >= self.sample_rate:
+                return None
+            self.remaining -= 1
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active; give the sample back
+            with self._lock:
+                self.remaining += 1
+            return None
+        return profile
+
+    def finish(self, profile):
+        profile.disable()
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self.profiled += 1
+
+    def report(self, sort="cumulative", limit=40):
+        """Aggregated stats with the most expensive functions first."""
+        column = {"ncalls": 0, "tottime": 1, "cumulative": 2}.get(sort, 2)
+        with self._lock:
+            raw = dict(self._stats.stats) if self._stats else {}
+            report = {
+                "armed_at": self.armed_at,
+                "remaining": self.remaining,
+                "sample_rate": self.sample_rate,
+                "profiled_requests": self.profiled,
+                "total_time": round(self._stats.total_tt, 6) if self._stats else 0.0,
+            }
+        rows = [((nc, tt, ct), func, filename, line)
+                for (filename, line, func), (cc, nc, tt, ct, callers) in raw.items()]
+        rows.sort(key=lambda r: r[0][column], reverse=True)
+        report["functions"] = [{
+            "function": func,
+            "file": f"{filename}:{line}",
+            "ncalls": nc,
+            "tottime": round(tt, 6),
+            "cumtime": round(ct, 6),
+        } for (nc, tt, ct), func, filename, line in rows[:limit]]
+        return report
+
+profiler = RequestProfiler()
 
 # =============================================================================
 # Device Token Storage
 # =============================================================================
 
 devices_data = {"devices": []}
+_devices_lock = threading.RLock()
+
+def atomic_write(path, data):
+    """Write bytes to `path` via a temp file + rename so readers never see a partial file."""
+    tmp = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
 
 def load_devices():
-    global devices_data
-    if os.path.exists(DEVICES_FILE):
-        try:
-            with open(DEVICES_FILE, "r") as f:
-                devices_data = json.load(f)
-        except: pass
+    global devices_data, token_signer
+    data = read_json_file(DEVICES_FILE)
+    if isinstance(data, dict) and isinstance(data.get("devices"), list):
+        devices_data = data
+    elif data is not None:
+        quarantine(DEVICES_FILE, "no device list")
+    index_devices()
+    token_signer = TokenSigner(load_signing_keys(TOKEN_SIGNING_KEYS, TOKEN_KEYS_FILE),
+                               RevocationList(REVOKED_FILE, TOKEN_REVOCATION_BLOOM_BITS))
 
 def save_devices():
-    with open(DEVICES_FILE, "w") as f:
-        json.dump(devices_data, f, indent=2)
+    with _devices_lock, PERSIST_SECONDS.time("devices"):
+        atomic_write(DEVICES_FILE, json.dumps(devices_data, indent=2).encode())
 
 def generate_device_token():
     """Generate a secure random device token."""
@@ -72,75 +493,1945 @@ def hash_token(token):
     """Hash a token for storage (we only store hashes)."""
     return hashlib.sha256(token.encode()).hexdigest()
 
+DEVICE_TOKEN_DAYS = 90
+
+# last_used of opaque-token devices is saved at most this often (seconds)
+LAST_USED_RESOLUTION = 300
+
+# token_hash -> device (opaque tokens) and device id -> device (all)
+_devices_by_hash = {}
+_devices_by_id = {}
+
+def device_id(device):
+    """Stable id of a devices.json entry: its own for signed tokens, a token
+    hash prefix for opaque ones."""
+    return device.get("device_id") or device.get("token_hash", "")[:16]
+
+def index_devices():
+    global _devices_by_hash, _devices_by_id
+    devices = devices_data.get("devices", [])
+    _devices_by_hash = {d["token_hash"]: d for d in devices if d.get("token_hash")}
+    _devices_by_id = {device_id(d): d for d in devices}
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+def load_signing_keys(spec, path):
+    """kid -> key bytes from "kid:secret,..." (first one signs), else from the
+    key file at `path`, created with a random key on first use. The file is
+    shared by every process using the same DATA_DIR."""
+    keys = {}
+    for part in spec.split(","):
+        if part.strip():
+            kid, sep, secret = part.strip().partition(":")
+            if not (sep and kid and secret) or "." in kid:
+                raise ValueError("TOKEN_SIGNING_KEYS must look like kid:secret,kid:secret")
+            keys[kid] = secret.encode()
+    if keys:
+        return keys
+    if not os.path.exists(path):
+        tmp = f"{path}.tmp-{os.getpid()}"
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            json.dump({"k1": secrets.token_urlsafe(32)}, f)
+        try:
+            os.link(tmp, path)  # fails if another process created it first
+        except FileExistsError:
+            pass
+        os.unlink(tmp)
+    with open(path) as f:
+        return {kid: secret.encode() for kid, secret in json.load(f).items()}
+
+class BloomFilter:
+    """Fixed-size, in-process Bloom filter over strings. Positions come from
+    double hashing of the string's own hash(), which Python caches on the
+    object, so a lookup hashes nothing. (hash() is salted per process; the
+    filter is rebuilt in each.)"""
+
+    def __init__(self, bits, hashes=4):
+        self.bits = bits
+        self.hashes = hashes
+        self._array = bytearray((bits + 7) // 8)
+
+    def _positions(self, key):
+        h = hash(key)
+        h1, h2 = h & 0xFFFFFFFF, ((h >> 32) & 0xFFFFFFFF) | 1
+        bits = self.bits
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % bits
+
+    def add(self, key):
+        for p in self._positions(key):
+            self._array[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key):
+        # _positions() inlined: this runs on every authenticated request
+        h = hash(key)
+        h1, h2 = h & 0xFFFFFFFF, ((h >> 32) & 0xFFFFFFFF) | 1
+        array_, bits = self._array, self.bits
+        for i in range(self.hashes):
+            p = (h1 + i * h2) % bits
+            if not array_[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+class RevocationList:
+    """Device ids of revoked signed tokens, with their token's expiry.
+
+    Kept in one JSON file so every worker process sees the same list: each
+    re-reads it when its mtime changes, checked at most once per `recheck`
+    seconds, and writers take an flock. An entry is dropped once its token
+    would have expired anyway, so the list stays as small as the set of
+    revoked-but-unexpired tokens.
+
+    With `bloom_bits`, only a Bloom filter is kept in memory (about 10 bits
+    per revoked id instead of a dict entry). Ids it doesn't contain are not
+    revoked; the rare hits (revoked tokens and false positives) are confirmed
+    against the file once and the answer remembered until the next change.
+    """
+
+    def __init__(self, path, bloom_bits=0, recheck=1.0):
+        self.path = path
+        self.bloom_bits = bloom_bits
+        self.recheck = recheck
+        self._revoked = {}
+        self._bloom = None
+        self._confirmed = {}
+        self._count = 0
+        self._mtime = None
+        self._checked = float("-inf")
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def _read(self):
+        """The list on disk, or None if it can't be read."""
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            print(f"Could not read {self.path}: {e}")
+            return None
+
+    def _refresh(self, now):
+        self._checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        revoked = self._read()
+        if revoked is not None:
+            self._set(revoked)
+            self._mtime = mtime
+
+    def _set(self, revoked):
+        self._count = len(revoked)
+        self._confirmed = {}
+        if self.bloom_bits:
+            bloom = BloomFilter(self.bloom_bits)
+            for key in revoked:
+                bloom.add(key)
+            self._bloom, self._revoked = bloom, None
+        else:
+            self._revoked = revoked
+
+    def is_revoked(self, device_id, now):
+        if now - self._checked >= self.recheck:
+            self._refresh(now)
+        if self._bloom is None:
+            return device_id in self._revoked
+        if device_id not in self._bloom:
+            return False
+        answer = self._confirmed.get(device_id)
+        if answer is None:
+            answer = self._confirmed[device_id] = device_id in (self._read() or {})
+        return answer
+
+    def revoke(self, device_id, expires):
+        with self._lock, open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            revoked = self._read()
+            if revoked is None:
+                raise OSError(f"Revocation list {self.path} is unreadable")
+            now = time.time()
+            revoked = {key: exp for key, exp in revoked.items() if exp > now}
+            revoked[device_id] = expires
+            atomic_write(self.path, json.dumps(revoked).encode())
+            self._set(revoked)
+            self._mtime = os.stat(self.path).st_mtime_ns
+            self._checked = now
+
+class TokenSigner:
+    """Stateless device tokens: cos1.<kid>.<payload>.<signature>
+
+    payload is base64url of email, device id and expiry joined by newlines;
+    the signature is the first 128 bits of HMAC-SHA256 over everything
+    before it, with key `kid`.
+    Verifying needs only the keys and the revocation list, not devices.json.
+    Verified tokens are cached, so a repeat only costs a dict lookup plus
+    the expiry and revocation checks.
+    """
+
+    PREFIX = "cos1."
+
+    def __init__(self, keys, revocations, cache_size=4096):
+        self.keys = keys
+        self.active_kid = next(iter(keys))
+        self.revocations = revocations
+        self.cache_size = cache_size
+        self._cache = {}
+
+    def _signature(self, key, signing_input):
+        return hmac.digest(key, signing_input.encode(), "sha256")[:16]
+
+    def sign(self, email, device_id, expires):
+        payload = _b64encode(f"{email}\n{device_id}\n{int(expires)}".encode())
+        signing_input = f"{self.PREFIX}{self.active_kid}.{payload}"
+        return f"{signing_input}.{_b64encode(self._signature(self.keys[self.active_kid], signing_input))}"
+
+    def _decode(self, token):
+        try:
+            signing_input, _, signature = token.rpartition(".")
+            _, kid, payload = signing_input.split(".")
+            key = self.keys.get(kid)
+            if key is None or not hmac.compare_digest(_b64decode(signature), self._signature(key, signing_input)):
+                return None
+            email, device_id, expires = _b64decode(payload).decode().split("\n")
+            expires = int(expires)
+        except ValueError:
+            return None
+        return {"email": email, "device_id": device_id, "expires": expires,
+                "expires_at": datetime.fromtimestamp(expires).isoformat()}
+
+    def verify(self, token, now=None):
+        """The token's device {email, device_id, expires, expires_at}, or None."""
+        device = self._cache.get(token)
+        if device is None:
+            device = self._decode(token)
+            if device is None:
+                return None
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[token] = device
+        now = time.time() if now is None else now
+        if device["expires"] <= now or self.revocations.is_revoked(device["device_id"], now):
+            return None
+        return device
+
+token_signer = None
+
 def validate_device_token(token):
     """Check if a device token is valid. Returns device info or None."""
     if not token:
         return None
-    token_hash = hash_token(token)
-    for device in devices_data.get("devices", []):
-        if device.get("token_hash") == token_hash:
-            # Check expiry
-            expires_at = device.get("expires_at")
-            if expires_at and datetime.fromisoformat(expires_at) < datetime.now():
-                return None
-            # Update last used
-            device["last_used"] = datetime.now().isoformat()
+    if token.startswith(TokenSigner.PREFIX):
+        return token_signer.verify(token) if token_signer else None
+    device = _devices_by_hash.get(hash_token(token))
+    if device is None:
+        return None
+    now = datetime.now()
+    expires_at = device.get("expires_at")
+    if expires_at and datetime.fromisoformat(expires_at) < now:
+        return None
+    last_used = device.get("last_used")
+    if not last_used or (now - datetime.fromisoformat(last_used)).total_seconds() >= LAST_USED_RESOLUTION:
+        with _devices_lock:
+            device["last_used"] = now.isoformat()
             save_devices()
-            return device
-    return None
+    return device
 
 def create_device(email, device_name="Unknown Device"):
     """Create a new device token for an authenticated user."""
-    token = generate_device_token()
+    now = datetime.now()
+    expires = now + timedelta(days=DEVICE_TOKEN_DAYS)
     device = {
-        "token_hash": hash_token(token),
         "email": email,
         "device_name": device_name,
-        "created_at": datetime.now().isoformat(),
-        "expires_at": (datetime.now() + timedelta(days=90)).isoformat(),
-        "last_used": datetime.now().isoformat()
+        "created_at": now.isoformat(),
+        "expires_at": expires.isoformat(),
     }
-    devices_data["devices"].append(device)
-    save_devices()
-    return token  # Return the unhashed token to give to user
+    if TOKEN_FORMAT == "signed" and token_signer:
+        device["device_id"] = secrets.token_hex(8)
+        token = token_signer.sign(email, device["device_id"], expires.timestamp())
+    else:
+        token = generate_device_token()
+        device["token_hash"] = hash_token(token)
+        device["last_used"] = now.isoformat()
+    with _devices_lock:
+        devices_data["devices"].append(device)
+        index_devices()
+        save_devices()
+    return token  # Only the signed token or the hash of an opaque one is kept
+
+def revoke_device(id):
+    """Revoke a device by id. Returns its devices.json entry or None."""
+    with _devices_lock:
+        device = _devices_by_id.get(id)
+        if device is None:
+            return None
+        if device.get("device_id"):
+            token_signer.revocations.revoke(id, datetime.fromisoformat(device["expires_at"]).timestamp())
+        device["revoked_at"] = datetime.now().isoformat()
+        devices_data["devices"].remove(device)
+        index_devices()
+        save_devices()
+    return device
 
 # =============================================================================
-# Data Storage
+# Snapshot Files (fast restart)
 # =============================================================================
 
-tasks_data = {"tasks": [], "syncedAt": None}
-notes_data = {"notes": [], "syncedAt": None}
-context_data = {"files": {}, "syncedAt": None}
+class SnapshotCorrupt(Exception):
+    """A data file is truncated, fails its checksum or has an unknown format."""
+
+SNAPSHOT_MAGIC = b"COSSNAP\0"
+SNAPSHOT_VERSION = 1
+# magic, format version, record count, meta length, offset table position, CRC-32 of the rest
+SNAPSHOT_HEADER = struct.Struct("<8sIIIQI")
+SNAPSHOT_LENGTH = struct.Struct("<I")
+SNAPSHOT_CHECK_WINDOW = 4 << 20   # page-aligned
+
+def write_snapshot(path, meta, records):
+    """Write `records` (JSON bytes each) and a `meta` dict to `path` atomically.
+
+    Layout, little-endian:
+        header | meta JSON | (u32 length, record) per record | padding to 8 |
+        u64 position of each record's length prefix
+    The previous file is kept as `path`.prev for open_snapshot() to fall back on.
+    """
+    tmp = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    meta_bytes = json.dumps(meta).encode()
+    offsets = array("Q")
+    with open(tmp, "wb") as f:
+        f.write(bytes(SNAPSHOT_HEADER.size))
+        f.write(meta_bytes)
+        crc = zlib.crc32(meta_bytes)
+        position = SNAPSHOT_HEADER.size + len(meta_bytes)
+        pack = SNAPSHOT_LENGTH.pack
+        for record in records:
+            offsets.append(position)
+            prefix = pack(len(record))
+            f.write(prefix)
+            f.write(record)
+            crc = zlib.crc32(record, zlib.crc32(prefix, crc))
+            position += 4 + len(record)
+        padding = bytes(-position % 8)
+        if sys.byteorder == "big":
+            offsets.byteswap()
+        table = padding + offsets.tobytes()
+        f.write(table)
+        crc = zlib.crc32(table, crc)
+        f.seek(0)
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(offsets), len(meta_bytes),
+                                     position + len(padding), crc))
+    try:
+        os.replace(path, path + ".prev")
+    except FileNotFoundError:
+        pass
+    os.replace(tmp, path)
+
+class Snapshot:
+    """A snapshot file mapped read-only. Opening checks the header, size and
+    checksum; records are sliced out of the map on access and nothing is
+    decoded up front. Raises SnapshotCorrupt."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < SNAPSHOT_HEADER.size:
+                raise SnapshotCorrupt(f"{path}: truncated header")
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, meta_length, table, crc = SNAPSHOT_HEADER.unpack_from(self._map)
+        if magic != SNAPSHOT_MAGIC:
+            raise SnapshotCorrupt(f"{path}: not a snapshot file")
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotCorrupt(f"{path}: unsupported snapshot version {version}")
+        if table + 8 * count != len(self._map) or table % 8:
+            raise SnapshotCorrupt(f"{path}: truncated ({len(self._map)} bytes, header says {table + 8 * count})")
+        view = memoryview(self._map)
+        if self._checksum(view) != crc:
+            raise SnapshotCorrupt(f"{path}: checksum mismatch")
+        self.meta = json.loads(self._map[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + meta_length])
+        self._offsets = view[table:].cast("Q")
+        if sys.byteorder == "big":
+            self._offsets = array("Q", self._offsets.tobytes())
+            self._offsets.byteswap()
+
+    def _checksum(self, view):
+        """CRC-32 of everything after the header, in windows that are dropped from
+        memory once read: the check doesn't leave the whole file resident."""
+        crc, window = 0, SNAPSHOT_CHECK_WINDOW
+        for start in range(0, len(view), window):
+            crc = zlib.crc32(view[max(start, SNAPSHOT_HEADER.size):start + window], crc)
+            if hasattr(mmap, "MADV_DONTNEED"):
+                self._map.madvise(mmap.MADV_DONTNEED, start, min(window, len(view) - start))
+        return crc
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, i):
+        start = self._offsets[i] + 4
+        (length,) = SNAPSHOT_LENGTH.unpack_from(self._map, start - 4)
+        return self._map[start:start + length]
+
+    def __iter__(self):
+        return map(self.__getitem__, range(len(self._offsets)))
+
+def quarantine(path, error):
+    """Move an unreadable data file aside, keeping it for inspection."""
+    target = f"{path}.corrupt-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    os.replace(path, target)
+    print(f"ERROR: {path} is unreadable ({error}); moved to {target}")
+
+def open_snapshot(path):
+    """The Snapshot at `path`, else the one it replaced (`path`.prev), else None.
+    Corrupt files are quarantined rather than loaded or overwritten."""
+    for candidate in (path, path + ".prev"):
+        if not os.path.exists(candidate):
+            continue
+        try:
+            snapshot = Snapshot(candidate)
+        except (SnapshotCorrupt, ValueError) as e:
+            quarantine(candidate, e)
+            continue
+        if candidate != path:
+            print(f"WARNING: loaded the previous snapshot {candidate}")
+        return snapshot
+    return None
 
-def load_data():
-    global tasks_data, notes_data, context_data
-    if os.path.exists(TASKS_FILE):
+def read_json_file(path):
+    """A JSON data file's content, or None if it is missing or corrupt (then quarantined)."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except ValueError as e:
+        quarantine(path, e)
+        return None
+
+# =============================================================================
+# Task Store
+# =============================================================================
+
+def _task_time(value):
+    """A task timestamp as a float: 0.0 for unset/falsy. Non-numeric values
+    (and NaN) count as set but never reached (inf), so they keep a task closed/hidden."""
+    if not value:
+        return 0.0
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return float("inf")
+    return float("inf") if math.isnan(value) else value
+
+def _task_score(value):
+    """A task's score as a finite float; 0.0 if unset, non-numeric, NaN or infinite."""
+    try:
+        value = float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+    return value if math.isfinite(value) else 0.0
+
+def _task_key(task, row):
+    """A task's uuid, or its row for tasks without a usable (string) uuid."""
+    uuid = task.get("uuid")
+    return uuid if isinstance(uuid, str) and uuid else f"#{row}"
+
+class TaskColumns:
+    """One immutable snapshot of the task list.
+
+    Each task is kept as its pre-serialized JSON bytes (responses and the
+    tasks file are built by joining them), plus `open_rows`: the rows of
+    tasks not completed or dismissed, in sync order, as a typed array.
+    Ranking of today's tasks is TaskRanker's job.
+    """
+
+    def __init__(self, tasks, synced_at=None, records=None):
+        self.synced_at = synced_at
+        self.records = [json.dumps(t).encode() for t in tasks] if records is None else records
+        self.open_rows = array("q", [i for i, t in enumerate(tasks)
+                                     if not _task_time(t.get("completedAt")) and not _task_time(t.get("dismissedAt"))])
+        self._json = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def json_rows(self, rows=None, key=None):
+        """{"tasks": [...], "syncedAt": ...} as bytes; cached under `key` if given."""
+        if key is not None and key in self._json:
+            return self._json[key]
+        records = self.records if rows is None else map(self.records.__getitem__, rows)
+        body = b"".join([b'{"tasks": [', b", ".join(records),
+                         b'], "syncedAt": ', json.dumps(self.synced_at).encode(), b"}"])
+        if key is not None:
+            self._json[key] = body
+        return body
+
+# =============================================================================
+# Task Ranking (incremental)
+# =============================================================================
+
+def parse_weights(value, allowed=None):
+    """"score=1,deadline=10" -> {"score": 1.0, "deadline": 10.0}."""
+    weights = {}
+    for part in value.split(","):
+        if not part.strip():
+            continue
+        name, sep, weight = part.partition("=")
+        name = name.strip()
+        if not sep or (allowed is not None and name not in allowed):
+            raise ValueError(f"Bad weight {part.strip()!r} in {value!r}")
+        weights[name] = float(weight)
+    return weights
+
+class SortedKeys:
+    """A sorted list kept as sorted chunks of at most 2 * chunk items (the
+    layout of sortedcontainers.SortedList). add() and remove() bisect the
+    chunk maxima, then shift items within one chunk; iteration is in order."""
+
+    def __init__(self, keys=(), chunk=512):
+        keys = sorted(keys)
+        self.chunk = chunk
+        self._chunks = [keys[i:i + chunk] for i in range(0, len(keys), chunk)]
+        self._maxes = [c[-1] for c in self._chunks]
+        self._len = len(keys)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return chain.from_iterable(self._chunks)
+
+    def add(self, key):
+        if not self._chunks:
+            self._chunks.append([key])
+            self._maxes.append(key)
+        else:
+            i = bisect_left(self._maxes, key)
+            if i == len(self._maxes):
+                i -= 1
+                self._chunks[i].append(key)
+                self._maxes[i] = key
+            else:
+                insort(self._chunks[i], key)
+            chunk = self._chunks[i]
+            if len(chunk) > 2 * self.chunk:
+                self._chunks[i:i + 1] = [chunk[:self.chunk], chunk[self.chunk:]]
+                self._maxes[i:i + 1] = [chunk[self.chunk - 1], chunk[-1]]
+        self._len += 1
+
+    def remove(self, key):
+        i = bisect_left(self._maxes, key)
+        chunk = self._chunks[i]
+        del chunk[bisect_left(chunk, key)]
+        self._len -= 1
+        if not chunk:
+            del self._chunks[i]
+            del self._maxes[i]
+        else:
+            self._maxes[i] = chunk[-1]
+
+class RankEntry:
+    __slots__ = ("record", "base", "gate", "deadline", "first_seen", "key", "version")
+
+    def __init__(self, record, base, gate, deadline, first_seen):
+        self.record = record
+        self.base = base          # time-independent part of the rank
+        self.gate = gate          # max(startAt, hideUntil): in today's list from then on
+        self.deadline = deadline  # None if unset
+        self.first_seen = first_seen
+        self.key = None           # (-rank, uuid, self) while in today's list
+        self.version = 0          # bumped on every re-rank; older heap events are stale
+
+class TaskRanker:
+    """Today's open tasks ordered by a weighted rank, maintained incrementally.
+
+        rank = score * w.score + sum of tag weights
+             + w.deadline * step(deadline - now)   1 overdue, .75 <1d, .5 <3d, .25 <7d
+             + w.start    while the task started/unhid less than fresh_seconds ago
+             + w.age      * days since the task was first synced
+
+    The age term grows at the same rate for every task, so it never changes
+    the order: it is stored as -w.age * first seen time and added back for
+    display. First-seen times (when a sync first had the task open) are kept
+    here, not in the task records, and saved with the task snapshot.
+    Every other time-dependent term is a step function, so a task's rank only
+    changes at known instants (becoming visible, deadline steps, end of the
+    start bonus). Each task has its next such instant in one heap; a request
+    first applies the events up to `now` (re-ranking only those tasks), then
+    reads the first `limit` keys of a SortedKeys of active tasks. Per-request
+    cost is O(limit + events due), independent of the number of tasks.
+
+    update() diffs a new sync against the current entries by uuid and record
+    bytes and re-ranks only what changed. Big changes (over a quarter of the
+    tasks, e.g. the first load) and a heap grown stale start a new epoch:
+    everything is re-ranked and the order built with one sort.
+    """
+
+    DEADLINE_STEPS = ((0, 1.0), (86400, 0.75), (3 * 86400, 0.5), (7 * 86400, 0.25))
+
+    def __init__(self, weights="", tag_weights="", fresh_seconds=86400):
+        self.weights = {"score": 1.0, "deadline": 0.0, "start": 0.0, "age": 0.0}
+        self.weights.update(parse_weights(weights, self.weights))
+        self.tag_weights = parse_weights(tag_weights)
+        self.fresh_seconds = fresh_seconds
+        self.epoch = 0
+        self._entries = {}
+        self._first_seen = {}           # uuid -> epoch seconds, open tasks only
+        self._order = SortedKeys()
+        self._events = []
+        self._clock = 0.0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _entry(self, task, record, first_seen):
+        w = self.weights
+        base = w["score"] * _task_score(task.get("score"))
+        if self.tag_weights:
+            tags = task.get("tags")
+            tags = [tag for tag in tags if isinstance(tag, str)] if isinstance(tags, list) else []
+            tags += [flag for flag in ("important", "urgent") if task.get(flag)]
+            base += sum(self.tag_weights.get(tag, 0.0) for tag in tags)
+        base -= w["age"] * first_seen / 86400
+        deadline = _task_time(task.get("deadline"))
+        return RankEntry(record, base,
+                         max(_task_time(task.get("startAt")), _task_time(task.get("hideUntil"))),
+                         deadline if 0 < deadline < float("inf") else None, first_seen)
+
+    def _evaluate(self, entry, now):
+        """(rank or None if not visible yet, time of the next rank change or None)."""
+        if entry.gate > now:
+            return None, entry.gate
+        rank, changes = entry.base, []
+        if entry.gate and now < entry.gate + self.fresh_seconds:
+            rank += self.weights["start"]
+            changes.append(entry.gate + self.fresh_seconds)
+        if entry.deadline is not None:
+            remaining = entry.deadline - now
+            for threshold, factor in self.DEADLINE_STEPS:
+                if remaining <= threshold:
+                    rank += self.weights["deadline"] * factor
+                    break
+                changes.append(entry.deadline - threshold)
+        return rank, (min(changes) if changes else None)
+
+    def _place(self, uuid, entry, now):
+        """(Re-)rank one entry at `now`: update its key and schedule its next change."""
+        if entry.key is not None:
+            self._order.remove(entry.key)
+            entry.key = None
+        rank, change = self._evaluate(entry, now)
+        if rank is not None:
+            entry.key = (-rank, uuid, entry)
+            self._order.add(entry.key)
+        entry.version += 1
+        if change is not None:
+            heapq.heappush(self._events, (change, entry.version, uuid))
+
+    def _advance(self, now):
+        self._clock = now = max(now, self._clock)
+        events, entries = self._events, self._entries
+        while events and events[0][0] <= now:
+            _, version, uuid = heapq.heappop(events)
+            entry = entries.get(uuid)
+            if entry is not None and entry.version == version:
+                self._place(uuid, entry, now)
+        return now
+
+    def _rebuild(self, entries, now):
+        """New epoch: rank all entries and build the order and heap from scratch."""
+        keys, events = [], []
+        for uuid, entry in entries.items():
+            rank, change = self._evaluate(entry, now)
+            entry.key = None if rank is None else (-rank, uuid, entry)
+            entry.version += 1
+            if entry.key is not None:
+                keys.append(entry.key)
+            if change is not None:
+                events.append((change, entry.version, uuid))
+        heapq.heapify(events)
+        self._entries, self._order, self._events = entries, SortedKeys(keys), events
+        self._clock = now
+        self.epoch += 1
+
+    def update(self, tasks, columns, now, first_seen=None):
+        """Take a new sync: the task dicts and their TaskColumns snapshot.
+        `first_seen` ({uuid: epoch seconds}) restores saved first-seen times."""
+        records = columns.records
+        with self._lock:
+            now = max(now, self._clock)
+            old = self._entries
+            known = self._first_seen if first_seen is None else first_seen
+            entries, changed, seen = {}, [], {}
+            for i in columns.open_rows:
+                task = tasks[i]
+                uuid = _task_key(task, i)
+                seen[uuid] = known.get(uuid) or int(now)
+                entry = old.get(uuid)
+                if entry is None or entry.record != records[i] or entry.first_seen != seen[uuid]:
+                    entry = self._entry(task, records[i], seen[uuid])
+                    changed.append((uuid, old.get(uuid), entry))
+                entries[uuid] = entry
+            self._first_seen = seen
+            removed = [entry for uuid, entry in old.items() if uuid not in entries]
+
+            if (len(changed) + len(removed)) * 4 > len(entries) or len(self._events) > 2 * len(entries) + 1024:
+                self._rebuild(entries, now)
+                return
+            for entry in removed:
+                if entry.key is not None:
+                    self._order.remove(entry.key)
+            for uuid, previous, entry in changed:
+                if previous is not None and previous.key is not None:
+                    self._order.remove(previous.key)
+                self._place(uuid, entry, now)
+            self._entries = entries
+
+    def advance(self, now):
+        """Apply the rank changes due up to `now`."""
+        with self._lock:
+            self._advance(now)
+
+    def first_seen(self):
+        """{uuid: epoch seconds} of the open tasks, for saving with the snapshot."""
+        with self._lock:
+            return dict(self._first_seen)
+
+    def top(self, now, limit=None):
+        """[(record, rank)] of today's tasks at `now`, best first."""
+        with self._lock:
+            now = self._advance(now)
+            age_shift = self.weights["age"] * now / 86400
+            return [(entry.record, age_shift - negative_rank)
+                    for negative_rank, _, entry in islice(self._order, limit)]
+
+    def count(self, now):
+        """Number of today's tasks at `now`."""
+        with self._lock:
+            self._advance(now)
+            return len(self._order)
+
+def _ranked_record(record, rank):
+    """A task's JSON record with "rank" spliced in."""
+    if record == b"{}":
+        return b'{"rank": %r}' % round(rank, 2)
+    return b'{"rank": %r, %s' % (round(rank, 2), record[1:])
+
+class TaskStore:
+    """Holds the current TaskColumns and the TaskRanker. Readers take
+    `store.columns` once per request; replace() swaps in a new snapshot and
+    updates the ranking."""
+
+    def __init__(self, ranker=None):
+        self.columns = TaskColumns([])
+        self.ranker = ranker if ranker is not None else TaskRanker()
+
+    def __len__(self):
+        return len(self.columns)
+
+    def replace(self, tasks, synced_at, now=None, records=None, first_seen=None):
+        """Swap in a new task list. `records` are the tasks' JSON bytes if already
+        encoded, `first_seen` the ranker's saved first-seen times (loading a snapshot)."""
+        now = time.time() if now is None else now
+        columns = TaskColumns(tasks, synced_at, records)
+        self.ranker.update(tasks, columns, now, first_seen)
+        self.columns = columns
+
+    def today(self, now, limit=None):
+        """Today's tasks at `now` as dicts with their rank, best first."""
+        return [dict(json.loads(record), rank=round(rank, 2)) for record, rank in self.ranker.top(now, limit)]
+
+    def today_json(self, now, limit=None):
+        """{"tasks": [...], "total": n, "syncedAt": ...} as bytes, tasks with their rank."""
+        with span("filter"):
+            ranked = self.ranker.top(now, limit)
+            total = self.ranker.count(now) if limit is not None else len(ranked)
+        with span("json"):
+            return b"".join([b'{"tasks": [', b", ".join([_ranked_record(r, rank) for r, rank in ranked]),
+                             b'], "total": ', str(total).encode(),
+                             b', "syncedAt": ', json.dumps(self.columns.synced_at).encode(), b"}"])
+
+    def load(self, path):
+        """Load the snapshot at `path`; False if there is none."""
+        snapshot = open_snapshot(path)
+        if snapshot is None:
+            return False
+        records = list(snapshot)
+        tasks = []
+        for start in range(0, len(records), 10000):
+            # One json.loads per chunk of records: much less per-call overhead than one per task
+            tasks += json.loads(b"[" + b",".join(records[start:start + 10000]) + b"]")
+        first_seen = snapshot.meta.get("firstSeen")
+        if first_seen is None:
+            # Older snapshots kept the first-seen time in the records as "firstSeenAt"
+            first_seen = {}
+            for i, task in enumerate(tasks):
+                if "firstSeenAt" in task:
+                    first_seen[_task_key(task, i)] = _task_score(task.pop("firstSeenAt"))
+                    records = None
+        self.replace(tasks, snapshot.meta.get("syncedAt"), records=records, first_seen=first_seen)
+        return True
+
+    def save(self, path):
+        columns = self.columns
+        with PERSIST_SECONDS.time("tasks"):
+            write_snapshot(path, {"syncedAt": columns.synced_at, "firstSeen": self.ranker.first_seen()},
+                           columns.records)
+
+# =============================================================================
+# Data Storage
+# =============================================================================
+
+def _note_time(value):
+    """A note's updated time as epoch milliseconds (numbers as given, ISO 8601
+    strings parsed), or None if unset or unreadable."""
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
         try:
-            with open(TASKS_FILE, "r") as f:
-                tasks_data = json.load(f)
-        except: pass
-    if os.path.exists(NOTES_FILE):
+            return float(value)
+        except ValueError:
+            pass
         try:
-            with open(NOTES_FILE, "r") as f:
-                notes_data = json.load(f)
-        except: pass
-    if os.path.exists(CONTEXT_FILE):
+            return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() * 1000
+        except ValueError:
+            return None
+    return None
+
+def note_columns(notes):
+    """The indexed fields of `notes` as columns: {"type", "tags", "updated"}, one entry per note."""
+    types, tags, updated = [], [], []
+    for note in notes:
+        kind = note.get("type")
+        types.append(kind if isinstance(kind, str) else None)
+        note_tags = note.get("tags")
+        tags.append([tag for tag in note_tags if isinstance(tag, str)] if isinstance(note_tags, list) else [])
+        updated.append(_note_time(note.get("updated")))
+    return {"type": types, "tags": tags, "updated": updated}
+
+class NoteColumns:
+    """One immutable version of the notes.
+
+    Notes are kept as JSON records. After a restart they are slices of the
+    snapshot's map, and a note is decoded the first time something needs
+    more than its record. The fields queries filter on (type, tags,
+    updated) are kept as columns and saved in the snapshot's meta, so the
+    secondary indexes over them are rebuilt without decoding a note:
+    `by_type` and `by_tag` map a value to its rows in sync order, and
+    `updated_keys`/`updated_rows` are the dated rows sorted by time.
+    """
+
+    def __init__(self, records, synced_at, columns, decoded=None):
+        self.records = records
+        self.synced_at = synced_at
+        self.columns = columns
+        self._decoded = decoded if decoded is not None else [None] * len(records)
+        self.by_type = {}
+        self.by_tag = {}
+        for row, kind in enumerate(columns["type"]):
+            self.by_type.setdefault(kind, []).append(row)
+        for row, tags in enumerate(columns["tags"]):
+            for tag in tags:
+                self.by_tag.setdefault(tag, []).append(row)
+        dated = sorted((t, row) for row, t in enumerate(columns["updated"]) if t is not None)
+        self.updated_keys = [t for t, _ in dated]
+        self.updated_rows = [row for _, row in dated]
+        self._json = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def note(self, row):
+        note = self._decoded[row]
+        if note is None:
+            note = self._decoded[row] = json.loads(self.records[row])
+        return note
+
+    def notes(self, rows=None):
+        return [self.note(row) for row in (range(len(self.records)) if rows is None else rows)]
+
+    def query(self, kind=None, tags=(), updated_since=None):
+        """Rows matching every given filter, in sync order. Starts from the
+        smallest index list and checks the other filters on the columns, so
+        the cost follows the matches, not the number of notes."""
+        if kind is None and not tags and updated_since is None:
+            return range(len(self.records))
+        candidates = []
+        if kind is not None:
+            candidates.append(self.by_type.get(kind, []))
+        candidates += [self.by_tag.get(tag, []) for tag in tags]
+        if updated_since is not None:
+            first = bisect_left(self.updated_keys, updated_since)
+            if not candidates or len(self.updated_keys) - first < min(map(len, candidates)):
+                candidates = [sorted(self.updated_rows[first:])]
+        rows = min(candidates, key=len)
+        types, tag_lists, updated = self.columns["type"], self.columns["tags"], self.columns["updated"]
+        return [row for row in rows
+                if (kind is None or types[row] == kind)
+                and all(tag in tag_lists[row] for tag in tags)
+                and (updated_since is None or (updated[row] is not None and updated[row] >= updated_since))]
+
+    def json_rows(self, rows=None, key=None, fields=None):
+        """{"notes": [...], "syncedAt": ...} as bytes, cached under `key` if given.
+        Without `fields` the records are joined undecoded; with it each note
+        is reduced to those fields."""
+        if key is not None and key in self._json:
+            return self._json[key]
+        if fields is None:
+            items = self.records if rows is None else map(self.records.__getitem__, rows)
+        else:
+            items = [json.dumps({f: note[f] for f in fields if f in note}).encode() for note in self.notes(rows)]
+        body = b"".join([b'{"notes": [', b", ".join(items),
+                         b'], "syncedAt": ', json.dumps(self.synced_at).encode(), b"}"])
+        if key is not None:
+            self._json[key] = body
+        return body
+
+class NoteStore:
+    """Holds the current NoteColumns; readers take `store.columns` once per request."""
+
+    def __init__(self):
+        self.columns = NoteColumns([], None, note_columns([]))
+
+    def __len__(self):
+        return len(self.columns)
+
+    def replace(self, notes, synced_at):
+        notes = list(notes)
+        self.columns = NoteColumns([json.dumps(n).encode() for n in notes], synced_at, note_columns(notes), notes)
+
+    def load(self, path):
+        """Map the snapshot at `path` without decoding the notes; False if there is none."""
+        snapshot = open_snapshot(path)
+        if snapshot is None:
+            return False
+        columns = snapshot.meta.get("columns")
+        if not columns or len(columns.get("type", ())) != len(snapshot):
+            columns = note_columns(json.loads(record) for record in snapshot)  # written before the indexes
+        self.columns = NoteColumns(snapshot, snapshot.meta.get("syncedAt"), columns)
+        return True
+
+    def save(self, path):
+        columns = self.columns
+        with PERSIST_SECONDS.time("notes"):
+            write_snapshot(path, {"syncedAt": columns.synced_at, "columns": columns.columns}, columns.records)
+
+def migrate_legacy(store, legacy_file, path, key):
+    """Import a pre-snapshot JSON data file into `store`, write its snapshot and
+    keep the JSON as <file>.migrated."""
+    data = read_json_file(legacy_file)
+    if data is None:
+        return
+    if not isinstance(data, dict) or not isinstance(data.get(key, []), list):
+        quarantine(legacy_file, f"no {key} list")
+        return
+    # Entries that aren't objects were stored as sent before syncs were checked
+    store.replace([item for item in data.get(key, []) if isinstance(item, dict)], data.get("syncedAt"))
+    store.save(path)
+    os.replace(legacy_file, legacy_file + ".migrated")
+    print(f"Migrated {len(store)} {key} to {path}")
+
+def load_data():
+    """Shared data loaded at startup; user partitions load on first use."""
+    message_cache.load()
+
+def get_today_tasks(task_store, now, limit=None):
+    """Open tasks that are startable and not hidden at `now`, best ranked first."""
+    with span("filter"):
+        return task_store.today(now, limit)
+
+# =============================================================================
+# Context Storage (content-addressed snapshots + per-file edit journal)
+# =============================================================================
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def common_prefix_length(a, b):
+    """Length of the common prefix of two strings (binary search over slice compares)."""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def make_edit(old, new):
+    """Smallest single splice [start, end, text] turning `old` into `new`."""
+    start = common_prefix_length(old, new)
+    limit = min(len(old), len(new)) - start
+    tail = common_prefix_length(old[::-1][:limit], new[::-1][:limit])
+    return [start, len(old) - tail, new[start:len(new) - tail]]
+
+def apply_edit(content, edit):
+    start, end, text = edit
+    return content[:start] + text + content[end:]
+
+class VersionConflict(Exception):
+    """If-Match precondition failed; `version` is the current version (None if missing)."""
+    def __init__(self, version):
+        super().__init__(version)
+        self.version = version
+
+class VersionGone(Exception):
+    """The requested version was compacted away; `oldest` is the oldest still readable."""
+    def __init__(self, oldest):
+        super().__init__(oldest)
+        self.oldest = oldest
+
+def parse_etag(value):
+    """An If-Match / If-None-Match header as a version (int), a slice tag
+    ("s-<hash>"), "*" or None if absent. Raises ValueError for anything else."""
+    if value is None:
+        return None
+    value = value.strip()
+    if value == "*":
+        return value
+    if value.startswith("W/"):
+        value = value[2:]
+    value = value.strip('"')
+    if value.startswith("s-"):
+        return value
+    return int(value)
+
+HEADING_RE = re.compile(r"(#{1,6})[ \t]+(.+?)(?:[ \t]+#+)?[ \t]*$")
+
+class HeadingIndex:
+    """Markdown heading outline of one file version.
+
+    Each section runs from its heading line up to the next heading of the same
+    or a higher level, so it includes its subsections. Sections are stored as
+    line numbers and turned into char or byte offsets through the per-line
+    start tables. Headings inside fenced code blocks are ignored.
+    """
+
+    def __init__(self, content):
+        self.line_starts = [0]      # char offset of each line, plus len(content)
+        self.byte_starts = [0]      # same in UTF-8 bytes
+        self.sections = []          # [{"title", "level", "path", "line", "endLine"}]
+        stack = []
+        fence = None
+        lines = content.splitlines(keepends=True)
+        for number, line in enumerate(lines, 1):
+            stripped = line.strip()
+            if stripped.startswith(("```", "~~~")):
+                if fence is None:
+                    fence = stripped[:3]
+                elif stripped.startswith(fence):
+                    fence = None
+            elif fence is None:
+                m = HEADING_RE.match(line.rstrip("\r\n"))
+                if m:
+                    level = len(m.group(1))
+                    while stack and stack[-1]["level"] >= level:
+                        stack.pop()["endLine"] = number - 1
+                    section = {"title": m.group(2), "level": level,
+                               "path": [s["title"] for s in stack] + [m.group(2)],
+                               "line": number, "endLine": len(lines)}
+                    stack.append(section)
+                    self.sections.append(section)
+            self.line_starts.append(self.line_starts[-1] + len(line))
+            self.byte_starts.append(self.byte_starts[-1] + len(line.encode("utf-8")))
+
+    @property
+    def line_count(self):
+        return len(self.line_starts) - 1
+
+    def find(self, path):
+        """First section whose heading path ends with `path` ("Projects/Alpha"), case-insensitive."""
+        wanted = [part.strip().lower() for part in path.strip("/").split("/")]
+        for section in self.sections:
+            titles = [title.lower() for title in section["path"]]
+            if titles[-len(wanted):] == wanted:
+                return section
+        return None
+
+    def section_span(self, section, body_only=False):
+        """(start, end) char offsets of a section, optionally without its heading line."""
+        first = section["line"] if body_only else section["line"] - 1
+        return self.line_starts[first], self.line_starts[section["endLine"]]
+
+    def line_span(self, first, last=None):
+        """(start, end) char offsets of lines first..last (1-based, inclusive)."""
+        last = self.line_count if last is None else min(last, self.line_count)
+        if first < 1 or first > last + 1:
+            raise ValueError(f"lines {first}-{last} out of range (1-{self.line_count})")
+        return self.line_starts[first - 1], self.line_starts[last]
+
+    def own_span(self, section):
+        """Like section_span() but stopping at the next heading of any level."""
+        position = self.sections.index(section)
+        following = self.sections[position + 1:position + 2]
+        end_line = following[0]["line"] - 1 if following else section["endLine"]
+        return self.line_starts[section["line"] - 1], self.line_starts[end_line]
+
+    def describe(self, section):
+        return {"path": "/".join(section["path"]), "level": section["level"],
+                "lines": [section["line"], section["endLine"]],
+                "bytes": [self.byte_starts[section["line"] - 1], self.byte_starts[section["endLine"]] - 1]}
+
+def slice_etag(text):
+    """ETag of a partial read: content hash, so it survives edits elsewhere in the file."""
+    return f'"s-{content_hash(text.encode("utf-8"))[:16]}"'
+
+class ContextFile:
+    """One memory file: a snapshot at `base_version` plus the journal entries after it."""
+
+    def __init__(self, name, base):
+        self.name = name
+        self.base_version = base.get("version", 1)
+        self.base_hash = base["hash"]
+        self.base_at = base.get("updatedAt")
+        self.entries = []           # [{"v", "at", "edit"|"hash"}], oldest first
+        self.journal_bytes = 0
+        self._content = None        # current content, set by the store
+        self._loader = None         # reads the content on first use (see load_lazily)
+        self._index = None          # (content, its HeadingIndex), built on first use
+        self._load_lock = threading.Lock()
+        self._json = None           # (version, JSON-encoded content)
+
+    def set_content(self, content):
+        with self._load_lock:
+            self._content, self._loader = content, None
+
+    def load_lazily(self, loader):
+        """Defer reading the content to its first use, so startup skips files no one asks for."""
+        with self._load_lock:
+            self._content, self._loader = None, loader
+
+    @property
+    def content(self):
+        if self._content is None and self._loader is not None:
+            with self._load_lock:
+                if self._loader is not None:
+                    self._content, self._loader = self._loader(), None
+        return self._content
+
+    @property
+    def index(self):
+        """HeadingIndex of the current content."""
+        content, cached = self.content, self._index
+        if cached is None or cached[0] is not content:
+            cached = self._index = (content, HeadingIndex(content))
+        return cached[1]
+
+    @property
+    def version(self):
+        return self.entries[-1]["v"] if self.entries else self.base_version
+
+    @property
+    def updated_at(self):
+        return self.entries[-1]["at"] if self.entries else self.base_at
+
+    def info(self):
+        return {"version": self.version, "updatedAt": self.updated_at}
+
+class ContextStore:
+    """Memory scaffold files with a versioned, append-only edit journal.
+
+    Layout under `directory`:
+        manifest.json        {"files": {name: {"hash", "version", "updatedAt"}}, "version", "syncedAt"}
+        objects/<sha256>     raw UTF-8 snapshots
+        journal/<name>.log   one JSON line per edit after the manifest snapshot:
+                             {"v", "at", "edit": [start, end, text]} or {"v", "at", "hash"}
+
+    Versions come from one store-wide counter, so they are never reused even
+    when a file is deleted and recreated. An edit appends a single splice to the
+    file's journal, so its disk cost is O(edit size). Edits that rewrite most of
+    the file are stored as a snapshot object instead. A background thread
+    compacts long journals. It folds all but the last `keep_versions` entries
+    into a new snapshot, which bounds both journal size and startup replay.
+    """
+
+    def __init__(self, directory, legacy_file=None, keep_versions=50, compact_interval=60):
+        self.directory = directory
+        self.objects_dir = os.path.join(directory, "objects")
+        self.journal_dir = os.path.join(directory, "journal")
+        self.manifest_file = os.path.join(directory, "manifest.json")
+        self.legacy_file = legacy_file
+        self.keep_versions = keep_versions
+        self.compact_interval = compact_interval
+        self.files = {}
+        self.version = 0
+        self.synced_at = None
+        self._lock = threading.Lock()
+        self._compact_wakeup = threading.Event()
+        self._closed = False
+
+    # --- loading -----------------------------------------------------------
+
+    def load(self):
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.journal_dir, exist_ok=True)
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, "r") as f:
+                manifest = json.load(f)
+            self.synced_at = manifest.get("syncedAt")
+            self.version = manifest.get("version", 0)
+            for name, base in manifest.get("files", {}).items():
+                self.files[name] = self._replay(ContextFile(name, base))
+            self._collect_garbage()
+        elif self.legacy_file and os.path.exists(self.legacy_file):
+            self._migrate_legacy()
+        threading.Thread(target=self._compact_loop, name="context-compactor", daemon=True).start()
+
+    def _replay(self, cf):
+        self.version = max(self.version, cf.base_version)
+        path = self._journal_path(cf.name)
+        if not os.path.exists(path) or not os.path.getsize(path):
+            base_hash = cf.base_hash
+            cf.load_lazily(lambda: self._read_object(base_hash))
+            return cf
+        content = self._read_object(cf.base_hash)
+        with open(path, "rb") as f:
+            data = f.read()
+        if not data.endswith(b"\n") and data:
+            # A torn final append: cut it off so the next append starts on a fresh line.
+            data = data[:data.rfind(b"\n") + 1]
+            with open(path, "r+b") as f:
+                f.truncate(len(data))
+            print(f"Context journal {path}: dropped incomplete last entry")
+        lines = data.splitlines()
+        for number, line in enumerate(lines, 1):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                print(f"Context journal {path}: skipping unreadable line {number}/{len(lines)}")
+                continue
+            cf.journal_bytes += len(line) + 1
+            if entry["v"] <= cf.version:
+                continue  # already folded into the snapshot by an interrupted compaction
+            content = self._apply(content, entry)
+            cf.entries.append(entry)
+            self.version = max(self.version, entry["v"])
+            if not self.synced_at or entry["at"] > self.synced_at:
+                self.synced_at = entry["at"]
+        cf.set_content(content)
+        return cf
+
+    def _migrate_legacy(self):
+        """Import a pre-manifest context.json, keeping it as context.json.migrated."""
+        with open(self.legacy_file, "r") as f:
+            legacy = json.load(f)
+        self.replace_all(legacy.get("files", {}), legacy.get("syncedAt"))
+        os.replace(self.legacy_file, self.legacy_file + ".migrated")
+        print(f"Migrated {len(self.files)} context files to {self.directory}")
+
+    # --- reads -------------------------------------------------------------
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def names(self):
+        return list(self.files.keys())
+
+    def info(self, name):
+        """{"version", "updatedAt"} for `name`, or None."""
+        cf = self.files.get(name)
+        return cf.info() if cf else None
+
+    def get(self, name, default=None):
+        cf = self.files.get(name)
+        return cf.content if cf else default
+
+    def get_json(self, name):
+        """The current content as an encoded JSON string, cached per version."""
+        cf = self.files[name]
+        cached = cf._json
+        if cached is None or cached[0] != cf.version:
+            cached = cf._json = (cf.version, json.dumps(cf.content).encode())
+        return cached[1]
+
+    def as_dict(self):
+        """All files in the legacy {"files": {...}, "syncedAt": ...} shape."""
+        return {"files": {name: cf.content for name, cf in self.files.items()}, "syncedAt": self.synced_at}
+
+    def read(self, name, version):
+        """Content of `name` as of `version`. Raises KeyError if the file never had
+        that version, VersionGone if it has been compacted away."""
+        with self._lock:
+            cf = self.files[name]
+            if version == cf.version:
+                return cf.content
+            if version < cf.base_version:
+                raise VersionGone(cf.base_version)
+            content = self._read_object(cf.base_hash)
+            if version == cf.base_version:
+                return content
+            for entry in cf.entries:
+                content = self._apply(content, entry)
+                if entry["v"] == version:
+                    return content
+            raise KeyError(version)
+
+    def view(self, name, version=None):
+        """(version, content, HeadingIndex) of `name`, current unless `version` is given.
+        Raises like read()."""
+        with self._lock:
+            cf = self.files[name]
+            if version is None or version == cf.version:
+                return cf.version, cf.content, cf.index
+        content = self.read(name, version)
+        return version, content, HeadingIndex(content)
+
+    def changes_since(self, name, version):
+        """Journal entries of `name` newer than `version` as [{"version", "updatedAt", "edit"}],
+        or None when they can't be expressed as edits (compacted or snapshot entries)."""
+        with self._lock:
+            cf = self.files[name]
+            if version < cf.base_version:
+                return None
+            newer = [e for e in cf.entries if e["v"] > version]
+            if any("edit" not in e for e in newer):
+                return None
+            return [{"version": e["v"], "updatedAt": e["at"], "edit": e["edit"]} for e in newer]
+
+    def open_snapshot(self, name):
+        """Binary file of the current content if it is a stored snapshot, else None.
+        The handle stays valid even if compaction garbage-collects the object."""
+        with self._lock:
+            cf = self.files.get(name)
+            if cf is None or (cf.entries and "hash" not in cf.entries[-1]):
+                return None
+            digest = cf.entries[-1]["hash"] if cf.entries else cf.base_hash
+            return open(os.path.join(self.objects_dir, digest), "rb")
+
+    # --- writes ------------------------------------------------------------
+
+    def put(self, name, content, updated_at=None, expected=None):
+        """Store a new version of one file and return its info().
+
+        `expected` is the If-Match precondition: a version number, "*" (file
+        must exist) or None (no check). Raises VersionConflict on mismatch.
+        """
+        updated_at = updated_at or datetime.now().timestamp() * 1000
+        with self._lock, PERSIST_SECONDS.time("context"):
+            cf = self.files.get(name)
+            if expected is not None and (cf is None or expected not in ("*", cf.version)):
+                raise VersionConflict(cf.version if cf else None)
+            if cf is None:
+                self._create(name, content, updated_at)
+                self._write_manifest()
+            elif content != cf.content:
+                self._append(cf, content, updated_at)
+            self.synced_at = updated_at
+            return self.files[name].info()
+
+    def patch_section(self, name, path, text, append=False, updated_at=None, expected=None):
+        """Replace (or append to) the body of one section, keeping its heading.
+
+        `expected` is an If-Match precondition on either the file version or
+        the section's slice_etag(). Raises KeyError if the file or section
+        doesn't exist, VersionConflict on mismatch. Returns the file's info()
+        plus the new section "etag".
+        """
+        updated_at = updated_at or datetime.now().timestamp() * 1000
+        with self._lock, PERSIST_SECONDS.time("context"):
+            cf = self.files[name]
+            section = cf.index.find(path)
+            if section is None:
+                raise KeyError(path)
+            content = cf.content
+            start, end = cf.index.section_span(section)
+            if expected is not None and expected != "*" and expected not in (
+                    cf.version, slice_etag(content[start:end]).strip('"')):
+                raise VersionConflict(cf.version)
+            body_start = cf.index.section_span(section, body_only=True)[0]
+            lead = "\n" if body_start == len(content) and not content.endswith("\n") else ""
+            if append:
+                body = content[body_start:end]
+                kept = body.rstrip("\n")
+                text = (kept + "\n" if kept else "") + text.rstrip("\n") + (body[len(kept):] or "\n")
+            elif text and not text.endswith("\n") and end < len(content):
+                text += "\n"
+            updated = content[:body_start] + lead + text + content[end:]
+            if updated != content:
+                self._append(cf, updated, updated_at)
+                self.synced_at = updated_at
+            section = cf.index.find(path)
+            start, end = cf.index.section_span(section)
+            return dict(cf.info(), etag=slice_etag(cf.content[start:end]))
+
+    def replace_all(self, files, synced_at=None):
+        """Replace the whole set (POST /context). Unchanged files cost nothing."""
+        synced_at = synced_at or datetime.now().timestamp() * 1000
+        with self._lock, PERSIST_SECONDS.time("context"):
+            removed = [name for name in self.files if name not in files]
+            created = False
+            for name in removed:
+                self._drop(name)
+            for name, content in files.items():
+                cf = self.files.get(name)
+                if cf is None:
+                    self._create(name, content, synced_at)
+                    created = True
+                elif content != cf.content:
+                    self._append(cf, content, synced_at)
+            self.synced_at = synced_at
+            if removed or created:
+                self._write_manifest()
+                self._collect_garbage()
+
+    def _next_version(self):
+        self.version += 1
+        return self.version
+
+    def _create(self, name, content, updated_at):
+        digest = self._put_object(content)
+        cf = ContextFile(name, {"hash": digest, "version": self._next_version(), "updatedAt": updated_at})
+        cf.set_content(content)
+        self.files[name] = cf
+        path = self._journal_path(name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _append(self, cf, content, updated_at):
+        edit = make_edit(cf.content, content)
+        entry = {"v": self._next_version(), "at": updated_at}
+        if len(edit[2]) * 2 > len(content):
+            entry["hash"] = self._put_object(content)
+        else:
+            entry["edit"] = edit
+        line = json.dumps(entry).encode() + b"\n"
+        with open(self._journal_path(cf.name), "ab") as f:
+            f.write(line)
+        cf.entries.append(entry)
+        cf.journal_bytes += len(line)
+        cf.set_content(content)
+        if self._needs_compaction(cf):
+            self._compact_wakeup.set()
+
+    def _drop(self, name):
+        del self.files[name]
+        path = self._journal_path(name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    # --- compaction --------------------------------------------------------
+
+    def _needs_compaction(self, cf):
+        return (len(cf.entries) > 2 * self.keep_versions
+                or cf.journal_bytes > max(64 * 1024, 4 * len(cf.content)))
+
+    def close(self):
+        """Stop the compaction thread; the store is being dropped."""
+        self._closed = True
+        self._compact_wakeup.set()
+
+    def _compact_loop(self):
+        while not self._closed:
+            self._compact_wakeup.wait(self.compact_interval)
+            self._compact_wakeup.clear()
+            if self._closed:
+                break
+            try:
+                self.compact()
+            except Exception as e:
+                print(f"Context compaction failed: {e}")
+
+    def compact(self, force=False):
+        """Fold old journal entries into new snapshots, keeping the last
+        `keep_versions` (none if `force`). Returns the compacted file names."""
+        compacted = []
+        with self._lock, PERSIST_SECONDS.time("context_compact"):
+            for cf in self.files.values():
+                if not (force or self._needs_compaction(cf)):
+                    continue
+                keep = 0 if force else min(self.keep_versions, len(cf.entries))
+                folded = cf.entries[:len(cf.entries) - keep]
+                if not folded:
+                    continue
+                content = self._read_object(cf.base_hash)
+                for entry in folded:
+                    content = self._apply(content, entry)
+                cf.base_hash = self._put_object(content)
+                cf.base_version = folded[-1]["v"]
+                cf.base_at = folded[-1]["at"]
+                cf.entries = cf.entries[len(folded):]
+                compacted.append(cf)
+            if not compacted:
+                return []
+            # Manifest first: a crash before the journal rewrite leaves entries at or
+            # below the new snapshot version, which replay skips.
+            self._write_manifest()
+            for cf in compacted:
+                data = b"".join(json.dumps(e).encode() + b"\n" for e in cf.entries)
+                atomic_write(self._journal_path(cf.name), data)
+                cf.journal_bytes = len(data)
+            self._collect_garbage()
+        return [cf.name for cf in compacted]
+
+    # --- files -------------------------------------------------------------
+
+    def _journal_path(self, name):
+        return os.path.join(self.journal_dir, quote(name, safe="") + ".log")
+
+    def _read_object(self, digest):
+        with open(os.path.join(self.objects_dir, digest), "rb") as f:
+            return f.read().decode("utf-8")
+
+    def _put_object(self, content):
+        data = content.encode("utf-8")
+        digest = content_hash(data)
+        path = os.path.join(self.objects_dir, digest)
+        if not os.path.exists(path):
+            atomic_write(path, data)
+        return digest
+
+    def _apply(self, content, entry):
+        if "hash" in entry:
+            return self._read_object(entry["hash"])
+        return apply_edit(content, entry["edit"])
+
+    def _write_manifest(self):
+        files = {name: {"hash": cf.base_hash, "version": cf.base_version, "updatedAt": cf.base_at}
+                 for name, cf in self.files.items()}
+        manifest = {"files": files, "version": self.version, "syncedAt": self.synced_at}
+        atomic_write(self.manifest_file, json.dumps(manifest).encode())
+
+    def _collect_garbage(self):
+        """Remove objects that no snapshot or journal entry references."""
+        live = set()
+        for cf in self.files.values():
+            live.add(cf.base_hash)
+            live.update(e["hash"] for e in cf.entries if "hash" in e)
+        for digest in os.listdir(self.objects_dir):
+            if digest not in live and ".tmp-" not in digest:
+                try:
+                    os.remove(os.path.join(self.objects_dir, digest))
+                except OSError:
+                    pass
+
+def briefing_context(context_store):
+    """The CLAUDE.md section for /briefing: BRIEFING_CONTEXT_SECTION if it
+    exists, else the first heading's own text that isn't empty."""
+    try:
+        _, content, index = context_store.view("CLAUDE.md")
+    except KeyError:
+        return ""
+    section = index.find(BRIEFING_CONTEXT_SECTION) if BRIEFING_CONTEXT_SECTION else None
+    if section is not None:
+        start, end = index.section_span(section)
+        return content[start:end].strip()
+    for section in index.sections:
+        start, end = index.own_span(section)
+        text = content[start:end].strip()
+        if "\n" in text:
+            return text
+    return content[:500]
+
+# =============================================================================
+# User Partitions
+# =============================================================================
+
+class Partition:
+    """One user's tasks, notes and context: own files under `directory`, own
+    stores with their caches and views, and a lock that orders the user's
+    syncs. Readers take no lock (the stores swap in new snapshots)."""
+
+    def __init__(self, email, directory):
+        self.email = email
+        self.directory = directory
+        self.tasks_file = os.path.join(directory, "tasks.snap")
+        self.notes_file = os.path.join(directory, "notes.snap")
+        self.tasks = TaskStore(TaskRanker(TASK_RANK_WEIGHTS, TASK_TAG_WEIGHTS))
+        self.notes = NoteStore()
+        self.context = ContextStore(os.path.join(directory, "context"),
+                                    legacy_file=os.path.join(directory, "context.json"),
+                                    keep_versions=CONTEXT_KEEP_VERSIONS)
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.users = 0              # requests holding the partition
+        self.last_used = time.monotonic()
+        self._load_lock = threading.Lock()
+
+    def load(self):
+        """Load the files once; concurrent callers wait for the first."""
+        if self.loaded:
+            return
+        with self._load_lock:
+            if self.loaded:
+                return
+            with PARTITION_LOAD_SECONDS.time():
+                os.makedirs(self.directory, exist_ok=True)
+                if not self.tasks.load(self.tasks_file):
+                    migrate_legacy(self.tasks, os.path.join(self.directory, "tasks.json"), self.tasks_file, "tasks")
+                if not self.notes.load(self.notes_file):
+                    migrate_legacy(self.notes, os.path.join(self.directory, "notes.json"), self.notes_file, "notes")
+                self.context.load()
+            self.loaded = True
+
+    def sync_tasks(self, tasks, synced_at):
+        with self.lock:
+            self.tasks.replace(tasks, synced_at)
+            self.tasks.save(self.tasks_file)
+
+    def sync_notes(self, notes, synced_at):
+        with self.lock:
+            self.notes.replace(notes, synced_at)
+            self.notes.save(self.notes_file)
+
+    def close(self):
+        self.context.close()
+
+class Partitions:
+    """User partitions keyed by account email; API key requests belong to
+    `owner`. A partition loads on its first request and is dropped once it
+    has been idle for `idle_seconds` with no request holding it. Every write
+    is persisted as it happens, so dropping needs no flush."""
+
+    def __init__(self, owner, aliases=None, idle_seconds=900):
+        self.owner = owner
+        self.aliases = aliases or {}
+        self.idle_seconds = idle_seconds
+        self._partitions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._partitions)
+
+    def directory(self, email):
+        if email == self.owner:
+            return DATA_DIR
+        return os.path.join(USERS_DIR, re.sub(r"[^a-z0-9@._+-]", "_", email.lower()))
+
+    def acquire(self, email=None):
+        """The loaded partition of `email` (None: the owner), held until release()."""
+        email = self.aliases.get(email, email) if email else self.owner
+        with self._lock:
+            partition = self._partitions.get(email)
+            if partition is None:
+                partition = self._partitions[email] = Partition(email, self.directory(email))
+                PARTITIONS_LOADED.set(value=len(self._partitions))
+            partition.users += 1
         try:
-            with open(CONTEXT_FILE, "r") as f:
-                context_data = json.load(f)
-        except: pass
+            partition.load()
+        except Exception:
+            self.release(partition)
+            raise
+        return partition
+
+    def release(self, partition):
+        with self._lock:
+            partition.users -= 1
+            partition.last_used = time.monotonic()
+
+    def loaded(self):
+        with self._lock:
+            return [p for p in self._partitions.values() if p.loaded]
+
+    def evict_idle(self, now=None):
+        """Drop partitions unused for idle_seconds; returns their emails."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            idle = [p for p in self._partitions.values()
+                    if not p.users and now - p.last_used > self.idle_seconds]
+            for partition in idle:
+                del self._partitions[partition.email]
+            PARTITIONS_LOADED.set(value=len(self._partitions))
+        for partition in idle:
+            partition.close()
+        return [p.email for p in idle]
+
+    def run_maintenance(self, interval=30):
+        """Every `interval` seconds in a daemon thread: apply due task rank
+        changes (so requests only handle the few that came due since) and
+        evict idle partitions."""
+        def tick():
+            while True:
+                time.sleep(interval)
+                now = time.time()
+                for partition in self.loaded():
+                    partition.tasks.ranker.advance(now)
+                for email in self.evict_idle():
+                    print(f"Unloaded idle data of {email}")
+        threading.Thread(target=tick, name="partition-maintenance", daemon=True).start()
+
+partitions = Partitions(next((e for e in GMAIL_ACCOUNTS if e), ""), PARTITION_ALIASES, PARTITION_IDLE_SECONDS)
+
+# =============================================================================
+# Google API Scheduler (rate limits, coalescing, retries, circuit breaking)
+# =============================================================================
+
+# Gmail quota units per call; everything else costs 1 (Calendar counts requests)
+QUOTA_COSTS = {"gmail.messages.list": 5, "gmail.messages.get": 5}
 
-def save_tasks():
-    with open(TASKS_FILE, "w") as f:
-        json.dump(tasks_data, f, indent=2)
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
 
-def save_notes():
-    with open(NOTES_FILE, "w") as f:
-        json.dump(notes_data, f, indent=2)
+def http_status(error):
+    """HTTP status of a googleapiclient HttpError, else None."""
+    status = getattr(getattr(error, "resp", None), "status", None)
+    try:
+        return int(status) if status is not None else None
+    except (TypeError, ValueError):
+        return None
 
-def save_context():
-    with open(CONTEXT_FILE, "w") as f:
-        json.dump(context_data, f, indent=2)
+class QuotaExhausted(Exception):
+    pass
+
+class CircuitOpen(Exception):
+    pass
+
+class TokenBucket:
+    """Refills `rate` units per second up to `capacity`. Callers reserve units
+    up front and sleep off any debt, so waiting callers are served in order."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, cost, timeout):
+        """Take `cost` units. Returns the seconds waited, or None (nothing taken)
+        if that would take longer than `timeout`."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = max(0.0, (cost - self.tokens) / self.rate)
+            if wait > timeout:
+                return None
+            self.tokens -= cost
+        if wait:
+            with span("quota"):
+                time.sleep(wait)
+        return wait
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failed calls and rejects calls for
+    `cooldown` seconds. After that one trial call is let through (half-open):
+    success closes the circuit, failure opens it again."""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self._trial and time.monotonic() - self.opened_at >= self.cooldown:
+                self._trial = True
+                return True
+            return False
+
+    def retry_in(self):
+        return max(0.0, self.cooldown - (time.monotonic() - (self.opened_at or 0)))
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        """Record a failed call. Returns True if the circuit is (now) open."""
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            return self.opened_at is not None
+
+    def end_trial(self):
+        """Finish a half-open trial call without success or failure; the
+        circuit stays open and the next call after the cooldown is a trial."""
+        with self._lock:
+            self._trial = False
+
+class Flight:
+    """One in-flight upstream call that identical concurrent calls wait on."""
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class GoogleScheduler:
+    """Every Google API call goes through execute():
+
+    - identical requests (same account, HTTP method, URI and body) that are
+      already in flight are not sent again; callers share the first one's result;
+    - a token bucket per account and API keeps calls within the quota
+      (GMAIL_QUOTA_UNITS_PER_SEC, CALENDAR_REQUESTS_PER_SEC);
+    - 429 and 5xx responses and network errors are retried up to
+      GOOGLE_MAX_RETRIES times with exponential backoff and full jitter,
+      honouring Retry-After;
+    - an account whose calls keep failing after retries gets its circuit
+      opened and fails fast for a while instead of stalling every request.
+
+    An httplib2 connection isn't thread-safe, so each call borrows an idle
+    HTTP client for its account and API from a pool (clients are created
+    with the service's credentials as concurrency requires, and reused so
+    their connections stay open).
+    """
+
+    def __init__(self, rates, max_retries=3, backoff_base=0.25, backoff_cap=8.0,
+                 breaker_threshold=5, breaker_cooldown=30.0, max_quota_wait=10.0, burst_seconds=1.0):
+        self.rates = rates
+        self.burst_seconds = burst_seconds
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.max_quota_wait = max_quota_wait
+        self._buckets = {}
+        self._breakers = {}
+        self._clients = {}              # (account, api) -> idle HTTP clients
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, account, api):
+        with self._lock:
+            bucket = self._buckets.get((account, api))
+            if bucket is None:
+                rate = self.rates.get(api, self.rates["default"])
+                bucket = self._buckets[(account, api)] = TokenBucket(rate, rate * self.burst_seconds)
+            return bucket
+
+    def _breaker(self, account):
+        with self._lock:
+            breaker = self._breakers.get(account)
+            if breaker is None:
+                breaker = self._breakers[account] = CircuitBreaker(self.breaker_threshold, self.breaker_cooldown)
+            return breaker
+
+    def _checkout(self, key, http):
+        """An idle client of the pool `key` using the same credentials as
+        `http` (the service's own client), or a new one."""
+        credentials = http.credentials
+        with self._lock:
+            pool = self._clients.setdefault(key, [])
+            while pool:
+                client = pool.pop()
+                if client.credentials is credentials:  # else the service was rebuilt
+                    return client
+        libs = google_libs()
+        return libs.AuthorizedHttp(credentials, http=libs.build_http())
+
+    def _checkin(self, key, client):
+        with self._lock:
+            self._clients[key].append(client)
+
+    def execute(self, request, account, method):
+        key = (account, request.method, request.uri, request.body)
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+        if not leader:
+            GOOGLE_API_COALESCED.inc(account, method)
+            with span("coalesced"):
+                flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = self._call(request, account, method)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _call(self, request, account, method):
+        breaker = self._breaker(account)
+        if not breaker.allow():
+            raise CircuitOpen(f"Google API paused for {account} after repeated failures, "
+                              f"retrying in {breaker.retry_in():.0f}s")
+        try:
+            return self._retry(request, account, method, breaker)
+        finally:
+            breaker.end_trial()  # a trial that got no verdict (e.g. out of quota) lets the next call try
+
+    def _retry(self, request, account, method, breaker):
+        api = method.split(".", 1)[0]
+        bucket = self._bucket(account, api)
+        for attempt in range(self.max_retries + 1):
+            if bucket.acquire(QUOTA_COSTS.get(method, 1), self.max_quota_wait) is None:
+                raise QuotaExhausted(f"Rate limit for {account} would need more than {self.max_quota_wait:.0f}s")
+            try:
+                client = self._checkout((account, api), request.http)
+                try:
+                    result = self._attempt(request, client, account, method)
+                finally:
+                    self._checkin((account, api), client)
+                breaker.success()
+                return result
+            except Exception as e:
+                status = http_status(e)
+                if status not in RETRYABLE_STATUSES and not (status is None and isinstance(e, OSError)):
+                    breaker.success()  # Google answered; the account is healthy
+                    raise
+                if attempt == self.max_retries:
+                    GOOGLE_CIRCUIT_OPEN.set(account, value=int(breaker.failure()))
+                    raise
+                GOOGLE_API_RETRIES.inc(account, method)
+                with span("backoff"):
+                    time.sleep(self._backoff(attempt, e))
+            finally:
+                if breaker.opened_at is None:
+                    GOOGLE_CIRCUIT_OPEN.set(account, value=0)
+
+    def _backoff(self, attempt, error):
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        try:
+            retry_after = float(error.resp.get("retry-after"))
+            delay = max(delay, min(retry_after, self.backoff_cap))
+        except (AttributeError, TypeError, ValueError):
+            pass
+        return delay
+
+    def _attempt(self, request, client, account, method):
+        """One upstream call on `client`, recording call count, latency and errors."""
+        start = time.perf_counter()
+        try:
+            with span("google"):
+                return request.execute(http=client)
+        except Exception:
+            GOOGLE_API_ERRORS.inc(account, method)
+            raise
+        finally:
+            GOOGLE_API_CALLS.inc(account, method)
+            GOOGLE_API_SECONDS.observe(time.perf_counter() - start, account, method)
+
+google_scheduler = GoogleScheduler(
+    {"gmail": GMAIL_QUOTA_UNITS_PER_SEC, "default": CALENDAR_REQUESTS_PER_SEC},
+    max_retries=GOOGLE_MAX_RETRIES,
+    breaker_threshold=GOOGLE_BREAKER_THRESHOLD,
+    breaker_cooldown=GOOGLE_BREAKER_COOLDOWN,
+    burst_seconds=GOOGLE_QUOTA_BURST_SECONDS,
+)
+
+def google_execute(request, account, method):
+    """Execute a Google API request through the scheduler."""
+    return google_scheduler.execute(request, account, method)
 
 # =============================================================================
 # Gmail Functions
@@ -165,6 +2456,51 @@ def get_gmail_credentials_config():
         }
     }
 
+_google = None
+_google_lock = threading.Lock()
+
+def google_libs():
+    """The Google client classes, imported on first use.
+
+    The imports take a few hundred ms, which would otherwise delay every
+    start before /health can answer. main() warms them up in the background
+    once the server is listening (GOOGLE_WARMUP=0 disables that).
+    """
+    global _google
+    if _google is None:
+        with _google_lock:
+            if _google is None:
+                start = time.perf_counter()
+                from google.oauth2.credentials import Credentials
+                from google.oauth2 import id_token
+                from google.auth.transport.requests import Request
+                from googleapiclient.discovery import build
+                from googleapiclient.http import build_http
+                from google_auth_httplib2 import AuthorizedHttp
+                _google = SimpleNamespace(Credentials=Credentials, Request=Request,
+                                          build=build, id_token=id_token,
+                                          build_http=build_http, AuthorizedHttp=AuthorizedHttp)
+                startup.record("google_imports", time.perf_counter() - start)
+    return _google
+
+def refresh_credentials(creds, account):
+    """Refresh expired OAuth credentials, recorded as an upstream call."""
+    start = time.perf_counter()
+    try:
+        with span("refresh"):
+            creds.refresh(google_libs().Request())
+    except Exception:
+        GOOGLE_API_ERRORS.inc(account, "oauth.refresh")
+        raise
+    finally:
+        GOOGLE_API_CALLS.inc(account, "oauth.refresh")
+        GOOGLE_API_SECONDS.observe(time.perf_counter() - start, account, "oauth.refresh")
+
+def build_google_service(name, version, creds):
+    """Build a Google API client, honouring GOOGLE_API_ENDPOINT."""
+    options = {"api_endpoint": GOOGLE_API_ENDPOINT} if GOOGLE_API_ENDPOINT else None
+    return google_libs().build(name, version, credentials=creds, client_options=options)
+
 def get_token_file(email):
     safe_email = email.replace("@", "_at_").replace(".", "_")
     return os.path.join(DATA_DIR, f"gmail_token_{safe_email}.json")
@@ -182,21 +2518,68 @@ def get_gmail_service(email):
 
     try:
         # Load without specifying scopes - use scopes from token file
-        creds = Credentials.from_authorized_user_file(token_file)
+        creds = google_libs().Credentials.from_authorized_user_file(token_file)
 
         if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-            with open(token_file, 'w') as f:
-                f.write(creds.to_json())
+            refresh_credentials(creds, email)
+            atomic_write(token_file, creds.to_json().encode())
 
         if creds and creds.valid:
-            gmail_services[email] = build('gmail', 'v1', credentials=creds)
+            gmail_services[email] = build_google_service('gmail', 'v1', creds)
             return gmail_services[email]
     except Exception as e:
         print(f"Gmail service error for {email}: {e}")
 
     return None
 
+def _mail_time(headers, internal_date=None):
+    """Epoch ms of a message: Gmail's internalDate (receive time), else the
+    parsed Date header (naive dates taken as UTC); None if neither parses."""
+    try:
+        return int(internal_date)
+    except (TypeError, ValueError):
+        pass
+    try:
+        parsed = parsedate_to_datetime(headers.get("date", ""))
+    except (TypeError, ValueError, IndexError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=ZoneInfo("UTC"))
+    return int(parsed.timestamp() * 1000)
+
+def email_summary(msg_data, account):
+    """A format=metadata Gmail message as the email dict of the /emails routes."""
+    headers = {h['name'].lower(): h['value'] for h in msg_data.get('payload', {}).get('headers', [])}
+    return {
+        'id': msg_data['id'],
+        'threadId': msg_data.get('threadId'),
+        'subject': headers.get('subject', '(no subject)'),
+        'from': headers.get('from', 'Unknown'),
+        'date': headers.get('date', ''),
+        'timestamp': _mail_time(headers, msg_data.get('internalDate')),
+        'messageId': headers.get('message-id', ''),
+        'snippet': msg_data.get('snippet', ''),
+        'account': account
+    }
+
+def list_message_ids(service, email, max_results, query, hours_back):
+    after_date = (datetime.now() - timedelta(hours=hours_back)).strftime("%Y/%m/%d")
+    full_query = f"{query} after:{after_date}" if query else f"after:{after_date}"
+    results = google_execute(service.users().messages().list(
+        userId='me',
+        maxResults=max_results,
+        q=full_query
+    ), email, "gmail.messages.list")
+    return [msg['id'] for msg in results.get('messages', [])]
+
+def get_message_metadata(service, email, msg_id):
+    return google_execute(service.users().messages().get(
+        userId='me',
+        id=msg_id,
+        format='metadata',
+        metadataHeaders=['Subject', 'From', 'Date', 'Message-ID']
+    ), email, "gmail.messages.get")
+
 def fetch_emails(email, max_results=10, query="is:unread", hours_back=24):
     """Fetch emails from an account."""
     service = get_gmail_service(email)
@@ -204,41 +2587,422 @@ def fetch_emails(email, max_results=10, query="is:unread", hours_back=24):
         return [{"error": f"Not authenticated: {email}", "account": email}]
 
     try:
-        after_date = (datetime.now() - timedelta(hours=hours_back)).strftime("%Y/%m/%d")
-        full_query = f"{query} after:{after_date}" if query else f"after:{after_date}"
-
-        results = service.users().messages().list(
-            userId='me',
-            maxResults=max_results,
-            q=full_query
-        ).execute()
-
-        messages = results.get('messages', [])
-        emails = []
-
-        for msg in messages:
-            msg_data = service.users().messages().get(
-                userId='me',
-                id=msg['id'],
-                format='metadata',
-                metadataHeaders=['Subject', 'From', 'Date']
-            ).execute()
-
-            headers = {h['name']: h['value'] for h in msg_data.get('payload', {}).get('headers', [])}
-
-            emails.append({
-                'id': msg['id'],
-                'subject': headers.get('Subject', '(no subject)'),
-                'from': headers.get('From', 'Unknown'),
-                'date': headers.get('Date', ''),
-                'snippet': msg_data.get('snippet', ''),
-                'account': email
-            })
-
-        return emails
+        return [email_summary(get_message_metadata(service, email, msg_id), email)
+                for msg_id in list_message_ids(service, email, max_results, query, hours_back)]
     except Exception as e:
         return [{"error": str(e), "account": email}]
 
+def email_order(email):
+    """Sort key for email dicts, newest first with reverse=True."""
+    return email.get('timestamp') or 0
+
+# =============================================================================
+# Mail Digest (unread mail of all accounts, deduplicated)
+# =============================================================================
+
+# "Re:", "Fwd:", "AW:", "WG:" ... (also repeated or numbered, "Re[2]:")
+REPLY_PREFIX = re.compile(r"^(\s*(re|fwd?|aw|wg|sv|antw)\s*(\[\d+\])?\s*:)+\s*", re.IGNORECASE)
+
+def thread_subject(subject):
+    """Subject without reply/forward prefixes: the conversation a message
+    belongs to across accounts (Gmail thread ids are per account)."""
+    return " ".join(REPLY_PREFIX.sub("", subject).split()).casefold()
+
+def sender_address(email):
+    return parseaddr(email.get("from", ""))[1].lower() or email.get("from", "")
+
+def dedup_key(email):
+    """Identity of a message across accounts: its Message-ID, or a hash of
+    sender, subject, Date header and snippet if it has none."""
+    message_id = email.get("messageId", "").strip().strip("<>").lower()
+    if message_id:
+        return "mid:" + message_id
+    content = "\0".join([sender_address(email), email.get("subject", ""), email.get("date", ""),
+                         email.get("snippet", "")])
+    return "sha:" + hashlib.sha256(content.encode()).hexdigest()[:32]
+
+class MailDigest:
+    """Unread mail of all accounts as one list: each message once however
+    many accounts it reached, newest first by parsed time, with counts per
+    conversation and per sender.
+
+    Updated incrementally: a refresh lists each account's unread ids (one
+    messages.list call) and fetches metadata only for ids it hasn't seen;
+    ids no longer listed (read, archived, out of the window) are dropped.
+    Refreshes run at most every `ttl` seconds, requests in between get the
+    current state. An account whose listing fails keeps its last state.
+    """
+
+    def __init__(self, max_results=50, hours_back=24, ttl=60):
+        self.max_results = max_results
+        self.hours_back = hours_back
+        self.ttl = ttl
+        self.version = 0                # bumped on every change to the messages
+        self.fetched_at = None
+        self.errors = {}                # account -> error of its last refresh
+        self._ids = {}                  # account -> message ids in the digest
+        self._copies = {}               # (account, id) -> dedup key
+        self._messages = {}             # dedup key -> {(account, id): email}, first copy shown
+        self._placed = {}               # dedup key -> (timestamp, thread, sender) as indexed
+        self._order = SortedKeys()      # (-timestamp, dedup key), newest first
+        self._threads = {}              # thread subject -> {dedup key: timestamp}
+        self._senders = {}              # sender address -> {dedup key: timestamp}
+        self._refreshed = None          # monotonic time of the last refresh
+        self._refresh_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._body = (None, b"")        # (cache key, JSON body)
+
+    def _fresh(self):
+        return self._refreshed is not None and time.monotonic() - self._refreshed < self.ttl
+
+    def refresh(self, accounts):
+        """Bring the digest up to date unless it is younger than the TTL;
+        concurrent callers wait for the refresh in progress."""
+        if self._fresh():
+            return
+        with self._refresh_lock:
+            if self._fresh():
+                return
+            errors = {}
+            for account in accounts:
+                error = self._refresh_account(account)
+                if error:
+                    errors[account] = error
+            with self._lock:
+                self.errors = errors
+            self._refreshed = time.monotonic()
+            self.fetched_at = datetime.now().isoformat()
+            MAIL_DIGEST_MESSAGES.set(value=len(self._messages))
+
+    def _refresh_account(self, account):
+        """Apply one account's changes; returns its error, if any."""
+        service = get_gmail_service(account)
+        if not service:
+            return f"Not authenticated: {account}"
+        try:
+            ids = list_message_ids(service, account, self.max_results, "is:unread", self.hours_back)
+        except Exception as e:
+            return str(e)
+        error = None
+        known = self._ids.get(account, set())
+        new = []
+        for msg_id in ids:
+            if msg_id in known:
+                continue
+            try:
+                new.append(email_summary(get_message_metadata(service, account, msg_id), account))
+            except Exception as e:
+                error = str(e)  # the id is retried on the next refresh
+        gone = known - set(ids)
+        if not new and not gone:
+            return error
+        MAIL_DIGEST_FETCHED.inc(account, amount=len(new))
+        with self._lock:
+            for msg_id in gone:
+                self._remove(account, msg_id)
+            for email in new:
+                self._add(email)
+            self.version += 1
+        return error
+
+    def _add(self, email):
+        key = dedup_key(email)
+        copy = (email["account"], email["id"])
+        self._ids.setdefault(email["account"], set()).add(email["id"])
+        self._copies[copy] = key
+        self._unplace(key)
+        self._messages.setdefault(key, {})[copy] = email
+        self._place(key)
+
+    def _remove(self, account, msg_id):
+        self._ids[account].discard(msg_id)
+        key = self._copies.pop((account, msg_id))
+        self._unplace(key)
+        copies = self._messages[key]
+        del copies[(account, msg_id)]
+        if copies:
+            self._place(key)
+        else:
+            del self._messages[key]
+
+    def _place(self, key):
+        """Index a message under its earliest copy's time and its first copy's
+        conversation and sender."""
+        copies = self._messages[key]
+        email = self._shown(key)
+        times = [e["timestamp"] for e in copies.values() if e["timestamp"] is not None]
+        placed = (min(times) if times else 0, thread_subject(email["subject"]), sender_address(email))
+        self._placed[key] = placed
+        self._order.add((-placed[0], key))
+        self._threads.setdefault(placed[1], {})[key] = placed[0]
+        self._senders.setdefault(placed[2], {})[key] = placed[0]
+
+    def _unplace(self, key):
+        placed = self._placed.pop(key, None)
+        if placed is None:
+            return
+        self._order.remove((-placed[0], key))
+        for groups, name in ((self._threads, placed[1]), (self._senders, placed[2])):
+            members = groups[name]
+            del members[key]
+            if not members:
+                del groups[name]
+
+    def _shown(self, key):
+        """The copy that represents a message (the first one fetched)."""
+        return next(iter(self._messages[key].values()))
+
+    def _entry(self, key):
+        copies = self._messages[key]
+        timestamp = self._placed[key][0]
+        return dict(self._shown(key),
+                    timestamp=timestamp,
+                    time=datetime.fromtimestamp(timestamp / 1000).astimezone().isoformat(),
+                    accounts=[account for account, _ in copies],
+                    copies=[{"account": account, "id": msg_id} for account, msg_id in copies])
+
+    def summary(self, limit=50, groups=10):
+        """The newest `limit` messages and the `groups` most recent
+        conversations and most frequent senders."""
+        with self._lock:
+            emails = [self._entry(key) for _, key in islice(self._order, limit)]
+            threads = []
+            for members in self._threads.values():
+                keys = sorted(members, key=members.get, reverse=True)
+                threads.append({"subject": self._shown(keys[0])["subject"], "count": len(keys),
+                                "latest": members[keys[0]],
+                                "senders": list(dict.fromkeys(self._shown(key)["from"] for key in keys))})
+            threads = heapq.nlargest(groups, threads, key=lambda t: t["latest"])
+            senders = []
+            for address, members in self._senders.items():
+                newest = max(members, key=members.get)
+                name = parseaddr(self._shown(newest)["from"])[0]
+                senders.append({"address": address, "name": name or address,
+                                "count": len(members), "latest": members[newest]})
+            senders = heapq.nlargest(groups, senders, key=lambda s: (s["count"], s["latest"]))
+            return {
+                "emails": emails,
+                "threads": threads,
+                "senders": senders,
+                "total": len(self._messages),
+                "duplicates": len(self._copies) - len(self._messages),
+                "errors": [{"account": account, "error": error} for account, error in self.errors.items()],
+                "fetchedAt": self.fetched_at,
+            }
+
+    def body(self, limit=50, groups=10):
+        """summary() as JSON, cached until the digest changes or is refreshed."""
+        cache_key = (self.version, self.fetched_at, limit, groups)
+        cached_key, body = self._body
+        if cached_key != cache_key:
+            body = json.dumps(self.summary(limit, groups)).encode()
+            self._body = (cache_key, body)
+        return body
+
+mail_digest = MailDigest(MAIL_DIGEST_MAX, MAIL_DIGEST_HOURS, MAIL_DIGEST_TTL)
+
+# =============================================================================
+# Message Cache (full Gmail messages)
+# =============================================================================
+
+def _decode_body(data):
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4)).decode("utf-8", errors="replace")
+
+def html_to_text(markup):
+    """Rough plain-text rendering of an HTML mail body."""
+    text = re.sub(r"(?is)<(script|style)\b.*?</\1>", "", markup)
+    text = re.sub(r"(?i)<br\s*/?>|</(p|div|tr|li|h[1-6])>", "\n", text)
+    text = unescape(re.sub(r"<[^>]+>", "", text))
+    return re.sub(r"\n\s*\n\s*\n+", "\n\n", text).strip()
+
+def parse_gmail_message(msg):
+    """A format=full Gmail message as headers, decoded text body and attachment metadata."""
+    plain, html, attachments = [], [], []
+
+    def walk(part):
+        mime = part.get("mimeType", "")
+        body = part.get("body", {})
+        if part.get("filename") or (body.get("attachmentId") and not mime.startswith("text/")):
+            attachments.append({
+                "filename": part.get("filename", ""),
+                "mimeType": mime,
+                "size": body.get("size", 0),
+                "attachmentId": body.get("attachmentId"),
+                "partId": part.get("partId"),
+            })
+        elif mime == "text/plain" and body.get("data"):
+            plain.append(_decode_body(body["data"]))
+        elif mime == "text/html" and body.get("data"):
+            html.append(_decode_body(body["data"]))
+        for child in part.get("parts", []):
+            walk(child)
+
+    payload = msg.get("payload", {})
+    walk(payload)
+    headers = {h["name"].lower(): h["value"] for h in payload.get("headers", [])}
+    return {
+        "id": msg["id"],
+        "threadId": msg.get("threadId"),
+        "subject": headers.get("subject", "(no subject)"),
+        "from": headers.get("from", "Unknown"),
+        "to": headers.get("to", ""),
+        "cc": headers.get("cc", ""),
+        "date": headers.get("date", ""),
+        "messageId": headers.get("message-id", ""),
+        "snippet": msg.get("snippet", ""),
+        "body": "\n".join(plain) if plain else html_to_text("\n".join(html)),
+        "bodyType": "text/plain" if plain or not html else "text/html",
+        "attachments": attachments,
+    }
+
+class MessageCache:
+    """Parsed Gmail messages, cached by (account, message id).
+
+    Gmail message content never changes, so entries are served without
+    revalidation. Only labels (read/unread, archived, ...) can change; they
+    are kept separately and refetched (format=minimal) once older than
+    `label_ttl` seconds.
+
+    Two tiers: the last `hot_entries` messages stay in memory; all of them
+    live on disk as one JSON file each, up to `max_bytes` in total. Eviction
+    is least-recently-used. Reads bump the file mtime, so the order survives
+    a restart.
+    """
+
+    def __init__(self, directory, max_bytes, hot_entries=128, label_ttl=60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hot_entries = hot_entries
+        self.label_ttl = label_ttl
+        self._disk = OrderedDict()      # key -> file size, least recently used first
+        self._disk_bytes = 0
+        self._hot = OrderedDict()       # key -> message dict
+        self._labels = {}               # key -> (labelIds, monotonic fetch time)
+        self._lock = threading.Lock()
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                st = os.stat(os.path.join(self.directory, name))
+                entries.append((st.st_mtime, name[:-5], st.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+        with self._lock:
+            self._evict()
+
+    @staticmethod
+    def _key(account, msg_id):
+        return hashlib.sha256(f"{account}\0{msg_id}".encode()).hexdigest()[:32]
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, account, msg_id):
+        """The cached message (with its last known "labelIds") or None."""
+        key = self._key(account, msg_id)
+        with self._lock:
+            message = self._hot.get(key)
+            if message is not None:
+                self._hot.move_to_end(key)
+                if key in self._disk:
+                    self._disk.move_to_end(key)
+                MAIL_CACHE_LOOKUPS.inc("hot")
+                return message
+            if key not in self._disk:
+                MAIL_CACHE_LOOKUPS.inc("miss")
+                return None
+            self._disk.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as f:
+                message = json.loads(f.read())
+            os.utime(self._path(key))
+        except (OSError, ValueError):
+            with self._lock:
+                self._forget(key)
+            MAIL_CACHE_LOOKUPS.inc("miss")
+            return None
+        with self._lock:
+            self._remember(key, message)
+        MAIL_CACHE_LOOKUPS.inc("disk")
+        return message
+
+    def put(self, account, msg_id, message):
+        key = self._key(account, msg_id)
+        data = json.dumps(message).encode()
+        atomic_write(self._path(key), data)
+        with self._lock:
+            self._disk_bytes += len(data) - self._disk.get(key, 0)
+            self._disk[key] = len(data)
+            self._disk.move_to_end(key)
+            self._remember(key, message)
+            self._labels[key] = (message.get("labelIds", []), time.monotonic())
+            self._evict()
+
+    def fresh_labels(self, account, msg_id):
+        """Label ids fetched within the TTL, or None."""
+        entry = self._labels.get(self._key(account, msg_id))
+        if entry and time.monotonic() - entry[1] < self.label_ttl:
+            return entry[0]
+        return None
+
+    def set_labels(self, account, msg_id, label_ids):
+        self._labels[self._key(account, msg_id)] = (label_ids, time.monotonic())
+
+    def _remember(self, key, message):
+        self._hot[key] = message
+        self._hot.move_to_end(key)
+        while len(self._hot) > self.hot_entries:
+            self._hot.popitem(last=False)
+
+    def _forget(self, key):
+        self._disk_bytes -= self._disk.pop(key, 0)
+        self._hot.pop(key, None)
+        self._labels.pop(key, None)
+
+    def _evict(self):
+        while self._disk_bytes > self.max_bytes and len(self._disk) > 1:
+            key = next(iter(self._disk))
+            self._forget(key)
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+message_cache = MessageCache(MAIL_CACHE_DIR, MAIL_CACHE_MB * 1024 * 1024,
+                             label_ttl=MAIL_LABEL_TTL)
+
+def fetch_message(account, msg_id):
+    """Full message for /emails/{account}/{id}: from the cache when possible,
+    with labels refreshed once they are older than the TTL. Returns None if
+    the account isn't authenticated; Google errors propagate."""
+    message = message_cache.get(account, msg_id)
+    if message is not None:
+        labels = message_cache.fresh_labels(account, msg_id)
+        service = get_gmail_service(account) if labels is None else None
+        if service:
+            try:
+                minimal = google_execute(service.users().messages().get(
+                    userId='me', id=msg_id, format='minimal'), account, "gmail.messages.get")
+                labels = minimal.get("labelIds", [])
+                message_cache.set_labels(account, msg_id, labels)
+            except Exception:
+                pass
+        if labels is None:
+            labels = message.get("labelIds", [])  # stale labels beat failing the read
+        return dict(message, labelIds=labels, cached=True)
+
+    service = get_gmail_service(account)
+    if not service:
+        return None
+    msg = google_execute(service.users().messages().get(
+        userId='me', id=msg_id, format='full'), account, "gmail.messages.get")
+    message = dict(parse_gmail_message(msg), account=account, labelIds=msg.get("labelIds", []))
+    message_cache.put(account, msg_id, message)
+    return dict(message, cached=False)
+
 # =============================================================================
 # Calendar Functions
 # =============================================================================
@@ -256,34 +3020,36 @@ def get_calendar_service(email):
 
     try:
         # Load without specifying scopes - use scopes from token file
-        creds = Credentials.from_authorized_user_file(token_file)
+        creds = google_libs().Credentials.from_authorized_user_file(token_file)
 
         if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-            with open(token_file, 'w') as f:
-                f.write(creds.to_json())
+            refresh_credentials(creds, email)
+            atomic_write(token_file, creds.to_json().encode())
 
         if creds and creds.valid:
-            calendar_services[email] = build('calendar', 'v3', credentials=creds)
+            calendar_services[email] = build_google_service('calendar', 'v3', creds)
             return calendar_services[email]
     except Exception as e:
         print(f"Calendar service error for {email}: {e}")
 
     return None
 
-def fetch_calendar_events(email, days_ahead=7, max_results=20):
-    """Fetch upcoming calendar events from an account."""
+def fetch_calendar_events(email, days_ahead=7, max_results=20, start=None):
+    """Fetch upcoming calendar events from an account (from `start`, a naive
+    UTC datetime, instead of now if given)."""
     service = get_calendar_service(email)
     if not service:
         return [{"error": f"Not authenticated for calendar: {email}", "account": email}]
 
     try:
-        now = datetime.utcnow()
+        # Whole minutes, so concurrent identical requests can be coalesced
+        now = start or datetime.utcnow().replace(second=0, microsecond=0)
         time_min = now.isoformat() + 'Z'
         time_max = (now + timedelta(days=days_ahead)).isoformat() + 'Z'
+        covered_until = parse_event_time(time_max, None)
 
         # Get list of calendars
-        calendar_list = service.calendarList().list().execute()
+        calendar_list = google_execute(service.calendarList().list(), email, "calendar.calendarList.list")
         all_events = []
 
         for cal in calendar_list.get('items', []):
@@ -291,23 +3057,29 @@ def fetch_calendar_events(email, days_ahead=7, max_results=20):
             cal_name = cal.get('summary', cal_id)
 
             try:
-                events_result = service.events().list(
+                events_result = google_execute(service.events().list(
                     calendarId=cal_id,
                     timeMin=time_min,
                     timeMax=time_max,
                     maxResults=max_results,
                     singleEvents=True,
                     orderBy='startTime'
-                ).execute()
-
-                for event in events_result.get('items', []):
-                    start = event.get('start', {})
-                    end = event.get('end', {})
+                ), email, "calendar.events.list")
+                items = events_result.get('items', [])
+                if len(items) >= max_results:
+                    # Truncated: later events of this calendar are unknown
+                    last = items[-1].get('start', {})
+                    covered_until = min(covered_until, parse_event_time(
+                        last.get('dateTime', last.get('date', time_max)), None))
+
+                for event in items:
+                    event_start = event.get('start', {})
+                    event_end = event.get('end', {})
 
                     # Handle all-day vs timed events
-                    start_str = start.get('dateTime', start.get('date', ''))
-                    end_str = end.get('dateTime', end.get('date', ''))
-                    is_all_day = 'date' in start and 'dateTime' not in start
+                    start_str = event_start.get('dateTime', event_start.get('date', ''))
+                    end_str = event_end.get('dateTime', event_end.get('date', ''))
+                    is_all_day = 'date' in event_start and 'dateTime' not in event_start
 
                     all_events.append({
                         'id': event.get('id'),
@@ -320,6 +3092,7 @@ def fetch_calendar_events(email, days_ahead=7, max_results=20):
                         'calendar': cal_name,
                         'account': email,
                         'status': event.get('status', 'confirmed'),
+                        'transparency': event.get('transparency', 'opaque'),
                         'html_link': event.get('htmlLink', '')
                     })
             except Exception as e:
@@ -327,7 +3100,9 @@ def fetch_calendar_events(email, days_ahead=7, max_results=20):
                 continue
 
         # Sort by start time
-        all_events.sort(key=lambda x: x.get('start', ''))
+        with span("sort"):
+            all_events.sort(key=lambda x: x.get('start', ''))
+        calendar_event_cache[email] = (parse_event_time(time_min, None), covered_until, time.time(), all_events)
         return all_events
 
     except Exception as e:
@@ -349,7 +3124,7 @@ def fetch_todays_events(email):
         time_min = today_start.isoformat() + 'Z'
         time_max = today_end.isoformat() + 'Z'
 
-        calendar_list = service.calendarList().list().execute()
+        calendar_list = google_execute(service.calendarList().list(), email, "calendar.calendarList.list")
         all_events = []
 
         for cal in calendar_list.get('items', []):
@@ -357,14 +3132,14 @@ def fetch_todays_events(email):
             cal_name = cal.get('summary', cal_id)
 
             try:
-                events_result = service.events().list(
+                events_result = google_execute(service.events().list(
                     calendarId=cal_id,
                     timeMin=time_min,
                     timeMax=time_max,
                     maxResults=50,
                     singleEvents=True,
                     orderBy='startTime'
-                ).execute()
+                ), email, "calendar.events.list")
 
                 for event in events_result.get('items', []):
                     start = event.get('start', {})
@@ -386,485 +3161,1313 @@ def fetch_todays_events(email):
             except:
                 continue
 
-        all_events.sort(key=lambda x: x.get('start', ''))
+        with span("sort"):
+            all_events.sort(key=lambda x: x.get('start', ''))
         return all_events
 
     except Exception as e:
         return [{"error": str(e), "account": email}]
 
 # =============================================================================
-# HTTP Handler
+# Free/Busy
 # =============================================================================
 
-class ChiefOfStaffHandler(BaseHTTPRequestHandler):
-    def _set_headers(self, status=200):
-        self.send_response(status)
-        self.send_header("Content-Type", "application/json")
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type, Authorization, X-API-Key")
-        self.end_headers()
+# Last events.list result per account: email -> (covered_from, covered_until,
+# fetched_at, events), used by /calendar/free when freebusy fails
+calendar_event_cache = {}
+CALENDAR_CACHE_TTL = 900
+
+# Calendar ids per account for freebusy queries: email -> (fetched_at, ids)
+calendar_ids_cache = {}
+CALENDAR_IDS_TTL = 600
+
+# Calendars per freebusy query (the API's limit)
+FREEBUSY_MAX_ITEMS = 50
+
+def parse_event_time(value, tz):
+    """Epoch seconds of an event time: RFC 3339 date-times as given, all-day
+    dates ("2024-01-03") at midnight in tz (UTC if tz is None)."""
+    if len(value) == 10:
+        day = datetime.strptime(value, "%Y-%m-%d")
+        return datetime.combine(day.date(), dtime(0), tz or ZoneInfo("UTC")).timestamp()
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=tz or ZoneInfo("UTC"))
+    return moment.timestamp()
+
+def parse_work_hours(value):
+    """"09:00-18:00" -> (time(9), time(18)); ValueError if malformed."""
+    first, sep, last = value.partition("-")
+    start = dtime.fromisoformat(first.strip())
+    end = dtime.fromisoformat(last.strip())
+    if not sep or end <= start:
+        raise ValueError(value)
+    return start, end
+
+def parse_work_days(value):
+    """ISO weekdays from "1-5" or "1,3,5" as a set; ValueError if malformed."""
+    days = set()
+    for part in value.split(","):
+        first, sep, last = part.strip().partition("-")
+        days.update(range(int(first), int(last if sep else first) + 1))
+    if not days or not days <= set(range(1, 8)):
+        raise ValueError(value)
+    return days
+
+def merge_intervals(intervals):
+    """Sort (start, end) pairs and merge the overlapping or touching ones."""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        elif end > start:
+            merged.append([start, end])
+    return merged
+
+def free_slots(busy, window_start, window_end, tz, work_hours, work_days, min_seconds):
+    """Gaps of at least min_seconds between merged busy intervals, within
+    working hours on working days (wall-clock times in tz) and the window.
+
+    One sweep: days and busy intervals are both in order, so each busy
+    interval is passed at most once per day it overlaps."""
+    slots = []
+    i = 0
+    day = datetime.fromtimestamp(window_start, tz).date()
+    last_day = datetime.fromtimestamp(window_end, tz).date()
+    while day <= last_day:
+        if day.isoweekday() in work_days:
+            start = max(window_start, datetime.combine(day, work_hours[0], tz).timestamp())
+            end = min(window_end, datetime.combine(day, work_hours[1], tz).timestamp())
+            while i < len(busy) and busy[i][1] <= start:
+                i += 1
+            cursor = start
+            j = i
+            while cursor < end:
+                if j < len(busy) and busy[j][0] < end:
+                    gap_end, next_cursor = busy[j]
+                    j += 1
+                else:
+                    gap_end = next_cursor = end
+                if gap_end - cursor >= min_seconds:
+                    slots.append((cursor, gap_end))
+                cursor = max(cursor, next_cursor)
+        day += timedelta(days=1)
+    return slots
+
+def list_calendar_ids(email, service):
+    """Ids of an account's calendars, cached for CALENDAR_IDS_TTL."""
+    cached = calendar_ids_cache.get(email)
+    if cached and time.time() - cached[0] < CALENDAR_IDS_TTL:
+        return cached[1]
+    result = google_execute(service.calendarList().list(), email, "calendar.calendarList.list")
+    ids = [cal['id'] for cal in result.get('items', [])]
+    calendar_ids_cache[email] = (time.time(), ids)
+    return ids
+
+def freebusy_intervals(email, service, start, end):
+    """Busy (start, end) epoch pairs of all of an account's calendars, from
+    one freebusy query per FREEBUSY_MAX_ITEMS calendars."""
+    ids = list_calendar_ids(email, service)
+    intervals = []
+    for offset in range(0, len(ids), FREEBUSY_MAX_ITEMS):
+        body = {
+            "timeMin": datetime.utcfromtimestamp(start).isoformat() + 'Z',
+            "timeMax": datetime.utcfromtimestamp(end).isoformat() + 'Z',
+            "items": [{"id": cal_id} for cal_id in ids[offset:offset + FREEBUSY_MAX_ITEMS]],
+        }
+        result = google_execute(service.freebusy().query(body=body), email, "calendar.freebusy.query")
+        # Calendars with errors (e.g. no access) are skipped, as in fetch_calendar_events()
+        for calendar in result.get('calendars', {}).values():
+            for period in calendar.get('busy', []):
+                intervals.append((parse_event_time(period['start'], None), parse_event_time(period['end'], None)))
+    return intervals
+
+def event_intervals(events, tz):
+    """Busy (start, end) epoch pairs of events as returned by
+    fetch_calendar_events(). Like freebusy, cancelled events and events
+    marked free (the default for all-day events) don't count; all-day
+    events block whole days in tz."""
+    intervals = []
+    for event in events:
+        if event.get('error') or event.get('status') == 'cancelled' or event.get('transparency') == 'transparent':
+            continue
+        if not (event.get('start') and event.get('end')):
+            continue
+        intervals.append((parse_event_time(event['start'], tz), parse_event_time(event['end'], tz)))
+    return intervals
+
+def busy_intervals(email, start, end, tz):
+    """Busy intervals of an account between two epoch times, and where they
+    came from: the freebusy API, else cached events covering the range,
+    else a fresh events.list, else stale cached events."""
+    service = get_calendar_service(email)
+    if not service:
+        return None, {"error": f"Not authenticated for calendar: {email}"}
 
-    def _check_auth(self, allow_api_key=False):
-        """Check authentication via device token (and optionally API key for POST).
+    try:
+        return freebusy_intervals(email, service, start, end), {"source": "freebusy"}
+    except Exception as e:
+        error = str(e)
 
-        Args:
-            allow_api_key: If True, also accept API key (for Amplenote sync POST requests)
-        """
-        parsed = urlparse(self.path)
-        params = parse_qs(parsed.query)
-
-        # Check device token first (always accepted)
-        token = params.get("token", [None])[0]
-        if not token:
-            auth = self.headers.get("Authorization", "")
-            if auth.startswith("Bearer "):
-                token = auth[7:]
-        if token and validate_device_token(token):
-            return True
-
-        # API key only allowed for specific endpoints (POST for sync)
-        if allow_api_key and API_KEY:
-            if params.get("key", [None])[0] == API_KEY:
-                return True
-            if self.headers.get("X-API-Key") == API_KEY:
-                return True
+    cached = calendar_event_cache.get(email)
+    if cached and cached[0] <= start and cached[1] >= end and time.time() - cached[2] < CALENDAR_CACHE_TTL:
+        return event_intervals(cached[3], tz), {"source": "cache", "fetchedAt": datetime.fromtimestamp(cached[2]).isoformat()}
 
-        return False
+    days = int((end - start) // 86400) + 1
+    events = fetch_calendar_events(email, days_ahead=days, max_results=250,
+                                   start=datetime.utcfromtimestamp(start).replace(second=0, microsecond=0))
+    if not (events and events[0].get('error')):
+        return event_intervals(events, tz), {"source": "events"}
 
-    def _set_html_headers(self, status=200):
-        """Set headers for HTML response."""
-        self.send_response(status)
-        self.send_header("Content-Type", "text/html; charset=utf-8")
-        self.end_headers()
+    if cached:
+        return event_intervals(cached[3], tz), {"source": "cache", "stale": True, "error": error,
+                                                "fetchedAt": datetime.fromtimestamp(cached[2]).isoformat()}
+    return None, {"error": error}
+
+# =============================================================================
+# Routing
+# =============================================================================
+
+# Route auth levels
+PUBLIC = "public"    # no auth
+DEVICE = "device"    # device token
+SYNC = "sync"        # device token or API key (Amplenote sync, scrapers)
+ADMIN = "admin"      # device token of an admin account
+
+class HTTPError(Exception):
+    """Raised by route handlers to answer with a JSON error body."""
+
+    def __init__(self, status, error, **extra):
+        super().__init__(error)
+        self.status = status
+        self.payload = {"error": error, **extra}
+
+class RequestContext:
+    """A request parsed once: path, query, headers, body and auth result."""
+    __slots__ = ("method", "path", "query", "headers", "body", "route", "path_arg",
+                 "device", "auth", "response_headers", "_params", "_partition")
+
+    def __init__(self, method, raw_path, headers, body=b""):
+        self.method = method
+        self.path, _, self.query = raw_path.partition("?")
+        self.headers = headers
+        self.body = body
+        self.route = None
+        self.path_arg = None
+        self.device = None
+        self.auth = None
+        self.response_headers = []
+        self._params = None
+        self._partition = None
+
+    @property
+    def params(self):
+        if self._params is None:
+            self._params = parse_qs(self.query) if self.query else {}
+        return self._params
+
+    def param(self, name, default=None):
+        return self.params.get(name, [default])[0]
+
+    def int_param(self, name, default):
+        """Integer query parameter, or a 400 if it doesn't parse."""
+        value = self.param(name)
+        if value is None:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise HTTPError(400, f"{name} must be an integer")
+
+    def range_param(self, name):
+        """Inclusive "first-last" query parameter as (first, last); last is None
+        for an open range ("10-"). None if absent, 400 if malformed."""
+        value = self.param(name)
+        if value is None:
+            return None
+        first, sep, last = value.partition("-")
+        try:
+            return int(first), (int(last) if last else None)
+        except ValueError:
+            raise HTTPError(400, f"{name} must look like 10-20")
+
+    def json(self):
+        """Decode the request body as JSON, or raise a 400."""
+        try:
+            return json.loads(self.body)
+        except json.JSONDecodeError:
+            raise HTTPError(400, "Invalid JSON")
+
+    def sync_body(self, name):
+        """(items, syncedAt) of a sync POST such as {"tasks": [...], "syncedAt": ...};
+        a 400 unless `name` is a list of objects."""
+        data = self.json()
+        items = data.get(name, []) if isinstance(data, dict) else None
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise HTTPError(400, f"{name} must be a list of objects")
+        return items, data.get("syncedAt", datetime.now().timestamp() * 1000)
+
+    def authenticate(self):
+        """Resolve the device token / API key once. Returns "device_token", "api_key" or None."""
+        if self.auth is not None:
+            return self.auth or None
+        with span("auth") as s:
+            token = self.param("token")
+            if not token:
+                header = self.headers.get("Authorization", "")
+                if header.startswith("Bearer "):
+                    token = header[7:]
+            self.device = validate_device_token(token) if token else None
+            if self.device:
+                self.auth = "device_token"
+            elif API_KEY and (self.param("key") == API_KEY or self.headers.get("X-API-Key") == API_KEY):
+                self.auth = "api_key"
+            else:
+                self.auth = ""
+        AUTH_SECONDS.observe(time.perf_counter() - s.start, self.auth or "denied")
+        return self.auth or None
+
+    @property
+    def partition(self):
+        """The authenticated user's data (the owner's for the API key), loaded on
+        first use and held until partition_middleware releases it."""
+        if self._partition is None:
+            self._partition = partitions.acquire(self.device.get("email") if self.device else None)
+        return self._partition
+
+class Route:
+    __slots__ = ("method", "pattern", "handler", "auth", "label")
+
+    def __init__(self, method, pattern, handler, auth):
+        self.method = method
+        self.pattern = pattern
+        self.handler = handler
+        self.auth = auth
+        self.label = pattern  # metric label, bounded by the number of routes
+
+class Router:
+    """Route table with O(1) lookups.
+
+    Exact paths are a dict lookup on (method, path). Parameterised routes such
+    as "/context/{file}" are keyed by their first path segment, so
+    "/context/CLAUDE.md" is one more dict lookup on (method, "/context/") and
+    the rest of the path is handed to the handler as ctx.path_arg. Lookup cost
+    does not grow with the number of routes.
+    """
+
+    def __init__(self):
+        self.exact = {}
+        self.prefix = {}
+
+    def route(self, method, pattern, auth=DEVICE):
+        """Decorator registering a handler method for `pattern`."""
+        def register(handler):
+            route = Route(method, pattern, handler, auth)
+            if "{" in pattern:
+                prefix = pattern[:pattern.index("{")]
+                if prefix.count("/") != 2 or not prefix.endswith("/"):
+                    raise ValueError(f"parameters must follow the first path segment: {pattern}")
+                self.prefix[(method, prefix)] = route
+            else:
+                self.exact[(method, pattern)] = route
+            return handler
+        return register
+
+    def match(self, method, path):
+        """Return (route, path_arg) or (None, None)."""
+        route = self.exact.get((method, path))
+        if route:
+            return route, None
+        slash = path.find("/", 1)
+        if slash > 0:
+            route = self.prefix.get((method, path[:slash + 1]))
+            if route:
+                return route, path[slash + 1:]
+        return None, None
+
+router = Router()
+
+# -----------------------------------------------------------------------------
+# Middleware: each takes (handler, ctx, call_next) and may short-circuit.
+# -----------------------------------------------------------------------------
+
+def timing_middleware(handler, ctx, call_next):
+    """Request metrics, Server-Timing spans and sampled profiling."""
+    label = ctx.route.label if ctx.route else "unmatched"
+    HTTP_IN_FLIGHT.inc(ctx.method)
+    start = time.perf_counter()
+    begin_trace(start)
+    profile = profiler.start() if label != "/admin/profile" else None
+    try:
+        call_next(handler, ctx)
+    finally:
+        if profile:
+            profiler.finish(profile)
+        end_trace()
+        elapsed = time.perf_counter() - start
+        HTTP_IN_FLIGHT.dec(ctx.method)
+        HTTP_REQUESTS.inc(ctx.method, label, str(handler._status or 0))
+        HTTP_REQUEST_SECONDS.observe(elapsed, ctx.method, label)
+
+def error_middleware(handler, ctx, call_next):
+    """Turn HTTPError into its JSON response and anything else into a 500."""
+    try:
+        call_next(handler, ctx)
+    except HTTPError as e:
+        handler._send_json(e.payload, e.status)
+    except Exception as e:
+        print(f"Error handling {ctx.method} {ctx.path}: {e!r}")
+        if handler._status is None:
+            handler._send_json({"error": "Internal server error"}, 500)
+        else:
+            # The response may be cut short, so the connection can't be reused
+            handler.close_connection = True
+
+def cors_middleware(handler, ctx, call_next):
+    """Add CORS headers to every response and answer preflight requests."""
+    ctx.response_headers.extend((
+        ("Access-Control-Allow-Origin", "*"),
+        ("Access-Control-Allow-Methods", "GET, POST, OPTIONS"),
+        ("Access-Control-Allow-Headers", "Content-Type, Authorization, X-API-Key, If-Match, If-None-Match"),
+        ("Access-Control-Expose-Headers", "ETag"),
+    ))
+    if ctx.method == "OPTIONS":
+        handler._send_bytes(b"", "application/json", 204)
+        return
+    call_next(handler, ctx)
+
+def auth_middleware(handler, ctx, call_next):
+    """Enforce the matched route's auth level."""
+    route = ctx.route
+    if route is None:
+        raise HTTPError(404, "Not found")
+    if route.auth == PUBLIC:
+        pass
+    elif route.auth == SYNC:
+        if not ctx.authenticate():
+            raise HTTPError(401, "Unauthorized", login_url=f"{SERVER_URL}/login")
+    elif ctx.authenticate() != "device_token":
+        raise HTTPError(401, "Unauthorized", login_url=f"{SERVER_URL}/login")
+    elif route.auth == ADMIN and ctx.device.get("email") not in (ADMIN_EMAILS or GMAIL_ACCOUNTS):
+        raise HTTPError(403, "Admin access required")
+    call_next(handler, ctx)
+
+def partition_middleware(handler, ctx, call_next):
+    """Release the user partition the request used, so it can be evicted when idle."""
+    try:
+        call_next(handler, ctx)
+    finally:
+        if ctx._partition is not None:
+            partitions.release(ctx._partition)
+
+def dispatch(handler, ctx):
+    ctx.route.handler(handler, ctx)
+
+MIDDLEWARE = [timing_middleware, error_middleware, cors_middleware, auth_middleware, partition_middleware]
+
+def build_pipeline(middleware, endpoint):
+    """Compose middleware (outermost first) around the endpoint dispatcher."""
+    call = endpoint
+    for mw in reversed(middleware):
+        call = (lambda mw, nxt: lambda handler, ctx: mw(handler, ctx, nxt))(mw, call)
+    return call
+
+pipeline = build_pipeline(MIDDLEWARE, dispatch)
+
+# =============================================================================
+# HTTP Handler
+# =============================================================================
+
+class ChiefOfStaffHandler(BaseHTTPRequestHandler):
+    """One instance per connection. Connections are persistent (HTTP/1.1):
+    every response is framed by Content-Length, idle connections time out
+    after KEEPALIVE_TIMEOUT and each serves at most KEEPALIVE_MAX_REQUESTS."""
+
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+    # Headers and body go out in separate writes; don't let Nagle hold the body
+    disable_nagle_algorithm = True
+    _status = None
+    _served = 0
+    ctx = None
+
+    def _handle(self, method):
+        self._served += 1
+        self._status = None
+        self.ctx = None
+        # Read exactly the request body so the next request on the connection
+        # starts in the right place; if that's impossible, close it afterwards
+        try:
+            if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+                raise ValueError("chunked")
+            content_length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            self.close_connection = True
+            self._send_bytes(b'{"error": "Content-Length required"}', "application/json", 411)
+            return
+        if content_length < 0:
+            self.close_connection = True
+            self._send_bytes(b'{"error": "Invalid Content-Length"}', "application/json", 400)
+            return
+        body = self.rfile.read(content_length) if content_length else b""
+        self.ctx = RequestContext(method, self.path, self.headers, body)
+        self.ctx.route, self.ctx.path_arg = router.match(method, self.ctx.path)
+        pipeline(self, self.ctx)
 
     def do_OPTIONS(self):
-        self._set_headers(204)
+        self._handle("OPTIONS")
 
     def do_GET(self):
-        global tasks_data, notes_data
-        parsed = urlparse(self.path)
-        path = parsed.path
-        params = parse_qs(parsed.query)
-
-        # === PUBLIC ENDPOINTS (no auth required) ===
-
-        # Health check
-        if path == "/health":
-            self._set_headers()
-            self.wfile.write(json.dumps({
-                "status": "ok",
-                "tasks": len(tasks_data.get("tasks", [])),
-                "notes": len(notes_data.get("notes", [])),
-                "gmail_accounts": len([e for e in GMAIL_ACCOUNTS if e]),
-                "devices": len(devices_data.get("devices", []))
-            }).encode())
-            return
+        self._handle("GET")
 
-        # === GOOGLE SIGN-IN FLOW ===
+    def do_POST(self):
+        self._handle("POST")
 
-        # Login page - redirects to Google
-        if path == "/login":
-            # Build Google OAuth URL
-            state = secrets.token_urlsafe(16)
-            oauth_params = {
-                "client_id": GMAIL_CLIENT_ID,
-                "redirect_uri": f"{SERVER_URL}/callback",
-                "response_type": "code",
-                "scope": "openid email profile",
-                "state": state,
-                "access_type": "online",
-                "prompt": "select_account"
-            }
-            google_auth_url = f"https://accounts.google.com/o/oauth2/v2/auth?{urlencode(oauth_params)}"
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
 
-            # Redirect to Google
-            self.send_response(302)
-            self.send_header("Location", google_auth_url)
-            self.end_headers()
-            return
+    def end_headers(self):
+        if self._served >= KEEPALIVE_MAX_REQUESTS or self.close_connection:
+            self.send_header("Connection", "close")
+        else:
+            self.send_header("Keep-Alive", f"timeout={int(KEEPALIVE_TIMEOUT)}, max={KEEPALIVE_MAX_REQUESTS - self._served}")
+        if self.ctx is not None:
+            for name, value in self.ctx.response_headers:
+                self.send_header(name, value)
+        timing = server_timing_header()
+        if timing:
+            self.send_header("Server-Timing", timing)
+        super().end_headers()
+
+    def _send_bytes(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if status != 204:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def _send_file(self, f, size, content_type):
+        """Send an open binary file with sendfile(), bypassing Python buffers."""
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        self.wfile.flush()
+        self.connection.sendfile(f)
+
+    def _send_json(self, data, status=200):
+        """Serialize data and send it as a JSON response."""
+        with span("json") as s:
+            body = json.dumps(data).encode()
+        JSON_SERIALIZE_SECONDS.observe(time.perf_counter() - s.start,
+                                       self.ctx.route.label if self.ctx and self.ctx.route else "unmatched")
+        self._send_bytes(body, "application/json", status)
+
+    def _send_html(self, html, status=200):
+        """Send an HTML page."""
+        self._send_bytes(html.encode(), "text/html; charset=utf-8", status)
+
+    def _redirect(self, location):
+        self.send_response(302)
+        self.send_header("Location", location)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
 
-        # Auth services - Gmail + Calendar OAuth (uses same /callback endpoint)
-        if path == "/auth/services":
-            # Build Google OAuth URL with Gmail + Calendar scopes
-            state = "services_" + secrets.token_urlsafe(16)
-            oauth_params = {
-                "client_id": GMAIL_CLIENT_ID,
-                "redirect_uri": f"{SERVER_URL}/callback",  # Use same callback
-                "response_type": "code",
-                "scope": "openid email profile https://www.googleapis.com/auth/gmail.readonly https://www.googleapis.com/auth/calendar.readonly",
-                "state": state,
-                "access_type": "offline",
-                "prompt": "consent"  # Force consent to get refresh token
-            }
-            google_auth_url = f"https://accounts.google.com/o/oauth2/v2/auth?{urlencode(oauth_params)}"
+    # === PUBLIC ENDPOINTS (no auth required) ===
 
-            # Redirect to Google
-            self.send_response(302)
-            self.send_header("Location", google_auth_url)
-            self.end_headers()
-            return
+    @router.route("GET", "/health", auth=PUBLIC)
+    def get_health(self, ctx):
+        owner = partitions.acquire()
+        try:
+            tasks, notes = len(owner.tasks), len(owner.notes)
+        finally:
+            partitions.release(owner)
+        self._send_json({
+            "status": "ok",
+            "tasks": tasks,
+            "notes": notes,
+            "partitions": len(partitions),
+            "gmail_accounts": len([e for e in GMAIL_ACCOUNTS if e]),
+            "devices": len(devices_data.get("devices", []))
+        })
+
+    # === GOOGLE SIGN-IN FLOW ===
+
+    @router.route("GET", "/login", auth=PUBLIC)
+    def get_login(self, ctx):
+        """Login page - redirects to Google."""
+        state = secrets.token_urlsafe(16)
+        oauth_params = {
+            "client_id": GMAIL_CLIENT_ID,
+            "redirect_uri": f"{SERVER_URL}/callback",
+            "response_type": "code",
+            "scope": "openid email profile",
+            "state": state,
+            "access_type": "online",
+            "prompt": "select_account"
+        }
+        self._redirect(f"https://accounts.google.com/o/oauth2/v2/auth?{urlencode(oauth_params)}")
 
-        # OAuth callback from Google
-        if path == "/callback":
-            code = params.get("code", [None])[0]
-            error = params.get("error", [None])[0]
-            state = params.get("state", [""])[0]
-            is_services_auth = state.startswith("services_")
+    @router.route("GET", "/auth/services", auth=PUBLIC)
+    def get_auth_services(self, ctx):
+        """Gmail + Calendar OAuth (uses the same /callback endpoint)."""
+        state = "services_" + secrets.token_urlsafe(16)
+        oauth_params = {
+            "client_id": GMAIL_CLIENT_ID,
+            "redirect_uri": f"{SERVER_URL}/callback",  # Use same callback
+            "response_type": "code",
+            "scope": "openid email profile https://www.googleapis.com/auth/gmail.readonly https://www.googleapis.com/auth/calendar.readonly",
+            "state": state,
+            "access_type": "offline",
+            "prompt": "consent"  # Force consent to get refresh token
+        }
+        self._redirect(f"https://accounts.google.com/o/oauth2/v2/auth?{urlencode(oauth_params)}")
+
+    @router.route("GET", "/callback", auth=PUBLIC)
+    def get_callback(self, ctx):
+        """OAuth callback from Google."""
+        code = ctx.param("code")
+        error = ctx.param("error")
+        state = ctx.param("state", "")
+        is_services_auth = state.startswith("services_")
+
+        if error:
+            self._send_html(f"<h1>Login Failed</h1><p>{error}</p>", 400)
+            return
 
-            if error:
-                self._set_html_headers(400)
-                self.wfile.write(f"<h1>Login Failed</h1><p>{error}</p>".encode())
-                return
+        if not code:
+            self._send_html("<h1>Login Failed</h1><p>No authorization code received</p>", 400)
+            return
 
-            if not code:
-                self._set_html_headers(400)
-                self.wfile.write(b"<h1>Login Failed</h1><p>No authorization code received</p>")
+        try:
+            # Exchange code for tokens
+            import urllib.request
+            token_data = urlencode({
+                "code": code,
+                "client_id": GMAIL_CLIENT_ID,
+                "client_secret": GMAIL_CLIENT_SECRET,
+                "redirect_uri": f"{SERVER_URL}/callback",
+                "grant_type": "authorization_code"
+            }).encode()
+
+            req = urllib.request.Request(
+                "https://oauth2.googleapis.com/token",
+                data=token_data,
+                headers={"Content-Type": "application/x-www-form-urlencoded"}
+            )
+            with urllib.request.urlopen(req) as response:
+                token_response = json.loads(response.read())
+
+            # Verify the ID token and get user info
+            google = google_libs()
+            id_info = google.id_token.verify_oauth2_token(
+                token_response["id_token"],
+                google.Request(),
+                GMAIL_CLIENT_ID
+            )
+
+            user_email = id_info.get("email", "")
+            user_name = id_info.get("name", "Unknown")
+
+            # Check if user is allowed (must be one of the Gmail accounts)
+            if user_email not in GMAIL_ACCOUNTS:
+                self._send_html(f"""
+                <html><head><title>Access Denied</title>
+                <style>body {{ font-family: -apple-system, sans-serif; padding: 40px; max-width: 500px; margin: 0 auto; }}</style>
+                </head><body>
+                <h1>Access Denied</h1>
+                <p>Email <strong>{user_email}</strong> is not authorized.</p>
+                <p>Allowed accounts: {', '.join(GMAIL_ACCOUNTS)}</p>
+                <p><a href="/login">Try another account</a></p>
+                </body></html>
+                """, 403)
                 return
 
-            try:
-                # Exchange code for tokens
-                import urllib.request
-                token_data = urlencode({
-                    "code": code,
+            # Handle services auth (Gmail + Calendar OAuth tokens)
+            if is_services_auth:
+                # Save the OAuth token for Gmail/Calendar access
+                token_to_save = {
+                    "token": token_response.get("access_token"),
+                    "refresh_token": token_response.get("refresh_token"),
+                    "token_uri": "https://oauth2.googleapis.com/token",
                     "client_id": GMAIL_CLIENT_ID,
                     "client_secret": GMAIL_CLIENT_SECRET,
-                    "redirect_uri": f"{SERVER_URL}/callback",
-                    "grant_type": "authorization_code"
-                }).encode()
-
-                req = urllib.request.Request(
-                    "https://oauth2.googleapis.com/token",
-                    data=token_data,
-                    headers={"Content-Type": "application/x-www-form-urlencoded"}
-                )
-                with urllib.request.urlopen(req) as response:
-                    token_response = json.loads(response.read())
-
-                # Verify the ID token and get user info
-                id_info = id_token.verify_oauth2_token(
-                    token_response["id_token"],
-                    google_requests.Request(),
-                    GMAIL_CLIENT_ID
-                )
-
-                user_email = id_info.get("email", "")
-                user_name = id_info.get("name", "Unknown")
-
-                # Check if user is allowed (must be one of the Gmail accounts)
-                if user_email not in GMAIL_ACCOUNTS:
-                    self._set_html_headers(403)
-                    self.wfile.write(f"""
-                    <html><head><title>Access Denied</title>
-                    <style>body {{ font-family: -apple-system, sans-serif; padding: 40px; max-width: 500px; margin: 0 auto; }}</style>
-                    </head><body>
-                    <h1>Access Denied</h1>
-                    <p>Email <strong>{user_email}</strong> is not authorized.</p>
-                    <p>Allowed accounts: {', '.join(GMAIL_ACCOUNTS)}</p>
-                    <p><a href="/login">Try another account</a></p>
-                    </body></html>
-                    """.encode())
-                    return
+                    "scopes": SCOPES,
+                    "account": user_email
+                }
 
-                # Handle services auth (Gmail + Calendar OAuth tokens)
-                if is_services_auth:
-                    # Save the OAuth token for Gmail/Calendar access
-                    token_to_save = {
-                        "token": token_response.get("access_token"),
-                        "refresh_token": token_response.get("refresh_token"),
-                        "token_uri": "https://oauth2.googleapis.com/token",
-                        "client_id": GMAIL_CLIENT_ID,
-                        "client_secret": GMAIL_CLIENT_SECRET,
-                        "scopes": SCOPES,
-                        "account": user_email
-                    }
-
-                    token_file = get_token_file(user_email)
-                    with open(token_file, 'w') as f:
-                        json.dump(token_to_save, f)
-
-                    # Clear cached services to reload with new token
-                    if user_email in gmail_services:
-                        del gmail_services[user_email]
-                    if user_email in calendar_services:
-                        del calendar_services[user_email]
-
-                    self._set_html_headers()
-                    self.wfile.write(f"""
-                    <html><head><title>Services Connected</title>
-                    <meta name="viewport" content="width=device-width, initial-scale=1">
-                    <style>
-                        body {{ font-family: -apple-system, sans-serif; padding: 40px; max-width: 500px; margin: 0 auto; background: #f5f5f5; }}
-                        .card {{ background: white; padding: 30px; border-radius: 12px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
-                        h1 {{ color: #34a853; margin-top: 0; }}
-                        .check {{ font-size: 48px; text-align: center; }}
-                        .next {{ margin-top: 20px; padding: 15px; background: #e8f5e9; border-radius: 8px; }}
-                    </style>
-                    </head><body>
-                    <div class="card">
-                        <div class="check">✅</div>
-                        <h1>Gmail + Kalender verbunden!</h1>
-                        <p><strong>{user_email}</strong></p>
-                        <div class="next">
-                            <p>Nächster Account? <a href="/auth/services">Weiteren Account verbinden</a></p>
-                        </div>
-                        <p style="color: #666; margin-top: 20px;">Du kannst dieses Fenster schließen wenn alle Accounts verbunden sind.</p>
-                    </div>
-                    </body></html>
-                    """.encode())
-                    return
+                token_file = get_token_file(user_email)
+                atomic_write(token_file, json.dumps(token_to_save).encode())
 
-                # Normal login - Create device token
-                device_name = params.get("device", ["Web Browser"])[0]
-                device_token = create_device(user_email, device_name)
+                # Clear cached services to reload with new token
+                if user_email in gmail_services:
+                    del gmail_services[user_email]
+                if user_email in calendar_services:
+                    del calendar_services[user_email]
 
-                # Show success page with token
-                self._set_html_headers()
-                self.wfile.write(f"""
-                <html><head><title>Login Successful</title>
+                self._send_html(f"""
+                <html><head><title>Services Connected</title>
                 <meta name="viewport" content="width=device-width, initial-scale=1">
                 <style>
-                    body {{ font-family: -apple-system, BlinkMacSystemFont, sans-serif; padding: 40px; max-width: 500px; margin: 0 auto; background: #f5f5f5; }}
+                    body {{ font-family: -apple-system, sans-serif; padding: 40px; max-width: 500px; margin: 0 auto; background: #f5f5f5; }}
                     .card {{ background: white; padding: 30px; border-radius: 12px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
-                    h1 {{ color: #1a73e8; margin-top: 0; }}
-                    .token {{ background: #f0f0f0; padding: 15px; border-radius: 8px; word-break: break-all; font-family: monospace; font-size: 12px; margin: 20px 0; }}
-                    .copy-btn {{ background: #1a73e8; color: white; border: none; padding: 12px 24px; border-radius: 6px; font-size: 16px; cursor: pointer; width: 100%; }}
-                    .copy-btn:hover {{ background: #1557b0; }}
-                    .info {{ color: #666; font-size: 14px; margin-top: 20px; }}
+                    h1 {{ color: #34a853; margin-top: 0; }}
+                    .check {{ font-size: 48px; text-align: center; }}
+                    .next {{ margin-top: 20px; padding: 15px; background: #e8f5e9; border-radius: 8px; }}
                 </style>
                 </head><body>
                 <div class="card">
-                    <h1>Welcome, {user_name}!</h1>
-                    <p>Your device token (valid for 90 days):</p>
-                    <div class="token" id="token">{device_token}</div>
-                    <button class="copy-btn" onclick="navigator.clipboard.writeText('{device_token}').then(() => this.textContent = 'Copied!')">
-                        Copy Token
-                    </button>
-                    <p class="info">
-                        Use this token with Claude:<br>
-                        <code>?token=YOUR_TOKEN</code>
-                    </p>
+                    <div class="check">✅</div>
+                    <h1>Gmail + Kalender verbunden!</h1>
+                    <p><strong>{user_email}</strong></p>
+                    <div class="next">
+                        <p>Nächster Account? <a href="/auth/services">Weiteren Account verbinden</a></p>
+                    </div>
+                    <p style="color: #666; margin-top: 20px;">Du kannst dieses Fenster schließen wenn alle Accounts verbunden sind.</p>
                 </div>
                 </body></html>
-                """.encode())
+                """)
                 return
 
-            except Exception as e:
-                self._set_html_headers(500)
-                self.wfile.write(f"<h1>Login Error</h1><p>{str(e)}</p>".encode())
-                return
+            # Normal login - Create device token
+            device_name = ctx.param("device", "Web Browser")
+            device_token = create_device(user_email, device_name)
+
+            # Show success page with token
+            self._send_html(f"""
+            <html><head><title>Login Successful</title>
+            <meta name="viewport" content="width=device-width, initial-scale=1">
+            <style>
+                body {{ font-family: -apple-system, BlinkMacSystemFont, sans-serif; padding: 40px; max-width: 500px; margin: 0 auto; background: #f5f5f5; }}
+                .card {{ background: white; padding: 30px; border-radius: 12px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
+                h1 {{ color: #1a73e8; margin-top: 0; }}
+                .token {{ background: #f0f0f0; padding: 15px; border-radius: 8px; word-break: break-all; font-family: monospace; font-size: 12px; margin: 20px 0; }}
+                .copy-btn {{ background: #1a73e8; color: white; border: none; padding: 12px 24px; border-radius: 6px; font-size: 16px; cursor: pointer; width: 100%; }}
+                .copy-btn:hover {{ background: #1557b0; }}
+                .info {{ color: #666; font-size: 14px; margin-top: 20px; }}
+            </style>
+            </head><body>
+            <div class="card">
+                <h1>Welcome, {user_name}!</h1>
+                <p>Your device token (valid for 90 days):</p>
+                <div class="token" id="token">{device_token}</div>
+                <button class="copy-btn" onclick="navigator.clipboard.writeText('{device_token}').then(() => this.textContent = 'Copied!')">
+                    Copy Token
+                </button>
+                <p class="info">
+                    Use this token with Claude:<br>
+                    <code>?token=YOUR_TOKEN</code>
+                </p>
+            </div>
+            </body></html>
+            """)
+            return
+
+        except Exception as e:
+            self._send_html(f"<h1>Login Error</h1><p>{str(e)}</p>", 500)
+            return
 
-        # Auth status - check if a token is valid
-        if path == "/auth/status":
-            token = params.get("token", [None])[0]
-            device = validate_device_token(token) if token else None
-            self._set_headers()
-            if device:
-                self.wfile.write(json.dumps({
-                    "authenticated": True,
-                    "email": device.get("email"),
-                    "device": device.get("device_name"),
-                    "expires_at": device.get("expires_at")
-                }).encode())
+    @router.route("GET", "/auth/status", auth=PUBLIC)
+    def get_auth_status(self, ctx):
+        """Check if a token is valid."""
+        ctx.authenticate()
+        device = ctx.device
+        if device:
+            entry = _devices_by_id.get(device_id(device), device)
+            self._send_json({
+                "authenticated": True,
+                "email": device.get("email"),
+                "device": entry.get("device_name"),
+                "expires_at": device.get("expires_at")
+            })
+        else:
+            self._send_json({"authenticated": False})
+
+    # === OBSERVABILITY ===
+
+    @router.route("GET", "/metrics", auth=SYNC)
+    def get_metrics(self, ctx):
+        """Prometheus scrape endpoint (API key allowed so scrapers need no device token)."""
+        self._send_bytes(render_metrics().encode(), "text/plain; version=0.0.4; charset=utf-8")
+
+    @router.route("GET", "/admin/devices", auth=ADMIN)
+    def get_admin_devices(self, ctx):
+        devices = [{
+            "id": device_id(d),
+            "email": d.get("email"),
+            "device_name": d.get("device_name"),
+            "format": "signed" if d.get("device_id") else "opaque",
+            "created_at": d.get("created_at"),
+            "expires_at": d.get("expires_at"),
+            "last_used": d.get("last_used"),
+        } for d in devices_data.get("devices", [])]
+        self._send_json({"devices": devices, "revoked": len(token_signer.revocations) if token_signer else 0})
+
+    @router.route("POST", "/admin/devices/revoke", auth=ADMIN)
+    def post_admin_devices_revoke(self, ctx):
+        data = ctx.json()
+        id = data.get("id") if isinstance(data, dict) else None
+        if not id or not isinstance(id, str):
+            raise HTTPError(400, "Missing id")
+        device = revoke_device(id)
+        if device is None:
+            raise HTTPError(404, f"No device {id}")
+        self._send_json({"success": True, "id": id, "email": device.get("email")})
+
+    @router.route("GET", "/admin/profile", auth=ADMIN)
+    def get_admin_profile(self, ctx):
+        """Aggregated stats from the sampled profiler (see POST /admin/profile)."""
+        self._send_json(profiler.report(
+            sort=ctx.param("sort", "cumulative"),
+            limit=ctx.int_param("limit", 40)
+        ))
+
+    @router.route("POST", "/admin/profile", auth=ADMIN)
+    def post_admin_profile(self, ctx):
+        """Profile the next N requests: POST /admin/profile?requests=50&sample=0.5"""
+        requests = ctx.int_param("requests", 20)
+        try:
+            sample_rate = float(ctx.param("sample", 1.0))
+        except ValueError:
+            raise HTTPError(400, "sample must be a number")
+        profiler.arm(requests, sample_rate)
+        self._send_json({"success": True, "requests": profiler.remaining, "sample_rate": profiler.sample_rate})
+
+    # === TASKS ===
+
+    @router.route("GET", "/tasks")
+    def get_tasks(self, ctx):
+        self._send_bytes(ctx.partition.tasks.columns.json_rows(key="all"), "application/json")
+
+    @router.route("GET", "/tasks/open")
+    def get_tasks_open(self, ctx):
+        columns = ctx.partition.tasks.columns
+        with span("json"):
+            body = columns.json_rows(columns.open_rows, key="open")
+        self._send_bytes(body, "application/json")
+
+    @router.route("GET", "/tasks/today")
+    def get_tasks_today(self, ctx):
+        limit = ctx.int_param("limit", None)
+        if limit is not None and limit < 0:
+            raise HTTPError(400, "limit must not be negative")
+        body = ctx.partition.tasks.today_json(datetime.now().timestamp(), limit)
+        self._send_bytes(body, "application/json")
+
+    @router.route("POST", "/tasks", auth=SYNC)
+    def post_tasks(self, ctx):
+        tasks, synced_at = ctx.sync_body("tasks")
+        partition = ctx.partition
+        partition.sync_tasks(tasks, synced_at)
+        self._send_json({
+            "success": True,
+            "count": len(partition.tasks)
+        })
+        print(f"Received {len(partition.tasks)} tasks for {partition.email or 'owner'}")
+
+    # === NOTES ===
+
+    @router.route("GET", "/notes")
+    def get_notes(self, ctx):
+        """All notes, or those matching ?type=, ?tag= (repeatable, all must match)
+        and ?updated_since= (epoch ms or ISO 8601). ?fields=uuid,name returns
+        only those fields of each note."""
+        columns = ctx.partition.notes.columns
+        kind, tags, since = ctx.param("type"), ctx.params.get("tag", []), ctx.param("updated_since")
+        fields = [f for f in ctx.param("fields", "").split(",") if f] or None
+        updated_since = _note_time(since)
+        if since is not None and updated_since is None:
+            raise HTTPError(400, "updated_since must be epoch milliseconds or an ISO 8601 time")
+        with span("filter"):
+            rows = columns.query(kind, tags, updated_since)
+        with span("json"):
+            if kind is None and not tags and since is None and fields is None:
+                body = columns.json_rows(key="all")
+            else:
+                body = columns.json_rows(rows, fields=fields)
+        self._send_bytes(body, "application/json")
+
+    @router.route("GET", "/notes/werkbank")
+    def get_notes_werkbank(self, ctx):
+        columns = ctx.partition.notes.columns
+        self._send_bytes(columns.json_rows(columns.by_type.get("werkbank", []), key="werkbank"), "application/json")
+
+    @router.route("GET", "/notes/projects")
+    def get_notes_projects(self, ctx):
+        columns = ctx.partition.notes.columns
+        self._send_bytes(columns.json_rows(columns.by_type.get("project", []), key="project"), "application/json")
+
+    @router.route("POST", "/notes", auth=SYNC)
+    def post_notes(self, ctx):
+        notes, synced_at = ctx.sync_body("notes")
+        partition = ctx.partition
+        partition.sync_notes(notes, synced_at)
+        self._send_json({
+            "success": True,
+            "count": len(partition.notes)
+        })
+        print(f"Received {len(partition.notes)} notes for {partition.email or 'owner'}")
+
+    # === CONTEXT (MD Files) ===
+
+    @router.route("GET", "/context")
+    def get_context(self, ctx):
+        self._send_json(ctx.partition.context.as_dict())
+
+    @router.route("GET", "/context/{file}")
+    def get_context_file(self, ctx):
+        """Get specific file: /context/CLAUDE.md
+
+        ?version=N reads an older version, ?since=N returns the edits after
+        version N (or the full content if they were compacted away).
+        ?section=, ?lines=, ?bytes= and ?index=1 read part of it (see
+        _send_context_slice). ?raw=1 (or Accept: text/markdown) sends plain text.
+        The version is the ETag; If-None-Match answers 304.
+        """
+        filename = ctx.path_arg
+        context_store = ctx.partition.context
+        info = context_store.info(filename)
+        if info is None:
+            raise HTTPError(404, f"File not found: {filename}", available=context_store.names())
+        current = info["version"]
+
+        since = ctx.int_param("since", None)
+        if since is not None:
+            ctx.response_headers.append(("ETag", f'"{current}"'))
+            changes = context_store.changes_since(filename, since)
+            if changes is None:
+                self._send_json({"filename": filename, "version": current, "full": True,
+                                 "content": context_store.get(filename), "syncedAt": context_store.synced_at})
             else:
-                self.wfile.write(json.dumps({"authenticated": False}).encode())
+                self._send_json({"filename": filename, "version": current, "changes": changes})
+            return
+
+        version = ctx.int_param("version", current)
+        if any(ctx.param(name) for name in ("index", "section", "lines", "bytes")):
+            self._send_context_slice(ctx, filename, version, current)
+            return
+        ctx.response_headers.append(("ETag", f'"{version}"'))
+        if self._not_modified(ctx, version):
+            return
+        raw = ctx.param("raw") == "1" or "text/markdown" in ctx.headers.get("Accept", "")
+
+        if version == current:
+            if raw:
+                f = context_store.open_snapshot(filename)
+                if f is not None:
+                    with f:
+                        self._send_file(f, os.fstat(f.fileno()).st_size, "text/markdown; charset=utf-8")
+                    return
+                self._send_bytes(context_store.get(filename).encode(), "text/markdown; charset=utf-8")
+                return
+            body = b"".join([
+                b'{"filename": ', json.dumps(filename).encode(),
+                b', "version": ', str(current).encode(),
+                b', "content": ', context_store.get_json(filename),
+                b', "syncedAt": ', json.dumps(context_store.synced_at).encode(), b"}",
+            ])
+            self._send_bytes(body, "application/json")
             return
 
-        # === PROTECTED ENDPOINTS (auth required) ===
+        version, content, _ = self._context_view(context_store, filename, version, current)
+        if raw:
+            self._send_bytes(content.encode(), "text/markdown; charset=utf-8")
+        else:
+            self._send_json({"filename": filename, "version": version, "content": content,
+                             "latestVersion": current})
+
+    def _context_view(self, context_store, filename, version, current):
+        try:
+            return context_store.view(filename, version)
+        except VersionGone as e:
+            raise HTTPError(410, f"Version {version} was compacted", oldest=e.oldest, version=current)
+        except KeyError:
+            raise HTTPError(404, f"No version {version} of {filename}", version=current)
+
+    def _not_modified(self, ctx, tag):
+        """Answer 304 if If-None-Match names `tag` (a version or slice tag)."""
+        try:
+            if parse_etag(ctx.headers.get("If-None-Match")) != tag:
+                return False
+        except ValueError:
+            return False
+        self.send_response(304)
+        self.end_headers()
+        return True
+
+    def _send_context_slice(self, ctx, filename, version, current):
+        """Partial reads: ?index=1 lists the headings, ?section=Path, ?lines=a-b
+        or ?bytes=a-b (inclusive) return one slice with its own ETag."""
+        version, content, index = self._context_view(ctx.partition.context, filename, version, current)
+        result = {"filename": filename, "version": version}
+        if ctx.param("index") == "1":
+            ctx.response_headers.append(("ETag", f'"{version}"'))
+            result["sections"] = [index.describe(s) for s in index.sections]
+            self._send_json(result)
+            return
 
-        if not self._check_auth():
-            self._set_headers(401)
-            self.wfile.write(json.dumps({
-                "error": "Unauthorized",
-                "login_url": f"{SERVER_URL}/login"
-            }).encode())
+        path, lines, byte_range = ctx.param("section"), ctx.range_param("lines"), ctx.range_param("bytes")
+        if path:
+            section = index.find(path)
+            if section is None:
+                raise HTTPError(404, f"No section {path} in {filename}",
+                                sections=["/".join(s["path"]) for s in index.sections])
+            start, end = index.section_span(section)
+            data = content[start:end].encode("utf-8")
+            result["section"] = index.describe(section)
+        elif lines:
+            try:
+                start, end = index.line_span(*lines)
+            except ValueError as e:
+                raise HTTPError(416, str(e))
+            data = content[start:end].encode("utf-8")
+            result["lines"] = [lines[0], min(lines[1] or index.line_count, index.line_count)]
+        else:
+            encoded = content.encode("utf-8")
+            first, last = byte_range
+            last = len(encoded) - 1 if last is None else min(last, len(encoded) - 1)
+            if first < 0 or first > last + 1:
+                raise HTTPError(416, f"bytes {first}-{last} out of range (0-{len(encoded) - 1})")
+            data = encoded[first:last + 1]
+            result["bytes"] = [first, last]
+
+        text = data.decode("utf-8", errors="ignore")
+        etag = slice_etag(text)
+        ctx.response_headers.append(("ETag", etag))
+        if self._not_modified(ctx, etag.strip('"')):
+            return
+        if ctx.param("raw") == "1" or "text/markdown" in ctx.headers.get("Accept", ""):
+            self._send_bytes(data, "text/markdown; charset=utf-8")
             return
+        result["content"] = text
+        self._send_json(result)
+
+    @router.route("POST", "/context", auth=SYNC)
+    def post_context(self, ctx):
+        """Receive context files (MD files from local machine)."""
+        data = ctx.json()
+        files = data.get("files", {}) if isinstance(data, dict) else None
+        if not isinstance(files, dict) or not all(isinstance(text, str) for text in files.values()):
+            raise HTTPError(400, "files must map file names to strings")
+        context_store = ctx.partition.context
+        context_store.replace_all(files, data.get("syncedAt"))
+        self._send_json({
+            "success": True,
+            "files": context_store.names()
+        })
+        print(f"Received context files: {context_store.names()}")
+
+    @router.route("POST", "/context/{file}")
+    def post_context_file(self, ctx):
+        """Update a single context file: POST /context/CLAUDE.md (device token only).
+
+        Send If-Match: "<version>" to reject the write (412) if someone else
+        changed the file since that version.
+
+        With ?section=Path only that section's body is replaced ({"content"})
+        or extended ({"append"}); If-Match may then also be the section's ETag,
+        so edits to other sections don't conflict.
+        """
+        filename = ctx.path_arg
+        if not filename.endswith(".md"):
+            raise HTTPError(400, "Only .md files allowed")
+
+        data = ctx.json()
+        if not isinstance(data, dict):
+            raise HTTPError(400, "Body must be a JSON object")
+        path = ctx.param("section")
+        content = data.get("content")
+        if content is None and not (path and data.get("append") is not None):
+            raise HTTPError(400, "Missing content")
+        if content is not None and not isinstance(content, str):
+            raise HTTPError(400, "content must be a string")
+        if content is None and not isinstance(data["append"], str):
+            raise HTTPError(400, "append must be a string")
 
-        # === TASKS ===
-        if path == "/tasks":
-            self._set_headers()
-            self.wfile.write(json.dumps(tasks_data).encode())
-
-        elif path == "/tasks/open":
-            open_tasks = [t for t in tasks_data.get("tasks", [])
-                         if not t.get("completedAt") and not t.get("dismissedAt")]
-            self._set_headers()
-            self.wfile.write(json.dumps({
-                "tasks": open_tasks,
-                "syncedAt": tasks_data.get("syncedAt")
-            }).encode())
-
-        elif path == "/tasks/today":
-            now = datetime.now().timestamp()
-            today_tasks = [t for t in tasks_data.get("tasks", [])
-                          if not t.get("completedAt")
-                          and not t.get("dismissedAt")
-                          and (not t.get("startAt") or t.get("startAt") <= now)
-                          and (not t.get("hideUntil") or t.get("hideUntil") <= now)]
-            today_tasks.sort(key=lambda t: t.get("score", 0), reverse=True)
-            self._set_headers()
-            self.wfile.write(json.dumps({
-                "tasks": today_tasks,
-                "syncedAt": tasks_data.get("syncedAt")
-            }).encode())
-
-        # === NOTES ===
-        elif path == "/notes":
-            self._set_headers()
-            self.wfile.write(json.dumps(notes_data).encode())
-
-        elif path == "/notes/werkbank":
-            werkbank = [n for n in notes_data.get("notes", []) if n.get("type") == "werkbank"]
-            self._set_headers()
-            self.wfile.write(json.dumps({
-                "notes": werkbank,
-                "syncedAt": notes_data.get("syncedAt")
-            }).encode())
-
-        elif path == "/notes/projects":
-            projects = [n for n in notes_data.get("notes", []) if n.get("type") == "project"]
-            self._set_headers()
-            self.wfile.write(json.dumps({
-                "notes": projects,
-                "syncedAt": notes_data.get("syncedAt")
-            }).encode())
-
-        # === CONTEXT (MD Files) ===
-        elif path == "/context":
-            self._set_headers()
-            self.wfile.write(json.dumps(context_data).encode())
-
-        elif path.startswith("/context/"):
-            # Get specific file: /context/CLAUDE.md
-            filename = path.replace("/context/", "")
-            files = context_data.get("files", {})
-            if filename in files:
-                self._set_headers()
-                self.wfile.write(json.dumps({
-                    "filename": filename,
-                    "content": files[filename],
-                    "syncedAt": context_data.get("syncedAt")
-                }).encode())
+        try:
+            expected = parse_etag(ctx.headers.get("If-Match"))
+        except ValueError:
+            raise HTTPError(400, "If-Match must be an ETag")
+        context_store = ctx.partition.context
+        try:
+            if path:
+                append = content is None
+                info = context_store.patch_section(filename, path, data["append"] if append else content,
+                                                   append=append, expected=expected)
+            elif isinstance(expected, str) and expected != "*":
+                raise HTTPError(400, "Whole-file writes need a version ETag in If-Match")
             else:
-                self._set_headers(404)
-                self.wfile.write(json.dumps({
-                    "error": f"File not found: {filename}",
-                    "available": list(files.keys())
-                }).encode())
-
-        # === GMAIL ===
-        elif path == "/emails/unread":
-            all_emails = []
-            for email in GMAIL_ACCOUNTS:
-                if email:
-                    all_emails.extend(fetch_emails(email, max_results=10, query="is:unread"))
-            all_emails.sort(key=lambda x: x.get('date', ''), reverse=True)
-            self._set_headers()
-            self.wfile.write(json.dumps({
-                "emails": all_emails,
-                "fetchedAt": datetime.now().isoformat()
-            }).encode())
-
-        elif path == "/emails/recent":
-            all_emails = []
-            for email in GMAIL_ACCOUNTS:
-                if email:
-                    all_emails.extend(fetch_emails(email, max_results=20, query="", hours_back=24))
-            all_emails.sort(key=lambda x: x.get('date', ''), reverse=True)
-            self._set_headers()
-            self.wfile.write(json.dumps({
-                "emails": all_emails,
-                "fetchedAt": datetime.now().isoformat()
-            }).encode())
-
-        elif path == "/gmail/status":
-            status = {}
-            for email in GMAIL_ACCOUNTS:
-                if email:
-                    token_file = get_token_file(email)
-                    status[email] = "authenticated" if os.path.exists(token_file) else "not_authenticated"
-            self._set_headers()
-            self.wfile.write(json.dumps(status).encode())
-
-        # === CALENDAR ===
-        elif path == "/calendar/today":
-            all_events = []
-            for email in GMAIL_ACCOUNTS:
-                if email:
-                    all_events.extend(fetch_todays_events(email))
+                info = context_store.put(filename, content, expected=expected)
+        except VersionConflict as e:
+            raise HTTPError(412, "Version conflict", version=e.version)
+        except KeyError:
+            raise HTTPError(404, f"No section {path} in {filename}" if filename in context_store
+                            else f"File not found: {filename}")
+
+        ctx.response_headers.append(("ETag", f'"{info["version"]}"'))
+        result = {
+            "success": True,
+            "file": filename,
+            "version": info["version"],
+            "updatedAt": info["updatedAt"]
+        }
+        if path:
+            result["section"] = path
+            result["sectionEtag"] = info["etag"]
+        self._send_json(result)
+        print(f"Updated context file: {filename}")
+
+    # === GMAIL ===
+
+    @router.route("GET", "/emails/unread")
+    def get_emails_unread(self, ctx):
+        all_emails = []
+        for email in GMAIL_ACCOUNTS:
+            if email:
+                all_emails.extend(fetch_emails(email, max_results=10, query="is:unread"))
+        with span("sort"):
+            all_emails.sort(key=email_order, reverse=True)
+        self._send_json({
+            "emails": all_emails,
+            "fetchedAt": datetime.now().isoformat()
+        })
+
+    @router.route("GET", "/emails/recent")
+    def get_emails_recent(self, ctx):
+        all_emails = []
+        for email in GMAIL_ACCOUNTS:
+            if email:
+                all_emails.extend(fetch_emails(email, max_results=20, query="", hours_back=24))
+        with span("sort"):
+            all_emails.sort(key=email_order, reverse=True)
+        self._send_json({
+            "emails": all_emails,
+            "fetchedAt": datetime.now().isoformat()
+        })
+
+    @router.route("GET", "/emails/digest")
+    def get_emails_digest(self, ctx):
+        """Unread mail of all accounts, deduplicated and grouped:
+        ?limit= messages (default 50), ?groups= conversations and senders (default 10)."""
+        limit = ctx.int_param("limit", 50)
+        groups = ctx.int_param("groups", 10)
+        if limit < 0 or groups < 0:
+            raise HTTPError(400, "limit and groups must not be negative")
+        with span("refresh"):
+            mail_digest.refresh([e for e in GMAIL_ACCOUNTS if e])
+        self._send_bytes(mail_digest.body(limit, groups), "application/json")
+
+    @router.route("GET", "/emails/{account}/{id}")
+    def get_email_message(self, ctx):
+        """Full message: /emails/me@example.com/18c2f... -> headers, plain-text
+        body, attachment metadata and current labels."""
+        account, _, msg_id = ctx.path_arg.partition("/")
+        if account not in GMAIL_ACCOUNTS or not msg_id or "/" in msg_id:
+            raise HTTPError(404, "Unknown account or message", accounts=[a for a in GMAIL_ACCOUNTS if a])
+        try:
+            message = fetch_message(account, msg_id)
+        except Exception as e:
+            status = getattr(getattr(e, "resp", None), "status", None)
+            if status == 404:
+                raise HTTPError(404, f"Message not found: {msg_id}")
+            raise HTTPError(502, f"Gmail error: {e}", account=account)
+        if message is None:
+            raise HTTPError(401, f"Not authenticated: {account}", account=account)
+        self._send_json(message)
+
+    @router.route("GET", "/gmail/status")
+    def get_gmail_status(self, ctx):
+        status = {}
+        for email in GMAIL_ACCOUNTS:
+            if email:
+                token_file = get_token_file(email)
+                status[email] = "authenticated" if os.path.exists(token_file) else "not_authenticated"
+        self._send_json(status)
+
+    @router.route("POST", "/gmail/token", auth=SYNC)
+    def post_gmail_token(self, ctx):
+        """Receive OAuth token from local auth flow."""
+        try:
+            data = json.loads(ctx.body)
+            email = data.get("email")
+            token_data = data.get("token")
+        except Exception as e:
+            raise HTTPError(400, str(e))
+        if not (email and token_data):
+            raise HTTPError(400, "Missing email or token")
+        token_file = get_token_file(email)
+        atomic_write(token_file, json.dumps(token_data).encode())
+        # Clear cached service to reload
+        if email in gmail_services:
+            del gmail_services[email]
+        self._send_json({"success": True})
+
+    # === CALENDAR ===
+
+    @router.route("GET", "/calendar/today")
+    def get_calendar_today(self, ctx):
+        all_events = []
+        for email in GMAIL_ACCOUNTS:
+            if email:
+                all_events.extend(fetch_todays_events(email))
+        with span("sort"):
             all_events.sort(key=lambda x: x.get('start', ''))
-            self._set_headers()
-            self.wfile.write(json.dumps({
-                "events": all_events,
-                "date": datetime.now().strftime("%Y-%m-%d"),
-                "fetchedAt": datetime.now().isoformat()
-            }).encode())
-
-        elif path == "/calendar/upcoming":
-            days = int(params.get("days", [7])[0])
-            all_events = []
-            for email in GMAIL_ACCOUNTS:
-                if email:
-                    all_events.extend(fetch_calendar_events(email, days_ahead=days))
+        self._send_json({
+            "events": all_events,
+            "date": datetime.now().strftime("%Y-%m-%d"),
+            "fetchedAt": datetime.now().isoformat()
+        })
+
+    @router.route("GET", "/calendar/upcoming")
+    def get_calendar_upcoming(self, ctx):
+        days = ctx.int_param("days", 7)
+        all_events = []
+        for email in GMAIL_ACCOUNTS:
+            if email:
+                all_events.extend(fetch_calendar_events(email, days_ahead=days))
+        with span("sort"):
             all_events.sort(key=lambda x: x.get('start', ''))
-            self._set_headers()
-            self.wfile.write(json.dumps({
-                "events": all_events,
-                "days_ahead": days,
-                "fetchedAt": datetime.now().isoformat()
-            }).encode())
-
-        elif path == "/calendar/week":
-            all_events = []
-            for email in GMAIL_ACCOUNTS:
-                if email:
-                    all_events.extend(fetch_calendar_events(email, days_ahead=7))
+        self._send_json({
+            "events": all_events,
+            "days_ahead": days,
+            "fetchedAt": datetime.now().isoformat()
+        })
+
+    @router.route("GET", "/calendar/week")
+    def get_calendar_week(self, ctx):
+        all_events = []
+        for email in GMAIL_ACCOUNTS:
+            if email:
+                all_events.extend(fetch_calendar_events(email, days_ahead=7))
+        with span("sort"):
             all_events.sort(key=lambda x: x.get('start', ''))
-            self._set_headers()
-            self.wfile.write(json.dumps({
-                "events": all_events,
-                "fetchedAt": datetime.now().isoformat()
-            }).encode())
-
-        # === HTML BRIEFING PAGE ===
-        elif path == "/briefing":
-            # Get today's tasks
-            now = datetime.now()
-            today_tasks = [t for t in tasks_data.get("tasks", [])
-                          if not t.get("completedAt")
-                          and not t.get("dismissedAt")
-                          and (not t.get("startAt") or t.get("startAt") <= now.timestamp())
-                          and (not t.get("hideUntil") or t.get("hideUntil") <= now.timestamp())]
-            today_tasks.sort(key=lambda t: t.get("score", 0), reverse=True)
-            top_tasks = today_tasks[:10]
-
-            # Get unread emails
-            all_emails = []
-            for email in GMAIL_ACCOUNTS:
-                if email:
-                    all_emails.extend(fetch_emails(email, max_results=10, query="is:unread"))
-            all_emails.sort(key=lambda x: x.get('date', ''), reverse=True)
-
-            # Get context
-            context_files = context_data.get("files", {})
-            claude_md = context_files.get("CLAUDE.md", "")
-
-            # Build HTML
+        self._send_json({
+            "events": all_events,
+            "fetchedAt": datetime.now().isoformat()
+        })
+
+    @router.route("GET", "/calendar/free")
+    def get_calendar_free(self, ctx):
+        tz_name = ctx.param("tz", CALENDAR_TIMEZONE)
+        try:
+            tz = ZoneInfo(tz_name)
+        except (ValueError, LookupError):
+            raise HTTPError(400, f"Unknown timezone: {tz_name}")
+        try:
+            work_hours = parse_work_hours(ctx.param("hours", WORK_HOURS))
+        except ValueError:
+            raise HTTPError(400, "hours must look like 09:00-18:00")
+        try:
+            work_days = parse_work_days(ctx.param("workdays", WORK_DAYS))
+        except ValueError:
+            raise HTTPError(400, "workdays must be ISO weekdays like 1-5 or 1,3,5")
+        days = ctx.int_param("days", 7)
+        duration = ctx.int_param("duration", 30)
+        if not 1 <= days <= 31:
+            raise HTTPError(400, "days must be between 1 and 31")
+        if duration < 1:
+            raise HTTPError(400, "duration must be at least 1 minute")
+
+        # From now (rounded up to 5 minutes) or midnight of ?from=YYYY-MM-DD,
+        # to midnight after the last day
+        now = time.time()
+        first_day = ctx.param("from")
+        if first_day:
+            try:
+                first_day = datetime.strptime(first_day, "%Y-%m-%d").date()
+            except ValueError:
+                raise HTTPError(400, "from must be a date like 2024-01-03")
+            start = datetime.combine(first_day, dtime(0), tz).timestamp()
+        else:
+            first_day = datetime.fromtimestamp(now, tz).date()
+            start = now
+        start = max(start, -(-now // 300) * 300)
+        end = datetime.combine(first_day + timedelta(days=days), dtime(0), tz).timestamp()
+        if end <= start:
+            raise HTTPError(400, "from is in the past")
+
+        intervals = []
+        sources = {}
+        unknown = 0
+        for email in GMAIL_ACCOUNTS:
+            if email:
+                account_intervals, sources[email] = busy_intervals(email, start, end, tz)
+                if account_intervals is None:
+                    unknown += 1
+                else:
+                    intervals.extend(account_intervals)
+        if unknown == len(sources):
+            raise HTTPError(503, "No calendar availability", accounts=sources)
+        with span("filter"):
+            busy = merge_intervals(intervals)
+            slots = free_slots(busy, start, end, tz, work_hours, work_days, duration * 60)
+
+        def iso(ts):
+            return datetime.fromtimestamp(ts, tz).isoformat()
+
+        slots = [{"start": iso(a), "end": iso(b), "minutes": int((b - a) // 60)} for a, b in slots]
+        self._send_json({
+            # With an account unknown, slots are only free on the others' calendars
+            "slots": [] if unknown else slots,
+            "unconfirmedSlots": slots if unknown else [],
+            "busy": [{"start": iso(a), "end": iso(b)} for a, b in busy if b > start and a < end],
+            "from": iso(start),
+            "to": iso(end),
+            "timezone": tz_name,
+            "workingHours": f"{work_hours[0]:%H:%M}-{work_hours[1]:%H:%M}",
+            "workdays": sorted(work_days),
+            "duration": duration,
+            "accounts": sources,
+            "incomplete": unknown > 0,
+            "fetchedAt": datetime.now().isoformat()
+        })
+
+    # === HTML BRIEFING PAGE ===
+
+    @router.route("GET", "/briefing")
+    def get_briefing(self, ctx):
+        # Get today's tasks
+        now = datetime.now()
+        partition = ctx.partition
+        top_tasks = get_today_tasks(partition.tasks, now.timestamp(), limit=10)
+        today_count = partition.tasks.ranker.count(now.timestamp())
+
+        # Get unread emails
+        with span("emails"):
+            mail_digest.refresh([e for e in GMAIL_ACCOUNTS if e])
+            digest = mail_digest.summary(limit=5, groups=3)
+
+        # Get context
+        claude_md = briefing_context(partition.context)
+
+        # Build HTML
+        with span("html"):
             tasks_html = ""
             for i, t in enumerate(top_tasks, 1):
-                score = t.get("score", 0)
+                score = round(t["rank"], 1)
                 content = t.get("content", "")[:80]
                 tasks_html += f'<div class="task"><span class="num">{i}.</span> <span class="score">{score}</span> {content}</div>'
 
             emails_html = ""
-            for e in all_emails[:5]:
+            for e in digest["emails"]:
                 sender = e.get("from", "")[:30]
                 subject = e.get("subject", "")[:50]
-                if "error" not in e:
-                    emails_html += f'<div class="email"><b>{sender}</b><br>{subject}</div>'
-
-            self._set_html_headers()
-            self.wfile.write(f"""
+                when = datetime.fromtimestamp(e["timestamp"] / 1000).strftime("%H:%M") if e["timestamp"] else ""
+                emails_html += f'<div class="email"><b>{sender}</b> <span class="when">{when}</span><br>{subject}</div>'
+            senders = ", ".join(f'{s["name"][:20]} ({s["count"]})' for s in digest["senders"])
+            if senders:
+                emails_html += f'<div class="summary">Meiste Mails von: {senders}</div>'
+            threads = ", ".join(f'{t["subject"][:30]} ({t["count"]})' for t in digest["threads"] if t["count"] > 1)
+            if threads:
+                emails_html += f'<div class="summary">Unterhaltungen: {threads}</div>'
+
+        self._send_html(f"""
 <!DOCTYPE html>
 <html>
 <head>
@@ -896,6 +4499,8 @@ class ChiefOfStaffHandler(BaseHTTPRequestHandler):
             background: #252540; padding: 12px; margin: 8px 0;
             border-radius: 8px; border-left: 3px solid #ff8a65;
         }}
+        .email .when {{ color: #888; font-size: 12px; }}
+        .summary {{ color: #888; font-size: 13px; margin: 8px 0; }}
         .context {{
             background: #252540; padding: 15px;
             border-radius: 8px; white-space: pre-wrap;
@@ -914,160 +4519,19 @@ class ChiefOfStaffHandler(BaseHTTPRequestHandler):
     <h1>Guten Morgen!</h1>
     <div class="date">{now.strftime("%A, %d. %B %Y")}</div>
 
-    <h2>Top Tasks ({len(today_tasks)} offen)</h2>
+    <h2>Top Tasks ({today_count} offen)</h2>
     {tasks_html if tasks_html else '<div class="task">Keine Tasks für heute</div>'}
 
-    <h2>Emails ({len(all_emails)} ungelesen)</h2>
+    <h2>Emails ({digest["total"]} ungelesen)</h2>
     {emails_html if emails_html else '<div class="email">Keine ungelesenen Emails</div>'}
 
     <h2>Kontext</h2>
-    <div class="context">{claude_md[:500] if claude_md else 'Kein Kontext gespeichert'}</div>
+    <div class="context">{claude_md if claude_md else 'Kein Kontext gespeichert'}</div>
 
     <button class="refresh" onclick="location.reload()">↻</button>
 </body>
 </html>
-            """.encode())
-
-        else:
-            self._set_headers(404)
-            self.wfile.write(json.dumps({"error": "Not found"}).encode())
-
-    def do_POST(self):
-        global tasks_data, notes_data
-        path = urlparse(self.path).path
-        content_length = int(self.headers.get("Content-Length", 0))
-        body = self.rfile.read(content_length)
-
-        # Check auth (allow API key for POST - needed for Amplenote sync)
-        if not self._check_auth(allow_api_key=True):
-            self._set_headers(401)
-            self.wfile.write(json.dumps({
-                "error": "Unauthorized",
-                "login_url": f"{SERVER_URL}/login"
-            }).encode())
-            return
-
-        if path == "/tasks":
-            try:
-                data = json.loads(body)
-                tasks_data = {
-                    "tasks": data.get("tasks", []),
-                    "syncedAt": data.get("syncedAt", datetime.now().timestamp() * 1000)
-                }
-                save_tasks()
-                self._set_headers()
-                self.wfile.write(json.dumps({
-                    "success": True,
-                    "count": len(tasks_data["tasks"])
-                }).encode())
-                print(f"Received {len(tasks_data['tasks'])} tasks")
-            except json.JSONDecodeError:
-                self._set_headers(400)
-                self.wfile.write(json.dumps({"error": "Invalid JSON"}).encode())
-
-        elif path == "/notes":
-            try:
-                data = json.loads(body)
-                notes_data = {
-                    "notes": data.get("notes", []),
-                    "syncedAt": data.get("syncedAt", datetime.now().timestamp() * 1000)
-                }
-                save_notes()
-                self._set_headers()
-                self.wfile.write(json.dumps({
-                    "success": True,
-                    "count": len(notes_data["notes"])
-                }).encode())
-                print(f"Received {len(notes_data['notes'])} notes")
-            except json.JSONDecodeError:
-                self._set_headers(400)
-                self.wfile.write(json.dumps({"error": "Invalid JSON"}).encode())
-
-        elif path == "/context":
-            # Receive context files (MD files from local machine)
-            global context_data
-            try:
-                data = json.loads(body)
-                context_data = {
-                    "files": data.get("files", {}),
-                    "syncedAt": data.get("syncedAt", datetime.now().timestamp() * 1000)
-                }
-                save_context()
-                self._set_headers()
-                self.wfile.write(json.dumps({
-                    "success": True,
-                    "files": list(context_data["files"].keys())
-                }).encode())
-                print(f"Received context files: {list(context_data['files'].keys())}")
-            except json.JSONDecodeError:
-                self._set_headers(400)
-                self.wfile.write(json.dumps({"error": "Invalid JSON"}).encode())
-
-        elif path.startswith("/context/"):
-            # Update a single context file: POST /context/CLAUDE.md
-            # Requires device token auth
-            if not self._check_auth():
-                self._set_headers(401)
-                self.wfile.write(json.dumps({"error": "Unauthorized"}).encode())
-                return
-
-            filename = path.replace("/context/", "")
-            if not filename.endswith(".md"):
-                self._set_headers(400)
-                self.wfile.write(json.dumps({"error": "Only .md files allowed"}).encode())
-                return
-
-            try:
-                data = json.loads(body)
-                content = data.get("content")
-                if content is None:
-                    self._set_headers(400)
-                    self.wfile.write(json.dumps({"error": "Missing content"}).encode())
-                    return
-
-                # Update the file in context_data
-                if "files" not in context_data:
-                    context_data["files"] = {}
-                context_data["files"][filename] = content
-                context_data["syncedAt"] = datetime.now().timestamp() * 1000
-                save_context()
-
-                self._set_headers()
-                self.wfile.write(json.dumps({
-                    "success": True,
-                    "file": filename,
-                    "updatedAt": context_data["syncedAt"]
-                }).encode())
-                print(f"Updated context file: {filename}")
-            except json.JSONDecodeError:
-                self._set_headers(400)
-                self.wfile.write(json.dumps({"error": "Invalid JSON"}).encode())
-
-        elif path == "/gmail/token":
-            # Receive OAuth token from local auth flow
-            try:
-                data = json.loads(body)
-                email = data.get("email")
-                token_data = data.get("token")
-                if email and token_data:
-                    token_file = get_token_file(email)
-                    with open(token_file, 'w') as f:
-                        json.dump(token_data, f)
-                    # Clear cached service to reload
-                    if email in gmail_services:
-                        del gmail_services[email]
-                    self._set_headers()
-                    self.wfile.write(json.dumps({"success": True}).encode())
-                else:
-                    self._set_headers(400)
-                    self.wfile.write(json.dumps({"error": "Missing email or token"}).encode())
-            except Exception as e:
-                self._set_headers(400)
-                self.wfile.write(json.dumps({"error": str(e)}).encode())
-
-        else:
-            self._set_headers(404)
-            self.wfile.write(json.dumps({"error": "Not found"}).encode())
+        """)
 
     def log_message(self, format, *args):
         print(f"[{datetime.now().strftime('%H:%M:%S')}] {args[0]}")
@@ -1078,12 +4542,20 @@ class ChiefOfStaffHandler(BaseHTTPRequestHandler):
 # =============================================================================
 
 def main():
+    startup.mark("module")
     load_data()
+    startup.mark("load_data")
     load_devices()
-
-    server = HTTPServer(("0.0.0.0", PORT), ChiefOfStaffHandler)
+    startup.mark("load_devices")
+
+    server = ThreadingHTTPServer(("0.0.0.0", PORT), ChiefOfStaffHandler)
+    server.daemon_threads = True
+    startup.mark("bind")
+    partitions.run_maintenance()
+    if GOOGLE_WARMUP:
+        threading.Thread(target=google_libs, name="google-warmup", daemon=True).start()
+    print(f"Startup: {startup.summary()}")
     print(f"Chief of Staff Server running on port {PORT}")
-    print(f"Tasks: {len(tasks_data.get('tasks', []))} | Notes: {len(notes_data.get('notes', []))}")
     print(f"Devices: {len(devices_data.get('devices', []))}")
     print(f"Gmail accounts: {', '.join(a for a in GMAIL_ACCOUNTS if a)}")
     print(f"Data directory: {DATA_DIR}")